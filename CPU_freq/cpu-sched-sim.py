@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Off-device replay of cpu-scheduler.py.
+
+`record` samples /proc/stat (cpu lines), /proc/pressure/cpu and scaling_cur_freq into a JSONL trace.
+`replay` runs the real Scheduler.step() against a temporary fake cpufreq/procfs/state tree on a simulated
+clock that follows the trace's wall-clock timeline, and reports governor/limit transitions, decision
+latency, the scheduler's own CPU time per iteration and an estimated energy figure.
+
+Energy model (estimate only): P = base_w + cores * w_per_ghz3 * f_GHz^3 * util. The recorded busy time is
+converted to cycles at the recorded frequency, so lower clocks raise util (saturating at 100 %).
+"""
+
+import argparse, bisect, datetime as _datetime, importlib.util, json, pathlib, statistics, sys, tempfile, time
+
+HERE = pathlib.Path(__file__).resolve().parent
+DEFAULT_FREQS = list(range(600_000, 2_800_001, 100_000))
+BASE_W = 2.7          # Pi 5 board idle
+W_PER_GHZ3 = 0.078    # per fully busy core; ~7 W for 4 cores at 2.4 GHz
+
+def load_scheduler():
+    spec=importlib.util.spec_from_file_location("cpu_scheduler", HERE/"cpu-scheduler.py")
+    m=importlib.util.module_from_spec(spec); spec.loader.exec_module(m); return m
+
+# ---------- record ----------
+def cmd_record(args):
+    cur=pathlib.Path("/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq")
+    end=time.time()+args.duration if args.duration else None
+    with open(args.out,"a") as out:
+        while end is None or time.time()<end:
+            with open("/proc/stat") as f: stat="".join(l for l in f if l.startswith("cpu"))
+            try: psi=next(l for l in open("/proc/pressure/cpu") if l.startswith("some "))
+            except (OSError,StopIteration): psi=None
+            try: khz=int(cur.read_text())
+            except (OSError,ValueError): khz=None
+            out.write(json.dumps({"t":round(time.time(),3),"stat":stat,"psi":psi,"khz":khz})+"\n"); out.flush()
+            time.sleep(args.interval)
+
+# ---------- simulated clock ----------
+class SimClock:
+    """Stands in for the `time` and `datetime` modules inside the scheduler."""
+    def __init__(self, t): self.t=t; self.t0=t
+    def time(self): return self.t
+    def monotonic(self): return 1000.0+self.t-self.t0
+    def sleep(self, s): self.t+=s
+    def localtime(self, ts=None): return time.localtime(self.t if ts is None else ts)
+    def strftime(self, fmt, tup=None): return time.strftime(fmt, self.localtime() if tup is None else tup)
+    def datetime_module(self):
+        clock=self
+        class _DT(_datetime.datetime):
+            @classmethod
+            def now(cls, tz=None): return cls.fromtimestamp(clock.t, tz)
+        return type("datetime_shim",(),{"datetime":_DT,"timedelta":_datetime.timedelta})
+
+# ---------- trace handling ----------
+def parse_stat(text):
+    """{"cpu": [fields...], "cpu0": [...]} from the recorded cpu lines."""
+    return {l.split()[0]:[int(x) for x in l.split()[1:]] for l in text.splitlines() if l.startswith("cpu")}
+
+def psi_total(line):
+    try: return int(line.rsplit("total=",1)[1])
+    except (AttributeError,ValueError,IndexError): return None
+
+def interp(a, b, frac):
+    return {k:[int(x+(y-x)*frac) for x,y in zip(a[k],b[k])] for k in a if k in b}
+
+def render_stat(stat):
+    return "".join(f"{k} {' '.join(map(str,v))}\n" for k,v in stat.items())
+
+def busy_frac(cur, prev):
+    c,p=cur["cpu"],prev["cpu"]; tot=sum(c)-sum(p)
+    if tot<=0: return 0.0
+    idle=(c[3]+(c[4] if len(c)>4 else 0))-(p[3]+(p[4] if len(p)>4 else 0))
+    return max(0.0,min(1.0,1.0-idle/tot))
+
+# ---------- fake tree ----------
+def build_tree(root, ncpu, freqs, temp_c):
+    for c in range(ncpu):
+        d=root/"sys"/f"cpu{c}"/"cpufreq"; d.mkdir(parents=True)
+        for n,v in (("scaling_available_frequencies"," ".join(map(str,freqs))),
+                    ("scaling_available_governors","conservative ondemand userspace powersave performance schedutil"),
+                    ("scaling_governor","schedutil"),("scaling_min_freq",freqs[0]),("scaling_max_freq",freqs[-1]),
+                    ("scaling_cur_freq",freqs[-1]),("cpuinfo_min_freq",freqs[0]),("cpuinfo_max_freq",freqs[-1])):
+            (d/n).write_text(f"{v}\n")
+    (root/"proc"/"pressure").mkdir(parents=True); (root/"state").mkdir(); (root/"cgroup").mkdir()
+    (root/"proc"/"stat").touch(); (root/"proc"/"pressure"/"cpu").touch()
+    (root/"temp").write_text(f"{int(temp_c*1000)}\n")
+
+def governor_freq(gov, fmin, fmax, demand_khz, freqs):
+    """Rough steady-state frequency the kernel governor would pick for this demand."""
+    if gov=="performance": return fmax
+    if gov in ("powersave","userspace"): return fmin
+    want=demand_khz*1.25  # schedutil headroom; close enough for ondemand/conservative
+    i=bisect.bisect_left(freqs,want); f=freqs[i] if i<len(freqs) else freqs[-1]
+    return max(fmin,min(fmax,f))
+
+# ---------- replay ----------
+def replay(args):
+    trace=[json.loads(l) for l in open(args.trace) if l.strip()]
+    if len(trace)<2: sys.exit("trace needs at least two samples")
+    for r in trace: r["cpus"]=parse_stat(r["stat"]); r["psi_us"]=psi_total(r.get("psi"))
+    ncpu=sum(1 for k in trace[0]["cpus"] if k!="cpu")
+    freqs=sorted(int(x) for x in args.freqs.split(",")) if args.freqs else DEFAULT_FREQS
+    tmp=tempfile.TemporaryDirectory(prefix="cpu-sched-sim-"); root=pathlib.Path(tmp.name)
+    build_tree(root, ncpu, freqs, args.temp_c)
+
+    m=load_scheduler(); clock=SimClock(trace[0]["t"])
+    m.time=clock; m.datetime=clock.datetime_module()
+    m.set_roots(cpufreq_base=root/"sys", proc=root/"proc", state_dir=root/"state", fan_mode_path=root/"fan_mode",
+                thermal_zone=root/"temp", cgroup_root=root/"cgroup")
+    m.SYSFS.truncate=True  # plain files, not kernel attributes
+    m._MQTT=m.MqttLink("cpu_scheduler_sim", config={})  # empty broker config: never connects
+    cfg=dict(m.DEFAULT_CFG)
+    if args.config: cfg.update(json.loads(pathlib.Path(args.config).read_text()))
+    cfg["fan_mode_path"]=str(root/"fan_mode"); m.CFG_FILE.write_text(json.dumps(cfg))
+    m.MODE_FILE.write_text(args.mode+"\n")
+    def log(msg):
+        if args.verbose: print(time.strftime("%m-%d %H:%M:%S",time.localtime(clock.t)), msg)
+    m.log=log
+
+    cpufreq=root/"sys"/"cpu0"/"cpufreq"; lw=m.LAST_WRITTEN
+    fake=m.SysfsCache(truncate=True)  # held fds for the per-iteration fake /proc writes
+    def state(): return (lw["gov"],lw["min"],lw["max"])  # what the scheduler wrote into the fake tree
+    def write_proc(t, write=True):
+        i=max(1,min(len(trace)-1,bisect.bisect_right(times,t)))
+        a,b=trace[i-1],trace[i]; frac=max(0.0,min(1.0,(t-a["t"])/max(1e-9,b["t"]-a["t"])))
+        stat=interp(a["cpus"],b["cpus"],frac)
+        if not write: return stat, (a.get("khz") or freqs[-1])
+        fake.write(root/"proc"/"stat",render_stat(stat),force=True)
+        if a["psi_us"] is not None and b["psi_us"] is not None:
+            fake.write(root/"proc"/"pressure"/"cpu",f"some avg10=0.00 avg60=0.00 avg300=0.00 total={int(a['psi_us']+(b['psi_us']-a['psi_us'])*frac)}\n")
+        return stat, (a.get("khz") or freqs[-1])
+    times=[r["t"] for r in trace]
+
+    S=m.Scheduler(); S.init_profile()
+    t=times[0]; end=times[-1]
+    transitions=[]; last_state=state(); costs=[]; energy_j=0.0; saturated_s=0.0; time_in={"idle":0.0,"perf":0.0}
+    lat={"up":[],"down":[]}; high_since=low_since=None
+    # latency timers use the scheduler's own signals (aggregate, per-core, PSI) and
+    # predicates on the unsmoothed load, so every switch reason starts a timer
+    probe=m.LoadSampler(); probe_t=t
+    while t<end:
+        clock.t=t
+        stat,rec_khz=write_proc(t)
+        load=probe.sample()
+        if load is not None:
+            if S.profile=="idle" and m.load_is_high(load,S.cfg): high_since=probe_t if high_since is None else high_since
+            elif S.profile=="idle": high_since=None
+            if S.profile=="perf" and m.load_is_low(load,S.cfg): low_since=probe_t if low_since is None else low_since
+            elif S.profile=="perf": low_since=None
+        probe_t=t
+        c0=time.process_time(); sleep=S.step(); costs.append(time.process_time()-c0)
+        st=state()
+        if st!=last_state:
+            transitions.append({"t":t,"governor":st[0],"min":int(st[1]),"max":int(st[2]),"profile":S.profile})
+            if S.profile=="perf" and high_since is not None: lat["up"].append(t-high_since)
+            if S.profile=="idle" and low_since is not None: lat["down"].append(t-low_since)
+            high_since=low_since=None; last_state=st
+        # energy over the interval until the next wakeup
+        nxt=min(end,t+max(sleep,0.05)); nstat,_=write_proc(nxt,write=False); dt=nxt-t
+        busy=busy_frac(nstat,stat)
+        demand=busy*rec_khz; f=governor_freq(st[0],int(st[1]),int(st[2]),demand,freqs)
+        fake.write(cpufreq/"scaling_cur_freq",f"{f}\n")
+        util=demand/f if f else 0.0
+        if util>1.0: saturated_s+=dt; util=1.0
+        energy_j+=dt*(args.base_w+ncpu*args.w_per_ghz3*(f/1e6)**3*util)
+        if S.profile in time_in: time_in[S.profile]+=dt
+        t=nxt
+    S.write_stats(force=True)
+
+    dur=end-times[0]
+    def summ(v): return {"n":len(v),"mean_s":round(statistics.mean(v),1),"max_s":round(max(v),1)} if v else {"n":0}
+    costs_us=sorted(c*1e6 for c in costs)
+    report={"duration_h":round(dur/3600,2),"iterations":len(costs),"transitions":len(transitions),
+            "transitions_by_tag":json.loads(m.STATS_FILE.read_text()).get("transitions_by_tag",{}),
+            "time_in_profile_h":{k:round(v/3600,2) for k,v in time_in.items()},
+            "decision_latency":{"idle->perf":summ(lat["up"]),"perf->idle":summ(lat["down"])},
+            "cpu_per_iteration_us":{"mean":round(statistics.mean(costs_us),1),"p95":round(costs_us[int(len(costs_us)*0.95)],1),"max":round(costs_us[-1],1)},
+            "energy_wh":round(energy_j/3600,2),"avg_power_w":round(energy_j/max(dur,1e-9),3),
+            "saturated_s":round(saturated_s,1)}
+    if args.transitions: report["transition_log"]=transitions
+    if args.json: print(json.dumps(report,indent=2)); return report
+    print(f"replayed {report['duration_h']} h, {report['iterations']} iterations, {report['transitions']} transitions")
+    for tr in transitions if args.transitions else ():
+        print(f"  {time.strftime('%m-%d %H:%M:%S',time.localtime(tr['t']))} {tr['profile']:4} gov={tr['governor']} min={tr['min']} max={tr['max']}")
+    print(f"by tag: {report['transitions_by_tag']}")
+    print(f"time in profile (h): {report['time_in_profile_h']}")
+    for k,v in report["decision_latency"].items():
+        print(f"decision latency {k}: " + (f"n={v['n']} mean={v['mean_s']} s max={v['max_s']} s" if v["n"] else "n=0"))
+    c=report["cpu_per_iteration_us"]; print(f"scheduler CPU per iteration: mean={c['mean']} us p95={c['p95']} us max={c['max']} us")
+    print(f"estimated energy: {report['energy_wh']} Wh (avg {report['avg_power_w']} W), saturated {report['saturated_s']} s")
+    return report
+
+def main():
+    ap=argparse.ArgumentParser(); sub=ap.add_subparsers(dest="cmd",required=True)
+    prec=sub.add_parser("record"); prec.add_argument("out"); prec.add_argument("--interval",type=float,default=5.0)
+    prec.add_argument("--duration",type=float,help="seconds (default: until interrupted)")
+    prep=sub.add_parser("replay"); prep.add_argument("trace")
+    prep.add_argument("--config",help="config.json to test (merged over the defaults)")
+    prep.add_argument("--mode",default="auto",choices=["auto","day-auto","force-low","force-high"])
+    prep.add_argument("--freqs",help="comma-separated available frequencies in kHz")
+    prep.add_argument("--temp-c",type=float,default=50.0); prep.add_argument("--base-w",type=float,default=BASE_W)
+    prep.add_argument("--w-per-ghz3",type=float,default=W_PER_GHZ3)
+    prep.add_argument("--transitions",action="store_true",help="list every governor/limit transition")
+    prep.add_argument("--json",action="store_true"); prep.add_argument("-v","--verbose",action="store_true")
+    args=ap.parse_args()
+    try:
+        if args.cmd=="record": cmd_record(args)
+        else: replay(args)
+    except KeyboardInterrupt: pass
+
+if __name__=="__main__": main()
@@ -5,12 +5,12 @@ RPi CPU scheduler v2: day/night switching + load monitoring with hard enforcemen
 Works with overclocking (arm_freq=2800 in /boot/firmware/config.txt): uses 'schedutil' during the day, 'powersave' when idle.
 """
 
-import time, datetime, pathlib, os, sys, argparse, json
+import time, datetime, pathlib, os, sys, argparse, json, select, bisect, math, hashlib, subprocess, statistics
 
-try:
-    import paho.mqtt.client as mqtt
-except Exception:  # pragma: no cover - optional dependency for status publish
-    mqtt = None
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent/"common"))
+from mqtt_link import MqttLink
+from inotify import Inotify
+from sysfs import SysfsCache
 
 # -------- default configuration --------
 NIGHT_START = "22:00"
@@ -28,21 +28,73 @@ LOW_LOAD_PCT         = 35
 LOW_LOAD_DURATION_S  = 300
 HIGH_LOAD_PCT        = 80
 HIGH_LOAD_DURATION_S = 10
+# per-core and PSI inputs (null in config.json disables a signal)
+HIGH_CORE_PCT        = 95    # a single core pegged (single-threaded job)
+LOW_CORE_PCT         = 70
+HIGH_PSI_PCT         = 20.0  # % of time some task waited for a CPU
+LOW_PSI_PCT          = 5.0
+# load estimator: switch up on the fast EWMA, down on the slow one
+EWMA_FAST_S          = 3.0
+EWMA_SLOW_S          = 60.0
+MIN_IDLE_DWELL_S     = 30    # minimum time in a profile before auto switching away
+MIN_PERF_DWELL_S     = 120
+STATS_WRITE_INTERVAL_S = 30
+# learned weekday x 15-minute load profile (optional)
+SLOT_S               = 900
+SLOTS_PER_WEEK       = 7 * 24 * 3600 // SLOT_S
+PREDICT_LEAD_S       = 120   # pre-switch this long before a predicted busy slot
+PREDICT_BUSY_FRAC    = 0.3   # slot counts as busy when >= 30 % of it had high load
+PREDICT_MIN_WEEKS    = 2     # observations of a slot needed before predicting
+LEARN_RATE           = 0.25  # weight of a new week once the slot has history
+# thermal governor: step max frequency down before the firmware throttles (80 °C on the Pi 5)
+THERMAL_FAN_C        = 68    # predicted temp that raises the fan mode silent -> normal
+THERMAL_CAP_C        = 75    # predicted temp that lowers scaling_max_freq by one step
+THERMAL_RELEASE_C    = 70    # cap is lifted step by step once at/below this and not rising
+THERMAL_STEP_KHZ     = 200000
+THERMAL_STEP_S       = 5     # minimum time between two cap steps (either direction)
+THERMAL_LOOKAHEAD_S  = 15    # predicted temp = temp + rising slope * lookahead
+THERMAL_SLOPE_S      = 10    # EWMA time constant of the temperature slope
+# process/cgroup boost rules
+BOOST_SCAN_S         = 10    # full /proc comm scan interval
 
 CHECK_INTERVAL_S = 1.0
+ENFORCE_INTERVAL_S = 5.0   # re-check limits when no load sampling is needed
 FAN_MODE_PATH = "/run/fan_mode"
 # -------------------------------------
 
-CPUFREQ_BASE = pathlib.Path("/sys/devices/system/cpu")
-CPUS = [p for p in CPUFREQ_BASE.glob("cpu[0-9]*") if (p/"cpufreq").exists()]
-
-STATE_DIR = pathlib.Path("/var/lib/cpu-scheduler"); STATE_DIR.mkdir(parents=True, exist_ok=True)
-CFG_FILE   = STATE_DIR/"config.json"
-MODE_FILE  = STATE_DIR/"mode"
-OVR_FILE   = STATE_DIR/"override_until"
 LAST_WRITTEN = {"gov": None, "min": None, "max": None, "fan": None, "force_high_fallback": None}
 _AVAILABLE_GOVS = None
-_MQTT_CFG = None
+_AVAILABLE_FREQS = None
+_CPUFREQ_PATHS = {}
+SYSFS = SysfsCache()  # cpufreq attributes with fds held open
+
+def set_roots(cpufreq_base=None, proc=None, state_dir=None, fan_mode_path=None, thermal_zone=None, cgroup_root=None):
+    """Point the daemon at (fake) sysfs/procfs/state trees. Unset arguments fall
+    back to CPU_SCHED_<NAME> environment variables, then to the real paths."""
+    global CPUFREQ_BASE, CPUS, PROC, PROC_STAT, PSI_CPU, STATE_DIR, CFG_FILE, MODE_FILE, OVR_FILE
+    global STATS_FILE, PROFILE_FILE, FAN_MODE_PATH, THERMAL_ZONE, CGROUP_ROOT, _AVAILABLE_GOVS, _AVAILABLE_FREQS
+    env=lambda name, default: pathlib.Path(os.environ.get("CPU_SCHED_"+name, default))
+    CPUFREQ_BASE = pathlib.Path(cpufreq_base) if cpufreq_base else env("CPUFREQ_BASE", "/sys/devices/system/cpu")
+    CPUS = sorted((p for p in CPUFREQ_BASE.glob("cpu[0-9]*") if (p/"cpufreq").exists()), key=lambda p: int(p.name[3:]))
+    PROC = pathlib.Path(proc) if proc else env("PROC", "/proc")
+    PROC_STAT = PROC/"stat"; PSI_CPU = PROC/"pressure"/"cpu"
+    STATE_DIR = pathlib.Path(state_dir) if state_dir else env("STATE_DIR", "/var/lib/cpu-scheduler")
+    try: STATE_DIR.mkdir(parents=True, exist_ok=True)
+    except PermissionError: pass  # unprivileged `status` before the daemon ever ran
+    CFG_FILE = STATE_DIR/"config.json"; MODE_FILE = STATE_DIR/"mode"; OVR_FILE = STATE_DIR/"override_until"
+    STATS_FILE = STATE_DIR/"stats.json"; PROFILE_FILE = STATE_DIR/"load_profile.json"
+    FAN_MODE_PATH = str(fan_mode_path or os.environ.get("CPU_SCHED_FAN_MODE_PATH", FAN_MODE_PATH))
+    THERMAL_ZONE = pathlib.Path(thermal_zone) if thermal_zone else env("THERMAL_ZONE", "/sys/class/thermal/thermal_zone0/temp")
+    CGROUP_ROOT = pathlib.Path(cgroup_root) if cgroup_root else env("CGROUP_ROOT", "/sys/fs/cgroup")
+    # new tree: drop held fds and everything read or written through the old one
+    SYSFS.close(); _AVAILABLE_GOVS = _AVAILABLE_FREQS = None
+    _CPUFREQ_PATHS.clear()
+    for k in LAST_WRITTEN: LAST_WRITTEN[k] = None
+    if "DEFAULT_CFG" in globals(): DEFAULT_CFG["fan_mode_path"] = FAN_MODE_PATH
+
+set_roots()
+MQTT_MODE_TOPIC = "rpi/cpu_scheduler/mode"
+_MQTT = MqttLink("cpu_scheduler", status_topic="rpi/cpu_scheduler/status")
 _MQTT_LAST = None
 
 def log(msg): print(time.strftime("%H:%M:%S"), msg, flush=True)
@@ -51,10 +103,11 @@ def _read_int(p: pathlib.Path):
     try: return int(p.read_text().strip())
     except: return None
 
-def _write_str(p: pathlib.Path, s: str):
-    with open(p, "w") as f: f.write(str(s))
-
-def cpufreq_paths(name: str): return [cpu/"cpufreq"/name for cpu in CPUS]
+def cpufreq_paths(name: str):
+    # built once per attribute; pathlib joins cost more than the pread itself
+    paths = _CPUFREQ_PATHS.get(name)
+    if paths is None: paths = _CPUFREQ_PATHS[name] = [cpu/"cpufreq"/name for cpu in CPUS]
+    return paths
 
 def available_governors():
     global _AVAILABLE_GOVS
@@ -62,76 +115,45 @@ def available_governors():
         sample = CPUS[0]/"cpufreq"
         govs_path = sample/"scaling_available_governors"
         if govs_path.exists():
-            _AVAILABLE_GOVS = govs_path.read_text().strip().split()
+            _AVAILABLE_GOVS = SYSFS.read(govs_path, static=True).split()
         else:
             _AVAILABLE_GOVS = []
     return _AVAILABLE_GOVS
 
 def available_freqs():
+    # static attributes: read once per process
+    global _AVAILABLE_FREQS
+    if _AVAILABLE_FREQS is not None:
+        return _AVAILABLE_FREQS
     sample = CPUS[0]/"cpufreq"
     av = sample/"scaling_available_frequencies"
     if av.exists():
-        vals = [int(x) for x in av.read_text().split()]
-        return sorted(set(vals))
-    mn = _read_int(sample/"cpuinfo_min_freq")
-    mx = _read_int(sample/"cpuinfo_max_freq")
-    return [v for v in (mn, mx) if v]
-
-def load_mqtt_config():
-    global _MQTT_CFG
-    if _MQTT_CFG is not None:
-        return _MQTT_CFG
-    config_path = pathlib.Path("/home/vojrik/homeassistant/.storage/core.config_entries")
-    try:
-        data = json.loads(config_path.read_text())
-    except Exception:
-        _MQTT_CFG = None
-        return None
-    for entry in data.get("data", {}).get("entries", []):
-        if entry.get("domain") == "mqtt":
-            cfg = entry.get("data", {})
-            _MQTT_CFG = {
-                "host": cfg.get("broker", "127.0.0.1"),
-                "port": int(cfg.get("port", 1883)),
-                "username": cfg.get("username"),
-                "password": cfg.get("password"),
-            }
-            return _MQTT_CFG
-    _MQTT_CFG = None
-    return None
+        _AVAILABLE_FREQS = sorted(set(int(x) for x in SYSFS.read(av, static=True).split()))
+    else:
+        mn = SYSFS.read_int(sample/"cpuinfo_min_freq", static=True)
+        mx = SYSFS.read_int(sample/"cpuinfo_max_freq", static=True)
+        _AVAILABLE_FREQS = [v for v in (mn, mx) if v]
+    return _AVAILABLE_FREQS
 
 def publish_mode(mode: str):
     global _MQTT_LAST
     normalized = {"force-high": "high", "force-low": "low", "day-auto": "auto"}.get(mode, mode)
     if normalized == _MQTT_LAST:
         return
-    if mqtt is None:
-        return
-    cfg = load_mqtt_config()
-    if not cfg:
-        return
-    try:
-        client = mqtt.Client(client_id="cpu_scheduler", clean_session=True)
-        if cfg.get("username"):
-            client.username_pw_set(cfg.get("username"), cfg.get("password"))
-        client.connect(cfg["host"], cfg["port"], 10)
-        client.publish("rpi/cpu_scheduler/mode", normalized, retain=True)
-        client.disconnect()
+    # queued on the persistent connection, never blocks the control loop
+    if _MQTT.publish(MQTT_MODE_TOPIC, normalized, retain=True):
         _MQTT_LAST = normalized
-    except Exception:
-        pass
 
 def clamp_freq(khz: int):
-    av = available_freqs()
-    if not av: return khz
-    av_sorted = sorted(set(av))
+    av_sorted = available_freqs()
+    if not av_sorted: return khz
     # choose the closest value <= requested, otherwise fall back to minimum
-    candidates = [f for f in av_sorted if f <= khz]
-    return candidates[-1] if candidates else av_sorted[0]
+    i = bisect.bisect_right(av_sorted, khz)
+    return av_sorted[i-1] if i else av_sorted[0]
 
 def set_governor(name: str):
     for p in cpufreq_paths("scaling_governor"):
-        try: _write_str(p, name)
+        try: SYSFS.write(p, name, force=True)
         except: pass
 
 def ensure_governor(name: str):
@@ -142,10 +164,8 @@ def ensure_governor(name: str):
     changed = False
     for p in cpufreq_paths("scaling_governor"):
         try:
-            cur = p.read_text().strip()
-            if cur != name:
-                _write_str(p, name)
-                changed = True
+            # cheap pread on the cached fd; written only when it differs
+            if SYSFS.ensure(p, name) != name: changed = True
         except: pass
     if changed or LAST_WRITTEN["gov"] != name:
         log(f"GOVERNOR={name}")
@@ -172,11 +192,16 @@ def enforce_min_max(min_khz: int, max_khz: int, tag: str):
     tmax = clamp_freq(max_khz)
     if tmin > tmax: tmin, tmax = tmax, tmin
 
-    # the Pi occasionally overwrites max -> enforce every time but log only on change
-    cur_min = _read_int(cpufreq_paths("scaling_min_freq")[0]) or 0
-    cur_max = _read_int(cpufreq_paths("scaling_max_freq")[0]) or 0
-    for p in cpufreq_paths("scaling_min_freq"): _write_str(p, tmin)
-    for p in cpufreq_paths("scaling_max_freq"): _write_str(p, tmax)
+    # the Pi occasionally overwrites max -> check every time (pread on held fds),
+    # rewrite only values that differ and log only on change
+    cur_min = cur_max = None
+    for pmin, pmax in zip(cpufreq_paths("scaling_min_freq"), cpufreq_paths("scaling_max_freq")):
+        omin = SYSFS.read_int(pmin) or 0; omax = SYSFS.read_int(pmax) or 0
+        if cur_min is None: cur_min, cur_max = omin, omax
+        # write order keeps min <= max at every step
+        order = ((pmax, tmax, omax), (pmin, tmin, omin)) if tmin > omax else ((pmin, tmin, omin), (pmax, tmax, omax))
+        for p, v, old in order:
+            if old != v: SYSFS.write(p, v, force=True)
 
     if LAST_WRITTEN["min"] != tmin or LAST_WRITTEN["max"] != tmax:
         log(f"PROFILE={tag} min={tmin} max={tmax} kHz")
@@ -210,33 +235,267 @@ def set_fan_mode(mode: str):
         except Exception:
             pass
 
-def cpu_usage_pct(interval: float):
-    """Return CPU busy percentage over the provided interval using /proc/stat."""
-    def snap():
-        with open("/proc/stat", "r", encoding="ascii") as f:
-            for line in f:
-                if line.startswith("cpu "):
-                    parts = [int(x) for x in line.split()[1:]]
-                    if len(parts) < 4:
-                        raise RuntimeError("Unexpected /proc/stat format")
-                    idle = parts[3]
-                    if len(parts) > 4:
-                        idle += parts[4]  # account for iowait
-                    total = sum(parts)
-                    return total, idle
+def proc_stat_cpus():
+    """Return {"cpu": (total, idle+iowait), "cpu0": (...), ...} jiffies from /proc/stat."""
+    out = {}
+    with open(PROC_STAT, "r", encoding="ascii") as f:
+        for line in f:
+            if not line.startswith("cpu"): break
+            fields = line.split()
+            parts = [int(x) for x in fields[1:]]
+            if len(parts) < 4:
+                raise RuntimeError("Unexpected /proc/stat format")
+            idle = parts[3]
+            if len(parts) > 4:
+                idle += parts[4]  # account for iowait
+            out[fields[0]] = (sum(parts), idle)
+    if "cpu" not in out:
         raise RuntimeError("Missing cpu line in /proc/stat")
+    return out
+
+def psi_cpu_some_us():
+    """Cumulative 'some' CPU stall time in us from PSI, or None if PSI is off."""
+    try:
+        with open(PSI_CPU, "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("some "):
+                    return int(line.rsplit("total=", 1)[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+def _busy_pct(cur, prev):
+    total_delta = cur[0] - prev[0]
+    if total_delta <= 0: return 0.0
+    return max(0.0, min(100.0, 100.0 * (1.0 - ((cur[1] - prev[1]) / total_delta))))
+
+class LoadSampler:
+    """Load between consecutive sample() calls (never sleeps): aggregate and
+    per-core busy % from /proc/stat plus the share of wall time in which some
+    task was stalled waiting for a CPU (PSI)."""
+    def __init__(self): self.prev = None
+    def reset(self): self.prev = None
+    def sample(self):
+        cur = (time.monotonic(), proc_stat_cpus(), psi_cpu_some_us())
+        prev, self.prev = self.prev, cur
+        if prev is None: return None
+        cores = [_busy_pct(v, prev[1][k]) for k, v in cur[1].items() if k != "cpu" and k in prev[1]]
+        psi = None
+        dt = cur[0] - prev[0]
+        if cur[2] is not None and prev[2] is not None and dt > 0:
+            psi = max(0.0, min(100.0, (cur[2] - prev[2]) / (dt * 1e6) * 100.0))
+        return {"total": _busy_pct(cur[1]["cpu"], prev[1]["cpu"]),
+                "max_core": max(cores) if cores else 0.0, "psi": psi}
+
+class LoadEstimator:
+    """Fast and slow exponentially weighted averages of each load signal.
+    The smoothing factor follows the real sample spacing (1 - exp(-dt/tau))."""
+    def __init__(self): self.fast = None; self.slow = None
+    def reset(self): self.fast = None; self.slow = None
+    @staticmethod
+    def _blend(avg, load, alpha):
+        if avg is None: return dict(load)
+        out = {}
+        for k, v in load.items():
+            prev = avg.get(k)
+            out[k] = v if v is None or prev is None else prev + alpha * (v - prev)
+        return out
+    def update(self, load, dt, cfg):
+        self.fast = self._blend(self.fast, load, 1.0 - math.exp(-dt / max(0.1, cfg["ewma_fast_s"])))
+        self.slow = self._blend(self.slow, load, 1.0 - math.exp(-dt / max(0.1, cfg["ewma_slow_s"])))
+
+def _over(value, limit): return value is not None and limit is not None and value >= limit
+def _under(value, limit): return value is None or limit is None or value <= limit
+
+def load_is_high(load, cfg):
+    """Any signal saturated: whole CPU busy, one core pegged, or tasks stalling on CPU."""
+    return (_over(load["total"], cfg["high_load_pct"]) or _over(load["max_core"], cfg["high_core_pct"])
+            or _over(load["psi"], cfg["high_psi_pct"]))
+
+def load_is_low(load, cfg):
+    """All signals quiet."""
+    return (_under(load["total"], cfg["low_load_pct"]) and _under(load["max_core"], cfg["low_core_pct"])
+            and _under(load["psi"], cfg["low_psi_pct"]))
+
+class ThermalGovernor:
+    """Temperature + trend driven fan boost and stepwise scaling_max_freq cap.
 
-    interval = max(0.05, float(interval))
-    total_1, idle_1 = snap()
-    time.sleep(interval)
-    total_2, idle_2 = snap()
+    Escalation order: raise the fan mode (if allowed), then lower the cap one
+    step per thermal_step_s while the predicted temperature stays over
+    thermal_cap_c. Release is the reverse and only while not heating up."""
+    def __init__(self):
+        self.temp=None; self.slope=0.0; self.last=None
+        self.cap=None; self.fan_boost=False; self.last_step=-math.inf; self.steps=0
 
-    total_delta = total_2 - total_1
-    if total_delta <= 0:
-        return 0.0
-    idle_delta = idle_2 - idle_1
-    usage = 100.0 * (1.0 - (idle_delta / total_delta))
-    return max(0.0, min(100.0, usage))
+    def read_temp(self):
+        v=SYSFS.read_int(THERMAL_ZONE)
+        return None if v is None else v/1000.0
+
+    def update(self, cfg, profile_max, fan_wanted):
+        """Refresh temperature/slope and take at most one escalation or release step."""
+        if not cfg["thermal_enabled"]:
+            if self.cap is not None or self.fan_boost: log("THERMAL disabled, cap/fan boost cleared")
+            self.cap=None; self.fan_boost=False; return
+        t=self.read_temp(); mono=time.monotonic()
+        if t is None: return
+        if self.last is not None and mono>self.last[0]:
+            dt=mono-self.last[0]; raw=(t-self.last[1])/dt
+            self.slope+=(1.0-math.exp(-dt/THERMAL_SLOPE_S))*(raw-self.slope)
+        self.last=(mono,t); self.temp=t
+        pred=t+max(0.0,self.slope)*cfg["thermal_lookahead_s"]
+        if mono-self.last_step<cfg["thermal_step_s"]: return
+        floor=clamp_freq(cfg["thermal_floor_khz"] or cfg["idle_max_khz"])
+        cur=self.cap if self.cap is not None else clamp_freq(profile_max)
+        info=f"T={t:.1f}C slope={self.slope:+.2f}C/s pred={pred:.1f}C"
+        if pred>=cfg["thermal_fan_c"] and not self.fan_boost and fan_wanted!="normal" and cfg["thermal_fan_boost"]:
+            # cheaper than losing clock: give the fan one step interval first
+            self.fan_boost=True; self.last_step=mono
+            log(f"THERMAL fan {fan_wanted}->normal ({info})")
+        elif pred>=cfg["thermal_cap_c"] and cur>floor:
+            self.cap=max(floor,clamp_freq(cur-cfg["thermal_step_khz"])); self.last_step=mono; self.steps+=1
+            log(f"THERMAL cap {cur}->{self.cap} kHz ({info})")
+        elif t<=cfg["thermal_release_c"] and self.slope<=0.0:
+            if self.cap is not None:
+                # smallest available frequency at least one step above the cap
+                av=available_freqs(); want=self.cap+cfg["thermal_step_khz"]
+                i=bisect.bisect_left(av,want); new=av[i] if i<len(av) else want
+                self.last_step=mono
+                if new>=clamp_freq(profile_max):
+                    log(f"THERMAL cap released ({info})"); self.cap=None
+                else:
+                    log(f"THERMAL cap {self.cap}->{new} kHz ({info})"); self.cap=new
+            elif self.fan_boost and pred<cfg["thermal_fan_c"]-3:
+                self.fan_boost=False; self.last_step=mono
+                log(f"THERMAL fan boost released ({info})")
+
+    def active(self):
+        return self.cap is not None or self.fan_boost
+
+    def limits(self, min_khz, max_khz, fan):
+        if self.cap is not None: max_khz=min(max_khz,self.cap); min_khz=min(min_khz,max_khz)
+        if self.fan_boost: fan="normal"
+        return min_khz, max_khz, fan
+
+    def state(self):
+        return {"temp_c":None if self.temp is None else round(self.temp,1),"slope_c_s":round(self.slope,3),
+                "cap_khz":self.cap,"fan_boost":self.fan_boost,"cap_steps":self.steps}
+
+class BoostWatcher:
+    """Matches boost_rules against running processes and cgroup CPU usage.
+
+    A rule is {"name": ..., "comm": [...]} and/or {"cgroup": "system.slice/x.service",
+    "cpu_pct": N}; cpu_pct is top-style (100 = one core). cgroup usage comes from
+    cpu.stat usage_usec deltas (one pread per check). /proc is scanned only every
+    boost_scan_s; in between, the pids that matched last time are re-checked."""
+    def __init__(self):
+        self.scan_at=-math.inf; self.hits={}     # rule name -> [pid, ...] from the last scan
+        self.usage={}                            # cgroup -> (mono, usage_usec)
+        self.active=None
+
+    @staticmethod
+    def rule_name(r): return r.get("name") or r.get("cgroup") or ",".join(r.get("comm",()))
+
+    @staticmethod
+    def _comm(pid):
+        try: return (PROC/str(pid)/"comm").read_text().strip()
+        except OSError: return None
+
+    def _scan(self, rules):
+        want={}
+        for r in rules:
+            for c in r.get("comm",()): want.setdefault(c,[]).append(self.rule_name(r))
+        hits={}
+        if want:
+            for e in os.scandir(PROC):
+                if not e.name.isdigit(): continue
+                c=self._comm(e.name)
+                for name in want.get(c,()): hits.setdefault(name,[]).append(int(e.name))
+        self.hits=hits
+
+    def _cgroup_pct(self, cg):
+        attr=SYSFS.attr(CGROUP_ROOT/cg/"cpu.stat")
+        try: text=attr.read()
+        except OSError: self.usage.pop(cg,None); return None
+        usec=next((int(l.split()[1]) for l in text.splitlines() if l.startswith("usage_usec ")),None)
+        mono=time.monotonic(); prev=self.usage.get(cg); self.usage[cg]=(mono,usec)
+        if prev is None or usec is None or mono<=prev[0]: return None
+        return (usec-prev[1])/((mono-prev[0])*1e4)
+
+    def check(self, cfg):
+        """Name of the first matching rule (with a short reason) or None."""
+        rules=cfg["boost_rules"]
+        if not rules:
+            self.active=None; return None
+        mono=time.monotonic()
+        if mono-self.scan_at>=cfg["boost_scan_s"]: self._scan(rules); self.scan_at=mono
+        match=None
+        for r in rules:
+            name=self.rule_name(r); comms=r.get("comm",())
+            # cheap re-check of last scan's hits: the process may have exited since
+            pids=[p for p in self.hits.get(name,()) if self._comm(p) in comms]
+            self.hits[name]=pids
+            if pids and match is None: match=(name,f"{self._comm(pids[0]) or '?'} pid {pids[0]}")
+            cg=r.get("cgroup")
+            if cg:
+                pct=self._cgroup_pct(cg)  # always sampled so the delta baseline stays fresh
+                if match is None and pct is not None and pct>=r.get("cpu_pct",50): match=(name,f"{cg} {pct:.0f}% CPU")
+        name=match[0] if match else None
+        if name!=self.active:
+            if name: log(f"BOOST rule '{name}' matched ({match[1]})")
+            else: log(f"BOOST rule '{self.active}' ended")
+            self.active=name
+        return name
+
+CGROUP_KEYS = {"uclamp_min": "cpu.uclamp.min", "uclamp_max": "cpu.uclamp.max", "weight": "cpu.weight"}
+
+def unit_cgroup(unit):
+    """'home-assistant' -> system.slice/home-assistant.service; paths with '/' are taken as-is."""
+    if "/" in unit: return unit.strip("/")
+    if "." not in unit: unit+=".service"
+    return f"system.slice/{unit}"
+
+def cgroup_value(key, v):
+    """Value as the kernel prints it back, so ensure() compares like with like."""
+    if key=="weight": return str(int(v))
+    return "max" if float(v)>=100 else f"{float(v):.2f}"
+
+class CgroupLimits:
+    """Per-unit cpu.uclamp.min/max and cpu.weight from cfg["cgroup_limits"].
+
+    Re-checked every enforce_interval_s through held fds (one pread per
+    attribute); written only when the kernel value differs, e.g. after the unit
+    restarted or systemd reset it on daemon-reload."""
+    def __init__(self):
+        self.checked=-math.inf; self.missing=set()
+
+    def apply(self, cfg, force=False):
+        limits=cfg["cgroup_limits"]; mono=time.monotonic()
+        if not limits or (not force and mono-self.checked<cfg["enforce_interval_s"]): return
+        self.checked=mono
+        for unit,want in limits.items():
+            cg=unit_cgroup(unit)
+            for key,fname in CGROUP_KEYS.items():
+                if want.get(key) is None: continue
+                path=CGROUP_ROOT/cg/fname; val=cgroup_value(key,want[key])
+                try: old=SYSFS.ensure(path,val)
+                except OSError as e:
+                    # unit stopped, or cpu controller / uclamp not enabled for it; retry next round
+                    if (unit,key) not in self.missing: log(f"CGROUP {unit} {fname} unavailable: {e.strerror}")
+                    self.missing.add((unit,key)); SYSFS.close(str(path)); continue
+                if (unit,key) in self.missing: self.missing.discard((unit,key)); log(f"CGROUP {unit} {fname} available again")
+                if old!=val: log(f"CGROUP {unit} {fname} {old}->{val}")
+
+def cgroup_status(cfg):
+    out={}
+    for unit,want in cfg["cgroup_limits"].items():
+        cg=unit_cgroup(unit); cur={"cgroup":cg}
+        for key,fname in CGROUP_KEYS.items():
+            try: v=(CGROUP_ROOT/cg/fname).read_text().strip()
+            except OSError: v=None
+            cur[fname]=v
+            if want.get(key) is not None: cur[fname+".want"]=cgroup_value(key,want[key])
+        out[unit]=cur
+    return out
 
 def parse_hhmm(s: str): h,m=[int(x) for x in s.split(":")]; return h,m
 
@@ -247,6 +506,15 @@ def in_night(now, start_s, end_s):
     if end <= start: return now>=start or now<end
     return start<=now<end
 
+def seconds_to_boundary(now, start_s, end_s):
+    """Seconds until the next night start or night end."""
+    out=[]
+    for hh,mm in (parse_hhmm(start_s), parse_hhmm(end_s)):
+        t=now.replace(hour=hh,minute=mm,second=0,microsecond=0)
+        if t<=now: t+=datetime.timedelta(days=1)
+        out.append((t-now).total_seconds())
+    return min(out)
+
 DEFAULT_CFG = {
   "night_start": NIGHT_START, "night_end": NIGHT_END,
   "idle_min_khz": IDLE_MIN_KHZ, "idle_max_khz": IDLE_MAX_KHZ,
@@ -254,15 +522,34 @@ DEFAULT_CFG = {
   "idle_governor": IDLE_GOVERNOR, "perf_governor": PERF_GOVERNOR,
   "low_load_pct": LOW_LOAD_PCT, "low_load_duration_s": LOW_LOAD_DURATION_S,
   "high_load_pct": HIGH_LOAD_PCT, "high_load_duration_s": HIGH_LOAD_DURATION_S,
+  "high_core_pct": HIGH_CORE_PCT, "low_core_pct": LOW_CORE_PCT,
+  "high_psi_pct": HIGH_PSI_PCT, "low_psi_pct": LOW_PSI_PCT,
+  "ewma_fast_s": EWMA_FAST_S, "ewma_slow_s": EWMA_SLOW_S,
+  "min_idle_dwell_s": MIN_IDLE_DWELL_S, "min_perf_dwell_s": MIN_PERF_DWELL_S,
+  "thermal_enabled": True, "thermal_fan_boost": True,
+  "thermal_fan_c": THERMAL_FAN_C, "thermal_cap_c": THERMAL_CAP_C, "thermal_release_c": THERMAL_RELEASE_C,
+  "thermal_step_khz": THERMAL_STEP_KHZ, "thermal_step_s": THERMAL_STEP_S,
+  "thermal_lookahead_s": THERMAL_LOOKAHEAD_S, "thermal_floor_khz": None,
+  "boost_rules": [], "boost_scan_s": BOOST_SCAN_S, "cgroup_limits": {},
+  "learn_enabled": False, "predict_enabled": False,
+  "predict_lead_s": PREDICT_LEAD_S, "predict_busy_frac": PREDICT_BUSY_FRAC,
+  "predict_min_weeks": PREDICT_MIN_WEEKS, "learn_rate": LEARN_RATE,
   "check_interval_s": CHECK_INTERVAL_S, "fan_mode_path": FAN_MODE_PATH,
+  "enforce_interval_s": ENFORCE_INTERVAL_S,
 }
 
-def load_cfg():
+def load_cfg(current=None):
+    """Config file merged over the defaults. A file that does not parse keeps
+    ``current`` (the running daemon's config) and falls back to the defaults
+    only when there is none yet (startup, CLI)."""
     if CFG_FILE.exists():
-        try: 
+        try:
             cfg = {**DEFAULT_CFG, **json.loads(CFG_FILE.read_text())}
             return cfg
-        except: pass
+        except (OSError, ValueError, TypeError) as e:
+            keep = "keeping the current settings" if current is not None else "using defaults"
+            log(f"CONFIG {CFG_FILE} unreadable ({e}), {keep}")
+            if current is not None: return current
     return DEFAULT_CFG.copy()
 
 def save_cfg(cfg): CFG_FILE.write_text(json.dumps(cfg, indent=2,sort_keys=True))
@@ -273,103 +560,342 @@ def set_mode(m):
 def set_override(sec): 
     if sec<=0: OVR_FILE.unlink(missing_ok=True)
     else: OVR_FILE.write_text(str(int(time.time()+sec)))
-def override_active():
-    try: return time.time()<int(OVR_FILE.read_text().strip())
-    except: return False
+def override_until():
+    try: return int(OVR_FILE.read_text().strip())
+    except: return 0
+def override_active(): return time.time()<override_until()
 
-def daemon_loop():
-    cfg=load_cfg(); global FAN_MODE_PATH; FAN_MODE_PATH=cfg["fan_mode_path"]
-    log("START daemon")
+def slot_of(ts):
+    """Index 0..671 of the weekday x 15-minute slot containing local time ts."""
+    lt=time.localtime(ts)
+    return lt.tm_wday*(SLOTS_PER_WEEK//7)+(lt.tm_hour*3600+lt.tm_min*60)//SLOT_S
 
-    # init: set profile based on day/night
-    now0=datetime.datetime.now()
-    if in_night(now0,cfg["night_start"],cfg["night_end"]):
-        ensure_governor(cfg["idle_governor"])
-        enforce_min_max(cfg["idle_min_khz"],cfg["idle_max_khz"],"IDLE(init)")
-        set_fan_mode("silent"); in_idle=True
-    else:
-        ensure_governor(cfg["perf_governor"])
-        enforce_min_max(cfg["perf_min_khz"],cfg["perf_max_khz"],"PERF(init)")
-        set_fan_mode("normal"); in_idle=False
+def slot_name(slot):
+    day,rest=divmod(slot,SLOTS_PER_WEEK//7); minutes=rest*SLOT_S//60
+    return f"{('Mon','Tue','Wed','Thu','Fri','Sat','Sun')[day]} {minutes//60:02d}:{minutes%60:02d}"
 
-    low_acc=0; high_acc=0; last_is_night=None
+class LoadProfile:
+    """Per-weekday, per-15-minute load history with busy/quiet prediction.
 
-    while True:
-        mode=get_mode(); now=datetime.datetime.now()
+    Each slot keeps [mean busy %, fraction of time with high load, weeks seen].
+    A finished slot is folded in with weight max(1/weeks, learn_rate), and the
+    prediction made for it is scored against what actually happened."""
+    RECENT = SLOTS_PER_WEEK//7  # one day of per-slot records for the report
+
+    def __init__(self, path=None):
+        self.path=path or PROFILE_FILE
+        self.data={"slots":[[0.0,0.0,0] for _ in range(SLOTS_PER_WEEK)],
+                   "score":{"busy_hit":0,"busy_false":0,"busy_missed":0,"quiet_hit":0},"recent":[]}
+        try:
+            d=json.loads(self.path.read_text())
+            if len(d.get("slots",[]))==SLOTS_PER_WEEK: self.data.update(d)
+        except (OSError,ValueError): pass
+        self.cur=None  # [slot, slot_start_ts, busy_pct*s, high_s, covered_s]
+
+    def predict(self, slot, cfg):
+        mean,high_frac,weeks=self.data["slots"][slot%SLOTS_PER_WEEK]
+        if weeks<cfg["predict_min_weeks"]: return None
+        if high_frac>=cfg["predict_busy_frac"]: return "busy"
+        if cfg["low_load_pct"] is not None and mean<=cfg["low_load_pct"] and high_frac<cfg["predict_busy_frac"]/3: return "quiet"
+        return None
+
+    def observe(self, ts, busy_pct, high, dt, cfg):
+        slot=slot_of(ts)
+        if self.cur is not None and self.cur[0]!=slot: self.close(cfg)
+        if self.cur is None: self.cur=[slot,ts,0.0,0.0,0.0]
+        self.cur[2]+=busy_pct*dt; self.cur[4]+=dt
+        if high: self.cur[3]+=dt
+
+    def close(self, cfg):
+        slot,start,busy_s,high_s,covered=self.cur; self.cur=None
+        # skip slots we barely saw (daemon started or was stopped mid-slot)
+        if covered<SLOT_S/3: return
+        mean=busy_s/covered; high_frac=high_s/covered
+        predicted=self.predict(slot,cfg); actual="busy" if high_frac>=cfg["predict_busy_frac"] else "quiet"
+        sc=self.data["score"]
+        if predicted=="busy": sc["busy_hit" if actual=="busy" else "busy_false"]+=1
+        elif actual=="busy": sc["busy_missed"]+=1
+        elif predicted=="quiet": sc["quiet_hit"]+=1
+        entry=self.data["slots"][slot]
+        w=max(1.0/(entry[2]+1),cfg["learn_rate"])
+        entry[0]=round(entry[0]+w*(mean-entry[0]),2); entry[1]=round(entry[1]+w*(high_frac-entry[1]),3); entry[2]+=1
+        self.data["recent"]=(self.data["recent"]+[[int(start),slot,predicted,actual,round(mean,1),round(high_frac,3)]])[-self.RECENT:]
+        self.save()
+
+    def save(self):
+        try:
+            tmp=self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self.data,separators=(",",":"))); os.replace(tmp,self.path)
+        except OSError as e:
+            log(f"load profile write failed: {e}")
+
+def _rounded(d): return None if d is None else {k:(None if v is None else round(v,2)) for k,v in d.items()}
+
+def load_stats():
+    """Transition counters and time-in-state, kept across daemon restarts."""
+    st={"since":int(time.time()),"transitions":{},"transitions_by_tag":{},"time_in_state_s":{}}
+    try: st.update(json.loads(STATS_FILE.read_text()))
+    except (OSError,ValueError): pass
+    return st
+
+class Scheduler:
+    """Decision state of the daemon. step() applies the current policy once and
+    returns how long the caller may sleep before the next step is needed."""
+    def __init__(self):
+        self.cfg=None; self.mode=None; self.ovr_until=0
+        self.in_idle=False; self.low_acc=0.0; self.high_acc=0.0; self.last_is_night=None
+        self.load=LoadSampler(); self.est=LoadEstimator(); self.last_sample=None
+        self.profile=None; self.profile_since=time.monotonic()
+        self.learner=None; self.learn_load=LoadSampler(); self.learn_last=None
+        self.thermal=ThermalGovernor(); self.want=None; self.boost=BoostWatcher()
+        self.cgroups=CgroupLimits()
+        self.stats=load_stats(); self.stats_mono=time.monotonic(); self.stats_written=0.0
+        self.reload_cfg(); self.reload_mode(); self.reload_override()
+
+    def reload_cfg(self):
+        global FAN_MODE_PATH
+        cfg=load_cfg(self.cfg)
+        if self.cfg is not None and cfg!=self.cfg: log("CONFIG reloaded")
+        self.cfg=cfg; FAN_MODE_PATH=cfg["fan_mode_path"]
+        self.cgroups.checked=-math.inf  # apply edited cgroup_limits on the next step
+        if (cfg["learn_enabled"] or cfg["predict_enabled"]) and self.learner is None: self.learner=LoadProfile()
+        elif not (cfg["learn_enabled"] or cfg["predict_enabled"]): self.learner=None
+
+    def learn(self, load, dt):
+        if self.learner is not None and self.cfg["learn_enabled"] and load is not None and dt>0:
+            self.learner.observe(time.time(),load["total"],load_is_high(load,self.cfg),dt,self.cfg)
+
+    def learn_fixed(self):
+        """Fixed states do not sample load for decisions; sample once per wakeup for the learner."""
+        if self.learner is None or not self.cfg["learn_enabled"]: return
+        mono=time.monotonic(); load=self.learn_load.sample()
+        if self.learn_last is not None: self.learn(load,mono-self.learn_last)
+        self.learn_last=mono
+
+    def prediction(self):
+        """'busy' if now or the next lead time is predicted busy, 'quiet' if now is predicted quiet."""
+        cfg=self.cfg
+        if self.learner is None or not cfg["predict_enabled"] or self.mode!="auto": return None
+        t=time.time(); now_p=self.learner.predict(slot_of(t),cfg)
+        if now_p=="busy" or self.learner.predict(slot_of(t+cfg["predict_lead_s"]),cfg)=="busy": return "busy"
+        return now_p
+
+    def reload_mode(self):
+        mode=get_mode()
+        if self.mode is not None and mode!=self.mode: log(f"MODE={mode}")
+        self.mode=mode
+
+    def reload_override(self): self.ovr_until=override_until()
+
+    def files_changed(self, names):
+        if "config.json" in names: self.reload_cfg()
+        if "mode" in names: self.reload_mode()
+        if "override_until" in names: self.reload_override()
+
+    def apply(self, gov, min_khz, max_khz, tag, fan, idle):
+        self.want=(max_khz,fan)
+        min_khz,max_khz,fan=self.thermal.limits(min_khz,max_khz,fan)
+        if self.thermal.cap is not None: tag+="+THERMAL"
+        if gov: ensure_governor(gov)
+        enforce_min_max(min_khz, max_khz, tag)
+        set_fan_mode(fan); self.in_idle=idle
+        profile="idle" if idle else "perf"
+        if profile!=self.profile:
+            self.account()
+            if self.profile is not None:
+                tr=self.stats["transitions"]; key=f"{self.profile}->{profile}"
+                tr[key]=tr.get(key,0)+1
+                by_tag=self.stats["transitions_by_tag"]; by_tag[tag]=by_tag.get(tag,0)+1
+            self.profile=profile; self.profile_since=time.monotonic()
+            self.stats["profile_since"]=int(time.time())
+            self.write_stats(force=True)
+
+    def account(self):
+        """Add the time since the last call to the current profile's time-in-state."""
+        mono=time.monotonic()
+        if self.profile is not None:
+            tis=self.stats["time_in_state_s"]
+            tis[self.profile]=tis.get(self.profile,0.0)+mono-self.stats_mono
+        self.stats_mono=mono
+
+    def write_stats(self, force=False):
+        if not force and time.monotonic()-self.stats_written<STATS_WRITE_INTERVAL_S: return
+        self.account()
+        st=self.stats
+        st.update(updated=int(time.time()),profile=self.profile,mode=self.mode,
+                  time_in_state_s={k:round(v,1) for k,v in st["time_in_state_s"].items()},
+                  estimator={"fast":_rounded(self.est.fast),"slow":_rounded(self.est.slow),
+                             "high_acc_s":round(self.high_acc,1),"low_acc_s":round(self.low_acc,1)},
+                  thermal=self.thermal.state(),boost=self.boost.active)
+        try:
+            tmp=STATS_FILE.with_suffix(".tmp")
+            tmp.write_text(json.dumps(st,sort_keys=True)); os.replace(tmp,STATS_FILE)
+        except OSError as e:
+            log(f"stats write failed: {e}")
+        self.stats_written=time.monotonic()
+
+    def apply_idle(self, tag):
+        cfg=self.cfg; self.apply(cfg["idle_governor"],cfg["idle_min_khz"],cfg["idle_max_khz"],tag,"silent",True)
+
+    def apply_perf(self, tag):
+        cfg=self.cfg; self.apply(cfg["perf_governor"],cfg["perf_min_khz"],cfg["perf_max_khz"],tag,"normal",False)
+
+    def init_profile(self):
+        # init: set profile based on day/night
+        if in_night(datetime.datetime.now(),self.cfg["night_start"],self.cfg["night_end"]): self.apply_idle("IDLE(init)")
+        else: self.apply_perf("PERF(init)")
+
+    def fixed_wait(self, now):
+        """Next wakeup when no load sampling is needed: re-enforce, night boundary or override expiry."""
+        cfg=self.cfg
+        waits=[cfg["enforce_interval_s"], seconds_to_boundary(now,cfg["night_start"],cfg["night_end"])+0.5]
+        left=self.ovr_until-time.time()
+        if left>0: waits.append(left+0.5)
+        if self.thermal.active() or (self.thermal.temp is not None and self.thermal.temp>=cfg["thermal_fan_c"]-5):
+            waits.append(min(cfg["check_interval_s"],cfg["thermal_step_s"]))
+        if cfg["boost_rules"] and self.mode=="auto": waits.append(cfg["boost_scan_s"])
+        if self.learner is not None and cfg["predict_enabled"]:
+            # wake when the look-ahead window reaches the next slot
+            t=time.time(); lead=(SLOT_S-(t+cfg["predict_lead_s"])%SLOT_S)
+            waits.append(lead+0.5)
+        return max(0.05,min(waits))
+
+    def step(self):
+        cfg=self.cfg; mode=self.mode; now=datetime.datetime.now()
         is_night=in_night(now,cfg["night_start"],cfg["night_end"])
         publish_mode(mode)
+        # thermal step first; the branches below re-apply the profile through the new cap
+        if self.want is not None: self.thermal.update(cfg,*self.want)
 
         # Day/night switching
-        if last_is_night is True and is_night is False:
-            ensure_governor(cfg["perf_governor"])
-            enforce_min_max(cfg["perf_min_khz"],cfg["perf_max_khz"],"PERF(day-start)")
-            set_fan_mode("normal"); in_idle=False; low_acc=high_acc=0
-
-        if is_night and not override_active() and mode=="auto":
-            ensure_governor(cfg["idle_governor"])
-            enforce_min_max(cfg["idle_min_khz"],cfg["idle_max_khz"],"IDLE(night)")
-            set_fan_mode("silent"); in_idle=True; low_acc=high_acc=0; last_is_night=is_night
-            time.sleep(cfg["check_interval_s"]); continue
+        if self.last_is_night is True and is_night is False:
+            self.apply_perf("PERF(day-start)"); self.low_acc=self.high_acc=0.0
+        self.last_is_night=is_night
 
+        pred=self.prediction()
+        boost=self.boost.check(cfg) if mode=="auto" else None
+        self.cgroups.apply(cfg)
+        fixed=True
+        if is_night and time.time()>=self.ovr_until and mode=="auto":
+            # boost rule or learned busy slot at night (backups, SMART tests): run it in the performance profile
+            if boost: self.apply_perf(f"PERF(boost:{boost})")
+            elif pred=="busy": self.apply_perf("PERF(predicted)")
+            else: self.apply_idle("IDLE(night)")
+            self.low_acc=self.high_acc=0.0
         # Modes with explicit enforcement
-        if mode=="force-low":
-            ensure_governor(cfg["idle_governor"])
-            enforce_min_max(cfg["idle_min_khz"],cfg["idle_max_khz"],"IDLE(force)")
-            set_fan_mode("silent"); in_idle=True
-            time.sleep(cfg["check_interval_s"]); last_is_night=is_night; continue
-        if mode=="force-high":
-            gov = pick_force_high_governor(cfg)
-            if gov:
-                ensure_governor(gov)
+        elif mode=="force-low":
+            self.apply_idle("IDLE(force)")
+        elif mode=="force-high":
             # Use the widest safe range so max acts as a ceiling, not a fixed target.
-            enforce_min_max(cfg["idle_min_khz"],cfg["perf_max_khz"],"PERF(force-limit)")
-            set_fan_mode("normal"); in_idle=False
-            time.sleep(cfg["check_interval_s"]); last_is_night=is_night; continue
+            self.apply(pick_force_high_governor(cfg),cfg["idle_min_khz"],cfg["perf_max_khz"],"PERF(force-limit)","normal",False)
         # day-auto = automatic switching during the day, force performance profile at night
-        if mode=="day-auto" and is_night:
-            ensure_governor(cfg["perf_governor"])
-            enforce_min_max(cfg["perf_min_khz"],cfg["perf_max_khz"],"PERF(day-auto)")
-            set_fan_mode("normal"); in_idle=False
-            time.sleep(cfg["check_interval_s"]); last_is_night=is_night; continue
-
-        # Guard and re-enforce limits in auto mode
-        if in_idle:
-            ensure_governor(cfg["idle_governor"])
-            enforce_min_max(cfg["idle_min_khz"],cfg["idle_max_khz"],"IDLE(enforce)")
+        elif mode=="day-auto" and is_night:
+            self.apply_perf("PERF(day-auto)")
         else:
-            ensure_governor(cfg["perf_governor"])
-            enforce_min_max(cfg["perf_min_khz"],cfg["perf_max_khz"],"PERF(enforce)")
+            fixed=False
+        if fixed:
+            self.last_sample=None  # load sampling restarts from a fresh baseline
+            self.learn_fixed()
+            self.write_stats()
+            return self.fixed_wait(now)
+
+        # Guard and re-enforce limits in auto mode; a learned busy slot
+        # (or one starting within predict_lead_s) pre-switches to perf.
+        if self.in_idle and boost: self.apply_perf(f"PERF(boost:{boost})")
+        elif self.in_idle and pred=="busy": self.apply_perf("PERF(predicted)")
+        elif self.in_idle: self.apply_idle("IDLE(enforce)")
+        else: self.apply_perf("PERF(enforce)")
 
         # Load-based adaptation (daytime or when night auto mode is overridden)
-        usage=cpu_usage_pct(cfg["check_interval_s"])
-
-        if in_idle:
-            if usage>=cfg["high_load_pct"]:
-                high_acc+=cfg["check_interval_s"]
-                if high_acc>=cfg["high_load_duration_s"]:
-                    ensure_governor(cfg["perf_governor"])
-                    enforce_min_max(cfg["perf_min_khz"],cfg["perf_max_khz"],"PERF(switch)")
-                    set_fan_mode("normal"); in_idle=False; high_acc=low_acc=0
-            else: high_acc=0
+        mono=time.monotonic()
+        self.learn_last=None  # the learner gets this branch's samples directly
+        if self.last_sample is None:
+            self.load.reset(); self.est.reset(); self.load.sample(); self.last_sample=mono
+            return cfg["check_interval_s"]
+        load=self.load.sample(); dt=mono-self.last_sample; self.last_sample=mono
+        self.est.update(load,dt,cfg); self.learn(load,dt)
+        dwell=mono-self.profile_since
+
+        # Boost rules and learned busy slots hold perf; a predicted quiet slot
+        # demands twice the evidence before leaving idle.
+        if boost or pred=="busy":
+            self.low_acc=0.0; self.write_stats()
+            return cfg["check_interval_s"]
+        high_needed=cfg["high_load_duration_s"]*(2 if pred=="quiet" else 1)
+
+        # Leaky accumulators on the smoothed signals: a contrary sample drains
+        # them by dt instead of resetting, so bursty load still adds up.
+        # Up-switch reacts to the fast average, down-switch needs the slow one
+        # quiet and no fresh burst in the fast one (asymmetric hysteresis).
+        if self.in_idle:
+            if load_is_high(self.est.fast,cfg): self.high_acc+=dt
+            else: self.high_acc=max(0.0,self.high_acc-dt)
+            if self.high_acc>=high_needed and dwell>=cfg["min_idle_dwell_s"]:
+                self.apply_perf("PERF(switch)"); self.high_acc=self.low_acc=0.0
         else:
-            if usage<=cfg["low_load_pct"]:
-                low_acc+=cfg["check_interval_s"]
-                if low_acc>=cfg["low_load_duration_s"]:
-                    ensure_governor(cfg["idle_governor"])
-                    enforce_min_max(cfg["idle_min_khz"],cfg["idle_max_khz"],"IDLE(switch)")
-                    set_fan_mode("silent"); in_idle=True; low_acc=high_acc=0
-            else: low_acc=0
+            if load_is_low(self.est.slow,cfg) and not load_is_high(self.est.fast,cfg): self.low_acc+=dt
+            else: self.low_acc=max(0.0,self.low_acc-dt)
+            if self.low_acc>=cfg["low_load_duration_s"] and dwell>=cfg["min_perf_dwell_s"]:
+                self.apply_idle("IDLE(switch)"); self.low_acc=self.high_acc=0.0
+        self.write_stats()
+        return cfg["check_interval_s"]
 
-        last_is_night=is_night
+STATE_FILES = {"mode", "override_until", "config.json"}
+
+def daemon_loop():
+    sched=Scheduler()
+    log("START daemon")
+    sched.init_profile()
+    try:
+        ino=Inotify(); ino.add_watch(STATE_DIR)
+    except OSError as e:
+        ino=None; log(f"WARNING: inotify unavailable ({e}), polling state files")
+
+    while True:
+        t0=time.monotonic()
+        timeout=sched.step()
+        deadline=t0+timeout
+        # Sleep until the policy needs us or a state file changes, whichever comes first.
+        while True:
+            left=deadline-time.monotonic()
+            if left<=0: break
+            if ino is None:
+                time.sleep(left); sched.files_changed(STATE_FILES); break
+            ready,_,_=select.select([ino],[],[],left)
+            if not ready: break
+            names={name for _,_,name in ino.read()}&STATE_FILES
+            if names:
+                sched.files_changed(names); break
 
 # ---------- CLI ----------
+def cmd_predict_report(args):
+    cfg=load_cfg(); prof=LoadProfile()
+    sc=prof.data["score"]; learned=sum(1 for e in prof.data["slots"] if e[2]>=cfg["predict_min_weeks"])
+    if args.json:
+        print(json.dumps({"score":sc,"learned_slots":learned,"recent":prof.data["recent"]},indent=2)); return
+    predicted=sc["busy_hit"]+sc["busy_false"]; actual=sc["busy_hit"]+sc["busy_missed"]
+    print(f"learned slots: {learned}/{SLOTS_PER_WEEK} (>= {cfg['predict_min_weeks']} weeks), "
+          f"learning={'on' if cfg['learn_enabled'] else 'off'}, prediction={'on' if cfg['predict_enabled'] else 'off'}")
+    print(f"busy slots: predicted {predicted}, actual {actual}, hit {sc['busy_hit']}, "
+          f"false alarm {sc['busy_false']}, missed {sc['busy_missed']}; quiet hit {sc['quiet_hit']}")
+    if predicted: print(f"precision {sc['busy_hit']/predicted:.2f}", end="  ")
+    if actual: print(f"recall {sc['busy_hit']/actual:.2f}", end="")
+    print("\nslot        predicted  actual  mean%  high%")
+    for start,slot,pred,act,mean,high in prof.data["recent"]:
+        if args.all or pred=="busy" or act=="busy":
+            print(f"{time.strftime('%m-%d',time.localtime(start))} {slot_name(slot)[4:]}  {pred or '-':9}  {act:6}  {mean:5.1f}  {high*100:5.1f}")
+
 def cmd_status():
     cfg=load_cfg(); mode=get_mode(); ov=override_active()
     s=CPUS[0]/"cpufreq"
     st={"mode":mode,"override":ov,"cur":_read_int(s/"scaling_cur_freq"),
         "min":_read_int(s/"scaling_min_freq"),"max":_read_int(s/"scaling_max_freq"),
         "gov": (CPUS[0]/"cpufreq"/"scaling_governor").read_text().strip(),
-        "avail":available_freqs(),"avail_governors":available_governors(),"cfg":cfg}
+        "avail":available_freqs(),"avail_governors":available_governors(),
+        "psi_available":psi_cpu_some_us() is not None,"temp_c":ThermalGovernor().read_temp(),
+        "cgroups":cgroup_status(cfg),"cfg":cfg}
+    try: st["stats"]=json.loads(STATS_FILE.read_text())
+    except (OSError,ValueError): st["stats"]=None
     print(json.dumps(st,indent=2,sort_keys=True))
 
 def cmd_set(args):
@@ -389,14 +915,140 @@ def cmd_set(args):
     for k in ["idle_min_khz","idle_max_khz","perf_min_khz","perf_max_khz",
               "idle_governor","perf_governor",
               "low_load_pct","low_load_duration_s","high_load_pct","high_load_duration_s",
-              "check_interval_s"]:
+              "check_interval_s","enforce_interval_s",
+              "high_core_pct","low_core_pct","high_psi_pct","low_psi_pct",
+              "ewma_fast_s","ewma_slow_s","min_idle_dwell_s","min_perf_dwell_s",
+              "predict_lead_s","predict_busy_frac",
+              "thermal_fan_c","thermal_cap_c","thermal_release_c","thermal_step_khz","boost_scan_s"]:
         v=getattr(args,k,None); 
         if v is not None: cfg[k]=v
     if args.fan_path: cfg["fan_mode_path"]=args.fan_path
+    if args.thermal: cfg["thermal_enabled"]=args.thermal=="on"
+    if args.thermal_fan_boost: cfg["thermal_fan_boost"]=args.thermal_fan_boost=="on"
+    if args.learn: cfg["learn_enabled"]=args.learn=="on"
+    if args.predict: cfg["predict_enabled"]=args.predict=="on"
     CFG_FILE.write_text(json.dumps(cfg, indent=2,sort_keys=True)); print("OK")
 
+# ---------- benchmark ----------
+BENCH_DIR_NAME = "benchmark"
+BENCH_RAMP_TIMEOUT_S = 2.0
+BENCH_SETTLE_S = 1.0       # idle time before each measurement so the governor drops back
+BENCH_HASH_MB = 32         # fixed workload: sha256 over this many MiB
+BENCH_WAKEUPS = 200        # 1 ms sleeps for the wakeup latency figure
+
+def daemon_running():
+    me=os.getpid()
+    for e in os.scandir(PROC):
+        if not e.name.isdigit() or int(e.name)==me: continue
+        try: argv=(PROC/e.name/"cmdline").read_bytes().split(b"\0")
+        except OSError: continue
+        if any(a.endswith(b"cpu-scheduler.py") for a in argv) and b"start" in argv: return int(e.name)
+    return None
+
+def bench_cases(cfg, governors):
+    cases=[("idle",cfg["idle_governor"],cfg["idle_min_khz"],cfg["idle_max_khz"]),
+           ("perf",cfg["perf_governor"],cfg["perf_min_khz"],cfg["perf_max_khz"])]
+    for g in governors or [g for g in available_governors() if g!="userspace"]:
+        cases.append((f"gov:{g}",g,cfg["idle_min_khz"],cfg["perf_max_khz"]))
+    return cases
+
+def bench_ramp(cur_attr, target):
+    """Pin a busy loop to cpu0 and poll scaling_cur_freq until it reaches target.
+
+    The hog starts ahead of time, pins itself and blocks on a pipe; t0 is taken when
+    it is released, so interpreter startup is not part of the measured ramp."""
+    hog=subprocess.Popen([sys.executable,"-c","import os\nos.sched_setaffinity(0,{0})\nos.write(1,b'r')\n"
+                          "os.read(0,1)\nwhile True: pass"],stdin=subprocess.PIPE,stdout=subprocess.PIPE)
+    first=None; peak=0; reached=None
+    try:
+        if hog.stdout.read(1)!=b"r": raise RuntimeError("ramp hog failed to start")
+        start=cur_attr.read_int()
+        hog.stdin.write(b"g"); hog.stdin.flush(); t0=time.monotonic()
+        while time.monotonic()-t0<BENCH_RAMP_TIMEOUT_S:
+            f=cur_attr.read_int() or 0; now=time.monotonic()-t0; peak=max(peak,f)
+            if first is None and f!=start: first=now
+            if f>=target: reached=now; break
+            time.sleep(0.0005)
+    finally:
+        hog.kill(); hog.wait(); hog.stdin.close(); hog.stdout.close()
+    ms=lambda v: None if v is None else round(v*1000,2)
+    return {"start_khz":start,"peak_khz":peak,"first_change_ms":ms(first),"reach_max_ms":ms(reached)}
+
+def bench_throughput():
+    buf=b"\0"*(1<<20); h=hashlib.sha256(); t0=time.perf_counter()
+    for _ in range(BENCH_HASH_MB): h.update(buf)
+    dt=time.perf_counter()-t0
+    return {"sha256_ms":round(dt*1000,1),"sha256_mb_s":round(BENCH_HASH_MB/dt,1)}
+
+def bench_wakeup():
+    late=[]
+    for _ in range(BENCH_WAKEUPS):
+        t0=time.perf_counter(); time.sleep(0.001); late.append((time.perf_counter()-t0-0.001)*1e6)
+    late.sort()
+    return {"wakeup_mean_us":round(statistics.mean(late),1),"wakeup_p99_us":round(late[int(len(late)*0.99)-1],1),
+            "wakeup_max_us":round(late[-1],1)}
+
+def bench_meta():
+    meta={"ts":int(time.time()),"kernel":os.uname().release}
+    try: meta["model"]=pathlib.Path("/proc/device-tree/model").read_text().strip("\0\n")
+    except OSError: pass
+    try: meta["firmware"]=subprocess.run(["vcgencmd","version"],capture_output=True,text=True,timeout=5).stdout.strip()
+    except (OSError,subprocess.SubprocessError): pass
+    return meta
+
+def cmd_benchmark(args):
+    pid=daemon_running()
+    if pid and not args.force:
+        print(f"cpu-scheduler daemon is running (pid {pid}) and would re-enforce its limits; "
+              "stop it first (systemctl stop cpu-scheduler) or pass --force",file=sys.stderr); sys.exit(1)
+    cfg=load_cfg(); cpu0=CPUS[0]/"cpufreq"
+    cur_attr=SYSFS.attr(cpu0/"scaling_cur_freq")
+    saved=(SYSFS.read(cpu0/"scaling_governor"),SYSFS.read_int(cpu0/"scaling_min_freq"),SYSFS.read_int(cpu0/"scaling_max_freq"))
+    aff=os.sched_getaffinity(0)
+    # keep the poller and the workloads off cpu0, where the ramp hog runs
+    if len(aff)>1: os.sched_setaffinity(0,aff-{0})
+    results=[]
+    try:
+        for name,gov,mn,mx in bench_cases(cfg,args.governors.split(",") if args.governors else None):
+            if gov not in available_governors(): log(f"BENCH skip {name}: governor {gov} not available"); continue
+            set_governor(gov); enforce_min_max(mn,mx,f"BENCH({name})"); LAST_WRITTEN["gov"]=gov
+            target=clamp_freq(mx); r={"name":name,"governor":gov,"min_khz":clamp_freq(mn),"max_khz":target}
+            for i in range(args.repeat):
+                time.sleep(BENCH_SETTLE_S); ramp=bench_ramp(cur_attr,target)
+                time.sleep(BENCH_SETTLE_S); tp=bench_throughput(); wk=bench_wakeup()
+                for k,v in {**ramp,**tp,**wk}.items(): r.setdefault(k,[]).append(v)
+            # median over repeats; None when the target was never reached
+            for k,v in list(r.items()):
+                if isinstance(v,list):
+                    vals=[x for x in v if x is not None]
+                    r[k]=statistics.median(vals) if len(vals)==len(v) else None
+            results.append(r); log(f"BENCH {name}: ramp {r['reach_max_ms']} ms, sha256 {r['sha256_mb_s']} MB/s, wakeup p99 {r['wakeup_p99_us']} us")
+    finally:
+        os.sched_setaffinity(0,aff)
+        set_governor(saved[0]); LAST_WRITTEN["min"]=LAST_WRITTEN["max"]=None
+        enforce_min_max(saved[1],saved[2],"BENCH(restore)")
+    out={**bench_meta(),"repeat":args.repeat,"results":results}
+    path=pathlib.Path(args.out) if args.out else STATE_DIR/BENCH_DIR_NAME/time.strftime("%Y%m%d-%H%M%S.json")
+    prev=pathlib.Path(args.compare) if args.compare else None
+    path.parent.mkdir(parents=True,exist_ok=True); path.write_text(json.dumps(out,indent=2)); print(f"saved {path}")
+    old={}
+    if prev:
+        try: old={r["name"]:r for r in json.loads(prev.read_text())["results"]}
+        except (OSError,ValueError,KeyError) as e: print(f"cannot read {prev}: {e}",file=sys.stderr)
+    fmt=lambda v: "-" if v is None else f"{v:g}"
+    print(f"{'profile':22} {'gov':12} {'max kHz':>8} {'ramp ms':>8} {'MB/s':>7} {'wake p99 us':>11}")
+    for r in results:
+        line=f"{r['name']:22} {r['governor']:12} {r['max_khz']:>8} {fmt(r['reach_max_ms']):>8} {fmt(r['sha256_mb_s']):>7} {fmt(r['wakeup_p99_us']):>11}"
+        o=old.get(r["name"])
+        if o: line+=f"   was {fmt(o.get('reach_max_ms'))} / {fmt(o.get('sha256_mb_s'))} / {fmt(o.get('wakeup_p99_us'))}"
+        print(line)
+
 def cmd_mode(args):
-    set_mode(args.mode); set_override(args.override or 0); print("OK")
+    global _MQTT
+    # separate client id so the CLI does not kick the daemon's connection (and no LWT)
+    _MQTT = MqttLink("cpu_scheduler_cli")
+    set_mode(args.mode); set_override(args.override or 0)
+    _MQTT.close(flush_timeout=3.0); print("OK")
 
 def main():
     ap=argparse.ArgumentParser(); sub=ap.add_subparsers(dest="cmd",required=True)
@@ -408,15 +1060,35 @@ def main():
     pset.add_argument("--low-load-pct",type=float); pset.add_argument("--low-load-duration-s",type=int)
     pset.add_argument("--high-load-pct",type=float); pset.add_argument("--high-load-duration-s",type=int)
     pset.add_argument("--check-interval-s",type=float); pset.add_argument("--fan-path",type=str)
+    pset.add_argument("--enforce-interval-s",type=float)
+    pset.add_argument("--high-core-pct",type=float); pset.add_argument("--low-core-pct",type=float)
+    pset.add_argument("--high-psi-pct",type=float); pset.add_argument("--low-psi-pct",type=float)
+    pset.add_argument("--ewma-fast-s",type=float); pset.add_argument("--ewma-slow-s",type=float)
+    pset.add_argument("--min-idle-dwell-s",type=float); pset.add_argument("--min-perf-dwell-s",type=float)
+    pset.add_argument("--thermal",choices=["on","off"]); pset.add_argument("--thermal-fan-boost",choices=["on","off"])
+    pset.add_argument("--thermal-fan-c",type=float); pset.add_argument("--thermal-cap-c",type=float)
+    pset.add_argument("--thermal-release-c",type=float); pset.add_argument("--thermal-step-khz",type=int)
+    pset.add_argument("--boost-scan-s",type=float)
+    pset.add_argument("--learn",choices=["on","off"]); pset.add_argument("--predict",choices=["on","off"])
+    pset.add_argument("--predict-lead-s",type=float); pset.add_argument("--predict-busy-frac",type=float)
+    prep=sub.add_parser("predict-report"); prep.add_argument("--json",action="store_true")
+    prep.add_argument("--all",action="store_true",help="list every recent slot, not only busy ones")
+    pbench=sub.add_parser("benchmark",help="ramp latency, throughput and wakeup latency per profile/governor")
+    pbench.add_argument("--governors",help="comma-separated governors to test with the full range (default: all)")
+    pbench.add_argument("--repeat",type=int,default=3); pbench.add_argument("--out",help="result JSON path")
+    pbench.add_argument("--compare",help="earlier result JSON to print next to this run")
+    pbench.add_argument("--force",action="store_true",help="run even if the daemon is active")
     pmode=sub.add_parser("mode"); pmode.add_argument("mode",choices=["auto","day-auto","force-low","force-high"])
     pmode.add_argument("--override",type=int,default=0)
     args=ap.parse_args()
-    if args.cmd!="status" and os.geteuid()!=0:
-        print("Run as root (except for 'status')",file=sys.stderr); sys.exit(1)
+    if args.cmd not in ("status","predict-report") and os.geteuid()!=0:
+        print("Run as root (except for 'status' and 'predict-report')",file=sys.stderr); sys.exit(1)
     if not CPUS: print("cpufreq not found",file=sys.stderr); sys.exit(1)
     if args.cmd=="start": daemon_loop()
     elif args.cmd=="status": cmd_status()
     elif args.cmd=="set": cmd_set(args)
     elif args.cmd=="mode": cmd_mode(args)
+    elif args.cmd=="predict-report": cmd_predict_report(args)
+    elif args.cmd=="benchmark": cmd_benchmark(args)
 
 if __name__=="__main__": main()
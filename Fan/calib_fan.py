@@ -1,14 +1,43 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import argparse
+import datetime
+import json
+import multiprocessing
 import os
+import statistics
 import sys
+import time
+
+from fan_tach import open_tach
 
 # Settings for your PWM channel
 PWM_CHIP = 0   # controller 0
 PWM_CH   = 3   # channel 3
 FREQ_HZ  = 25000 # Hz for 2-pin DC fan; use 25000 for a 4-pin PC fan
 
+# Automatic calibration (--auto)
+AUTO_FREQ_HZ = 20000    # must match fan_ctrl_CPU.PWM_FREQ: start/hold duty depend on it
+OFF_DUTY = 0.01         # % for "off" (raw 0 % runs the fan at full speed on this hardware)
+THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+CURVE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fan_curve.json")
+STEP_S = 20.0           # s per duty step of the start/hold sweeps
+SWEEP_MIN = 5           # % first duty of the start sweep
+SWEEP_MAX = 60          # % give up if the fan has not started by here
+SLOPE_DROP = 1.5        # degC/min: slope change that counts as start/stop without a tach
+SETTLE_MIN_S = 120.0    # s at least per steady-state point
+SETTLE_MAX_S = 900.0    # s at most per steady-state point
+SETTLE_SLOPE = 0.1      # degC/min over the last SETTLE_WINDOW_S counts as settled
+SETTLE_WINDOW_S = 60.0
+STEADY_DUTIES = (100, 70, 50, 40, 30)   # plus the minimum duty
+MIN_MARGIN = 2.0        # % added to the hold duty -> min_duty
+KICK_MARGIN = 3.0       # % added to the start duty -> kick_duty
+T_CRIT = 80.0           # degC: abort (fan to 100 %) above this
+SOAK_C = 70.0           # degC: the fan-off heat soak before the sweep ends here at the latest
+# per profile: fan-on temperature and the temperature the calibration load may settle at
+PROFILE_SPEC = {"normal": (55.0, 65.0), "silent": (60.0, 72.0)}
+
 base = f"/sys/class/pwm/pwmchip{PWM_CHIP}"
 pwm  = f"{base}/pwm{PWM_CH}"
 
@@ -48,10 +77,232 @@ def cleanup():
     except FileNotFoundError:
         pass
 
-if __name__ == "__main__":
+def read_temp():
+    with open(THERMAL_ZONE) as f:
+        return int(f.read()) / 1000.0
+
+def burn():
+    x = 0
+    while True:
+        x = (x * 1103515245 + 12345) & 0x7fffffff
+
+def start_load(workers):
+    procs = [multiprocessing.Process(target=burn, daemon=True) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    return procs
+
+def stop_load(procs):
+    for p in procs:
+        p.terminate()
+    for p in procs:
+        p.join()
+
+def fan_daemon_running():
+    me = os.getpid()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit() or int(pid) == me:
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                argv = f.read().split(b"\0")
+        except OSError:
+            continue
+        if any(a.endswith(b"fan_ctrl_CPU.py") for a in argv):
+            return int(pid)
+    return None
+
+
+class Rig:
+    """PWM channel + optional tach + temperature, with the T_CRIT guard."""
+
+    def __init__(self, period_ns, tach):
+        self.period_ns = period_ns
+        self.tach = tach
+        self.duty = None
+
+    def set(self, pct):
+        set_duty_percent(self.period_ns, pct)
+        self.duty = pct
+        if hasattr(self.tach, "note_duty"):
+            self.tach.note_duty(pct)
+
+    def sample(self, seconds):
+        """[(t, degC, rpm)] once per second for ``seconds``."""
+        out = []
+        end = time.monotonic() + seconds
+        while True:
+            t = read_temp()
+            if t >= T_CRIT:
+                duty = self.duty
+                self.set(100)
+                raise RuntimeError(f"{t:.1f} C reached at {duty:g} % - aborted, fan at 100 %")
+            out.append((time.monotonic(), t, self.tach.rpm() if self.tach else None))
+            if out[-1][0] >= end:
+                return out
+            time.sleep(1.0)
+
+
+def slope_per_min(samples):
+    """Least-squares temperature slope in degC/min."""
+    if len(samples) < 2:
+        return 0.0
+    ts = [s[0] for s in samples]
+    vs = [s[1] for s in samples]
+    mt, mv = statistics.fmean(ts), statistics.fmean(vs)
+    den = sum((t - mt) ** 2 for t in ts)
+    return 0.0 if den == 0 else 60.0 * sum((t - mt) * (v - mv) for t, v in zip(ts, vs)) / den
+
+def spinning(rig, samples, ref_slope, stopped):
+    """Tach: RPM over the last third of the step. Without it: the slope moved
+    by SLOPE_DROP against the previous step (down = started, up = stopped)."""
+    if rig.tach is not None:
+        tail = samples[len(samples) * 2 // 3:]
+        return statistics.median(s[2] for s in tail) > 0.0
+    slope = slope_per_min(samples)
+    return slope <= ref_slope - SLOPE_DROP if stopped else slope < ref_slope + SLOPE_DROP
+
+def find_start_hold(rig, step_s):
+    """Heat-soak with the fan off (so the slope is not dominated by the warm-up),
+    sweep up to the start duty, then down to the hold duty."""
+    rig.set(OFF_DUTY)
+    samples = rig.sample(step_s)
+    while abs(slope_per_min(samples[-int(step_s) - 1:])) > SLOPE_DROP / 3 and samples[-1][1] < SOAK_C \
+            and samples[-1][0] - samples[0][0] < SETTLE_MAX_S:
+        samples += rig.sample(step_s)
+    print(f"  soak       {samples[-1][1]:5.1f} C  {slope_per_min(samples[-int(step_s) - 1:]):+5.2f} C/min")
+    ref = slope_per_min(samples[-int(step_s) - 1:])
+    start = None
+    for duty in range(SWEEP_MIN, SWEEP_MAX + 1):
+        rig.set(duty)
+        samples = rig.sample(step_s)
+        print(f"  up   {duty:3d} %  {samples[-1][1]:5.1f} C  {slope_per_min(samples):+5.2f} C/min" + (f"  {samples[-1][2]:5.0f} RPM" if rig.tach else ""))
+        if spinning(rig, samples, ref, stopped=True):
+            start = duty
+            break
+        ref = slope_per_min(samples)
+    if start is None:
+        raise RuntimeError(f"fan did not start up to {SWEEP_MAX} %")
+    hold = start
+    ref = slope_per_min(settle(rig))  # the start transient would mask a stop
+    for duty in range(start - 1, 0, -1):
+        rig.set(duty)
+        samples = rig.sample(step_s)
+        print(f"  down {duty:3d} %  {samples[-1][1]:5.1f} C  {slope_per_min(samples):+5.2f} C/min" + (f"  {samples[-1][2]:5.0f} RPM" if rig.tach else ""))
+        if not spinning(rig, samples, ref, stopped=False):
+            break
+        hold = duty
+        ref = slope_per_min(samples)
+    return start, hold
+
+def settle(rig):
+    """Sample until the temperature is flat (or SETTLE_MAX_S); the last window."""
+    samples = rig.sample(SETTLE_MIN_S)
+    while True:
+        window = [s for s in samples if s[0] >= samples[-1][0] - SETTLE_WINDOW_S]
+        if abs(slope_per_min(window)) <= SETTLE_SLOPE or samples[-1][0] - samples[0][0] >= SETTLE_MAX_S:
+            return window
+        samples += rig.sample(SETTLE_WINDOW_S / 2)
+
+def steady_state(rig, duty, kick):
+    """Hold ``duty`` until the temperature settles; (degC, RPM) over the last window."""
+    if rig.duty is None or rig.duty < kick:
+        rig.set(kick)
+        time.sleep(0.5)
+    rig.set(duty)
+    window = settle(rig)
+    rpm = statistics.fmean(s[2] for s in window) if rig.tach else None
+    return round(statistics.fmean(s[1] for s in window), 2), rpm
+
+def interp(t, points):
+    """Piecewise-linear (temp, duty) lookup, flat beyond the ends."""
+    if t <= points[0][0]:
+        return points[0][1]
+    for (ta, da), (tb, db) in zip(points, points[1:]):
+        if t <= tb:
+            return da + (db - da) * (t - ta) / (tb - ta)
+    return points[-1][1]
+
+def build_profiles(steady, min_duty):
+    """Curves from the steady-state map: each profile switches on at its fan-on
+    temperature with min_duty and reaches, at its limit, the duty that holds the
+    limit under the calibration load; 100 % five degrees above."""
+    by_temp = sorted((s["temp_c"], s["duty"]) for s in steady)   # hotter = lower duty
+    curves = {}
+    for mode, (on_c, limit) in PROFILE_SPEC.items():
+        on = round(min(on_c, limit - 3.0), 2)
+        duty = round(max(interp(limit, by_temp), min_duty), 1)
+        points = [(round(on - 0.01, 2), 0.0), (on, min_duty), (limit, duty)]
+        if duty < 100.0:
+            points.append((round(limit + 5.0, 2), 100.0))
+        curves[mode] = points
+    temps = sorted({t for points in curves.values() for t, _ in points})
+    return temps, {m: [round(interp(t, p), 1) for t in temps] for m, p in curves.items()}
+
+def calibrate(period_ns, args):
+    tach = open_tach(args.tach)
+    rig = Rig(period_ns, tach)
+    evidence = "tach" if tach else "temperature slope"
+    print(f"Calibration load: {args.workers} busy workers, evidence: {evidence}")
+    procs = start_load(args.workers)
+    try:
+        start, hold = find_start_hold(rig, args.step_s)
+        min_duty = min(100.0, hold + MIN_MARGIN)
+        kick = min(100.0, max(start + KICK_MARGIN, min_duty))
+        print(f"start duty {start} %, hold duty {hold} % -> min_duty {min_duty:g} %, kick_duty {kick:g} %")
+        steady = []
+        for duty in sorted({*STEADY_DUTIES, min_duty}, reverse=True):
+            temp, rpm = steady_state(rig, duty, kick)
+            steady.append({"duty": duty, "temp_c": temp, "rpm": None if rpm is None else round(rpm)})
+            print(f"  steady {duty:5.1f} %  {temp:5.1f} C" + (f"  {rpm:5.0f} RPM" if rpm is not None else ""))
+    finally:
+        stop_load(procs)
+        if tach is not None:
+            tach.close()
+    temps, curves = build_profiles(steady, min_duty)
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "pwm_freq_hz": args.freq,
+        "workers": args.workers,
+        "evidence": evidence,
+        "start_duty": start,
+        "hold_duty": hold,
+        "min_duty": min_duty,
+        "kick_duty": kick,
+        "steady": steady,
+        "tempSteps": temps,
+        "profiles": curves,
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Fan calibration: type duties by hand, or --auto to sweep and write a curve for fan_ctrl_CPU.py")
+    ap.add_argument("--auto", action="store_true", help="automatic sweep under a synthetic CPU load")
+    ap.add_argument("--out", default=CURVE_FILE, help=f"curve JSON (default {CURVE_FILE})")
+    ap.add_argument("--tach", default=os.environ.get("FAN_TACH_GPIO", ""), help="tach GPIO or 'sim' (default $FAN_TACH_GPIO); without one the temperature slope is used")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="busy-loop processes for the load")
+    ap.add_argument("--step-s", type=float, default=STEP_S, help="seconds per start/hold sweep step")
+    ap.add_argument("--freq", type=int, help=f"PWM frequency (default {FREQ_HZ}, --auto {AUTO_FREQ_HZ})")
+    ap.add_argument("--force", action="store_true", help="run even though fan_ctrl_CPU.py is running")
+    args = ap.parse_args()
+    if args.freq is None:
+        args.freq = AUTO_FREQ_HZ if args.auto else FREQ_HZ
+    if args.auto:
+        pid = fan_daemon_running()
+        if pid and not args.force:
+            print(f"fan_ctrl_CPU.py is running (pid {pid}); stop fanctrl.service first or use --force", file=sys.stderr)
+            sys.exit(1)
     try:
         ensure_exported()
-        period_ns = setup(FREQ_HZ)
+        period_ns = setup(args.freq)
+        if args.auto:
+            result = calibrate(period_ns, args)
+            with open(args.out, "w") as f:
+                json.dump(result, f, indent=2)
+                f.write("\n")
+            print(f"Curve written to {args.out}; restart fanctrl.service to use it")
+            for mode, speeds in result["profiles"].items():
+                print(f"  {mode}: " + ", ".join(f"{t:g}C={d:g}%" for t, d in zip(result["tempSteps"], speeds)))
+            return
         print("Enter fan speed in % (0-100), 'q' to quit.")
         while True:
             s = input("Fan Speed [%]: ").strip()
@@ -64,5 +315,9 @@ if __name__ == "__main__":
         pass
     except Exception as e:
         print("Error:", e, file=sys.stderr)
+        sys.exit(1)
     finally:
         cleanup()
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,41 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import glob
+import json
+import os
+import select
+import shutil
+import subprocess
 import time
 import sys
-import json
 import pathlib
 import fan_pwm  # must provide: init_pwm(freq_hz), set_fan_speed(duty_pct), stop_pwm(), gpio_low()
 
-try:
-    import paho.mqtt.client as mqtt
-except Exception:  # pragma: no cover - optional dependency for status publish
-    mqtt = None
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "common"))
+from mqtt_link import MqttLink
+from sysfs import SysfsAttr
+from inotify import Inotify
+from ctl_socket import ControlServer
+from fan_tach import open_tach
 
 # === Settings ===
-WAIT_TIME = 2.0
+WAIT_TIME = 2.0             # s, cadence near thresholds / while the PID is active
+WAIT_MIN = 1.0              # s, temperature rising towards a breakpoint
+WAIT_MAX = 30.0             # s, stable and far from any breakpoint
+SLOPE_TAU = 20.0            # s, EWMA of the temperature slope
+THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
 PWM_FREQ = 20000            # Hz for 3-pin DC; 25000 for 4-pin
-MODE_FILE = "/run/fan_mode" # "normal" / "silent"
-OVERRIDE_FILE = "/run/fan_override" # "auto" / "normal" / "silent" / "duty:NN"
+RUN_DIR = "/run/fan"        # watched with inotify; holds only the two files below
+MODE_FILE = f"{RUN_DIR}/mode" # "normal" / "silent"
+OVERRIDE_FILE = f"{RUN_DIR}/override" # "auto" / "normal" / "silent" / "duty:NN" / "rpm:NNNN"
+LEGACY_FILES = {"/run/fan_mode": MODE_FILE, "/run/fan_override": OVERRIDE_FILE}  # symlinks for older writers
+CTL_SOCKET = os.environ.get("FAN_CTRL_SOCKET", "/run/fan_ctrl.sock")  # JSON control API (fanctl.py), "" = off
 HYST = 1.0                  # degC
+CURVE_FILE = os.environ.get("FAN_CURVE_FILE", str(pathlib.Path(__file__).resolve().parent / "fan_curve.json"))  # from calib_fan.py --auto
+MQTT_STATE_TOPIC = "rpi/fan/state"
+MQTT_STATUS_TOPIC = "rpi/fan/status"
+MQTT_RPM_TOPIC = "rpi/fan/rpm"
 
 # Duty policy
 FAN_MIN_DUTY = 23.0         # % that reliably keeps fan spinning (tune to your fan)
@@ -25,38 +43,54 @@ FAN_OFF_DUTY = 0.01         # % used instead of a raw zero (hardware keeps fan a
 FAN_KICK_DUTY = 24.0       # % kick-start
 FAN_KICK_MS = 500           # ms
 
+# Tachometer (optional): BCM GPIO number of the tach wire, "sim" / "sim:STALL_S" for a simulated fan
+TACH = os.environ.get("FAN_TACH_GPIO", "").strip().lower()
+STALL_S = 3.0               # s at 0 RPM with the fan driven before it counts as stalled
+STALL_KICKS = (60.0, 100.0) # retries after a first FAN_KICK_DUTY kick, escalating
+RPM_GAIN = 0.01             # % duty per RPM of error per step in rpm:NNNN mode
+RPM_TOLERANCE = 50          # RPM - smaller errors are left alone
+RPM_PUBLISH_STEP = 50       # RPM - smaller changes are not published
+
 # Curves
 tempSteps =             [40,    44.99,  45,     47,     49.99,  50,     54.99,  55,     58,     59.99,  60,     64,     67,     70,     73]
 speedSteps_normal =     [0,     0,      0,      0,      0,      0,      0,      23,     25,     27,     27,     30,     40,     50,     100]
 speedSteps_silent =     [0,     0,      0,      0,      0,      0,      0,      0,      0,      0,      23.5,   24,     25,     28,     35]
 profiles = {"normal": speedSteps_normal, "silent": speedSteps_silent}
 
-# === State ===
-cpu_ref = None
-last_mode = None
-last_effective = None
-last_override = None
-last_mqtt = None
-pwm_enabled = False
-fanDutyOld = -1.0
+# Disk temperatures (ROCKPi Penta bays share this fan): separate curve, max of both duties wins
+DISK_SENSOR = os.environ.get("FAN_DISK_SENSOR", "auto").strip().lower()  # auto / drivetemp / smartctl / off
+DISK_INTERVAL = 60.0        # s between disk temperature polls
+DISK_STALE_S = 900.0        # a reading older than this is ignored (disk idle or in standby)
+disk_tempSteps =        [38,    42,     45,     48,     50,     55]
+disk_speeds_normal =    [0,     23,     27,     35,     50,     100]
+disk_speeds_silent =    [0,     0,      23.5,   28,     40,     100]
+disk_profiles = {"normal": disk_speeds_normal, "silent": disk_speeds_silent}
 
-def read_mode():
-    try:
-        with open(MODE_FILE, "r") as f:
-            m = f.read().strip().lower()
-            return m if m in profiles else "normal"
-    except FileNotFoundError:
-        return "normal"
+# Controller: "curve" = tables above, "pid" = closed loop on a per-profile temperature setpoint
+CONTROLLER = os.environ.get("FAN_CONTROLLER", "curve").strip().lower()
+PID_SETPOINT = {"normal": 55.0, "silent": 62.0}   # degC
+PID_KP = 4.0                # % per degC
+PID_KI = 0.05               # % per degC*s
+PID_KD = 20.0               # % per degC/s (on the filtered temperature, not the error)
+PID_D_TAU = 8.0             # s, low-pass on the temperature used for D
+PID_FF_GAIN = {"normal": 30.0, "silent": 15.0}  # % at full load on all cores at max clock
+PID_OFF_BELOW = 15.0        # output below this stops a running fan; it restarts at FAN_MIN_DUTY
+PID_DEADBAND = 2.0          # % - smaller changes are not written ...
+PID_MIN_WRITE_S = 10.0      # ... and writes are at least this far apart ...
+PID_URGENT_STEP = 10.0      # ... unless the change is at least this big
+PROC_STAT = "/proc/stat"
+CPUFREQ = "/sys/devices/system/cpu/cpu0/cpufreq"
 
-def read_override():
-    try:
-        value = pathlib.Path(OVERRIDE_FILE).read_text().strip().lower()
-    except FileNotFoundError:
-        return ("auto", None)
+def parse_override(value):
+    """Override text -> (kind, value); None if it is not valid."""
+    value = value.strip().lower()
     if not value or value == "auto":
         return ("auto", None)
     if value in profiles:
         return ("profile", value)
+    if value.startswith("rpm:"):
+        value = value.split(":", 1)[1].strip()
+        return ("rpm", int(value)) if value.isdigit() else None
     if value.startswith("duty:"):
         value = value.split(":", 1)[1].strip()
     if value.endswith("%"):
@@ -64,7 +98,11 @@ def read_override():
     if value.isdigit():
         duty = int(value)
         return ("duty", max(0, min(100, duty)))
-    return ("auto", None)
+    return None
+
+def override_text(ov):
+    kind, value = ov
+    return {"auto": "auto", "profile": value}.get(kind) or f"{kind}:{value}"
 
 def clamp(v, lo, hi):
     return hi if v > hi else lo if v < lo else v
@@ -81,154 +119,656 @@ def interp_speed(t, temps, speeds):
             return round((sb-sa)/(b-a)*(t-a)+sa, 1)
     return float(speeds[-1])
 
-def ensure_pwm_enabled():
-    global pwm_enabled
-    if not pwm_enabled:
-        fan_pwm.init_pwm(freq_hz=PWM_FREQ)
-        pwm_enabled = True
+def builtin_curve():
+    return {"temps": tempSteps, "profiles": profiles, "min_duty": FAN_MIN_DUTY, "kick_duty": FAN_KICK_DUTY}
 
-def disable_pwm():
-    global pwm_enabled
-    if pwm_enabled:
-        # stop PWM clock and force pin low (fan completely off)
+def load_curve(path):
+    """Calibrated tables from calib_fan.py --auto; None if there is no usable file."""
+    try:
+        data = json.loads(pathlib.Path(path).read_text())
+        return {
+            "temps": [float(t) for t in data["tempSteps"]],
+            "profiles": {m: [float(d) for d in data["profiles"][m]] for m in profiles},
+            "min_duty": float(data["min_duty"]),
+            "kick_duty": max(float(data["kick_duty"]), float(data["min_duty"])),
+        }
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Ignoring {path} ({e!r}), using the built-in curves", file=sys.stderr)
+        return None
+
+def check_curve(curve, controller):
+    """Problem with the tables / controller choice, or None."""
+    temps = curve["temps"]
+    if any(len(v) != len(temps) for v in curve["profiles"].values()):
+        return "The number of temperature and speed steps does not match!"
+    if controller not in ("curve", "pid") or (controller == "pid" and set(curve["profiles"]) - (set(PID_SETPOINT) & set(PID_FF_GAIN))):
+        return f"FAN_CONTROLLER must be 'curve' or 'pid' (with a setpoint and feed-forward gain per profile), got '{controller}'"
+    if any(len(v) != len(disk_tempSteps) for v in disk_profiles.values()) or set(disk_profiles) != set(curve["profiles"]):
+        return "Disk curves must match disk_tempSteps and cover every profile!"
+    if not all(temps[i] < temps[i+1] for i in range(len(temps)-1)):
+        return "tempSteps must be strictly increasing!"
+    return None
+
+class DiskTemps:
+    """Drive temperatures without waking sleeping disks.
+
+    drivetemp: temp1_input of the hwmon device, read only when the disk did I/O
+    since the previous check (/sys/block/X/stat; after a start the first read
+    waits for new I/O), so an idle or spun-down disk is never touched. smartctl: `smartctl -n standby` skips disks in standby
+    (exit bit 1). Either way a disk keeps its last reading until DISK_STALE_S."""
+
+    def __init__(self, source):
+        self.hwmon = {}
+        for d in glob.glob("/sys/class/hwmon/hwmon*"):
+            try:
+                if pathlib.Path(d, "name").read_text().strip() != "drivetemp":
+                    continue
+                blocks = os.listdir(os.path.join(d, "device", "block"))
+            except OSError:
+                continue
+            if blocks:
+                self.hwmon[blocks[0]] = SysfsAttr(os.path.join(d, "temp1_input"))
+        if source == "auto":
+            source = "drivetemp" if self.hwmon else "smartctl" if shutil.which("smartctl") else "off"
+        self.source = source
+        self.disks = sorted(self.hwmon) if source == "drivetemp" else sorted(os.path.basename(b) for b in glob.glob("/sys/block/sd[a-z]"))
+        self.stat = {d: SysfsAttr(f"/sys/block/{d}/stat") for d in self.disks}
+        self.io = {}
+        self.temps = {}         # disk -> (monotonic, degC)
+        self.next_at = 0.0
+        if source != "off":
+            print(f"Disk sensor: {source} ({', '.join(self.disks) or 'no disks'})")
+
+    def _io_changed(self, disk):
         try:
-            fan_pwm.stop_pwm()
-        finally:
-            # optional: if your fan_pwm exposes gpio_low(), set the pin to 0
-            if hasattr(fan_pwm, "gpio_low"):
-                fan_pwm.gpio_low()
-        pwm_enabled = False
+            f = self.stat[disk].read().split()
+            io = (f[0], f[4])   # reads / writes completed
+        except (OSError, IndexError):
+            return False
+        # first sight only records the counters: a disk is read after real I/O,
+        # never just because the daemon (re)started
+        prev = self.io.get(disk)
+        self.io[disk] = io
+        return prev is not None and prev != io
+
+    def _read(self, disk):
+        if self.source == "drivetemp":
+            if not self._io_changed(disk):
+                return None
+            v = self.hwmon[disk].read_int()
+            return None if v is None else v / 1000.0
+        try:
+            r = subprocess.run(["smartctl", "-n", "standby", "-A", "-j", f"/dev/{disk}"],
+                               capture_output=True, text=True, timeout=15)
+        except (OSError, subprocess.SubprocessError):
+            return None
+        if r.returncode & 2:    # in standby (or could not open): not heating, leave asleep
+            return None
+        try:
+            return float(json.loads(r.stdout)["temperature"]["current"])
+        except (ValueError, KeyError, TypeError):
+            return None
 
-def load_mqtt_config():
-    config_path = pathlib.Path("/home/vojrik/homeassistant/.storage/core.config_entries")
+    def poll(self):
+        now = time.monotonic()
+        if self.source == "off" or now < self.next_at:
+            return
+        self.next_at = now + DISK_INTERVAL
+        for disk in self.disks:
+            t = self._read(disk)
+            if t is not None:
+                self.temps[disk] = (now, t)
+
+    def due_in(self):
+        return WAIT_MAX if self.source == "off" else max(0.0, self.next_at - time.monotonic())
+
+    def max_temp(self):
+        now = time.monotonic()
+        fresh = [t for at, t in self.temps.values() if now - at <= DISK_STALE_S]
+        return max(fresh) if fresh else None
+
+    def duty(self, mode):
+        t = self.max_temp()
+        return 0.0 if t is None else clamp(interp_speed(t, disk_tempSteps, disk_profiles[mode]), 0.0, 100.0)
+
+
+class LoadFeed:
+    """CPU power proxy for feed-forward: busy fraction x (cur/max clock)^2, 0..1."""
+
+    def __init__(self):
+        self.prev = None
+        self.cur = SysfsAttr(f"{CPUFREQ}/scaling_cur_freq")
+        self.max = SysfsAttr(f"{CPUFREQ}/cpuinfo_max_freq", static=True)
+
+    def read(self):
+        with open(PROC_STAT, "r") as f:
+            parts = [int(x) for x in f.readline().split()[1:]]
+        sample = (sum(parts), parts[3] + (parts[4] if len(parts) > 4 else 0))
+        prev, self.prev = self.prev, sample
+        if prev is None or sample[0] <= prev[0]:
+            return 0.0
+        busy = 1.0 - (sample[1] - prev[1]) / (sample[0] - prev[0])
+        cur, top = self.cur.read_int(), self.max.read_int()
+        scale = (cur / top) ** 2 if cur and top else 1.0
+        return clamp(busy * scale, 0.0, 1.0)
+
+
+class FanPid:
+    """PID on (temperature - setpoint) plus load feed-forward, with conditional
+    integration (no wind-up while saturated) and rate-limited output."""
+
+    def __init__(self, feed=None, clock=time, min_duty=FAN_MIN_DUTY):
+        self.integral = 0.0
+        self.t_filt = None
+        self.last = None          # monotonic time of the previous update
+        self.out = 0.0            # duty currently applied by the controller
+        self.written_at = -1e9
+        self.writes = 0
+        self.feed = feed if feed is not None else LoadFeed()
+        self.clock = clock
+        self.min_duty = min_duty
+
+    def update(self, temp, mode):
+        now = self.clock.monotonic()
+        dt = clamp(now - self.last, 0.1, 60.0) if self.last is not None else WAIT_TIME
+        self.last = now
+        err = temp - PID_SETPOINT[mode]
+        if self.t_filt is None:
+            self.t_filt = temp
+        prev_filt = self.t_filt
+        self.t_filt += (dt / (PID_D_TAU + dt)) * (temp - self.t_filt)
+        deriv = (self.t_filt - prev_filt) / dt
+        ff = PID_FF_GAIN[mode] * self.feed.read()
+        raw = ff + PID_KP * err + PID_KI * self.integral + PID_KD * deriv
+        # integrate only when that does not push an already saturated output further
+        if not ((raw >= 100.0 and err > 0) or (raw <= 0.0 and err < 0)):
+            self.integral += err * dt
+            raw = ff + PID_KP * err + PID_KI * self.integral + PID_KD * deriv
+        want = clamp(raw, 0.0, 100.0)
+        # a running fan keeps the minimum duty down to PID_OFF_BELOW; a stopped one waits for it
+        if self.out > 0.0:
+            want = 0.0 if want < PID_OFF_BELOW else max(want, self.min_duty)
+        else:
+            want = 0.0 if want < self.min_duty else want
+        want = round(want)
+        step = abs(want - self.out)
+        on_off = (want == 0.0) != (self.out == 0.0)
+        if step == 0 or (not on_off and step < PID_URGENT_STEP
+                         and (step < PID_DEADBAND or now - self.written_at < PID_MIN_WRITE_S)):
+            return self.out
+        self.out = want
+        self.written_at = now
+        self.writes += 1
+        return self.out
+
+
+def zone_reader(path=THERMAL_ZONE):
+    """Temperature source for FanController: degC from a thermal zone (held fd)."""
+    attr = SysfsAttr(path)
+    return lambda: attr.read_int() / 1000.0
+
+
+def prepare_run_dir(run_dir=RUN_DIR, legacy=LEGACY_FILES):
+    """Create the watched directory and turn the old /run paths into symlinks to
+    its files (a file already written there is moved in first), so writers such
+    as cpu-scheduler's fan_mode_path keep working."""
+    os.makedirs(run_dir, exist_ok=True)
+    for old, new in legacy.items():
+        try:
+            if os.path.islink(old):
+                if os.readlink(old) == new:
+                    continue
+            elif os.path.exists(old):
+                os.replace(old, new)
+            tmp = f"{old}.tmp"
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+            os.symlink(new, tmp)
+            os.replace(tmp, old)
+        except OSError as e:
+            print(f"Cannot link {old} -> {new} ({e})", file=sys.stderr)
+
+
+def open_watch(paths):
     try:
-        data = json.loads(config_path.read_text())
-    except Exception:
+        ino = Inotify()
+        for d in {os.path.dirname(p) for p in paths}:
+            ino.add_watch(d)
+        return ino
+    except OSError as e:
+        print(f"inotify unavailable ({e}), re-reading mode/override every {WAIT_TIME} s")
         return None
-    for entry in data.get("data", {}).get("entries", []):
-        if entry.get("domain") == "mqtt":
-            cfg = entry.get("data", {})
-            return {
-                "host": cfg.get("broker", "127.0.0.1"),
-                "port": int(cfg.get("port", 1883)),
-                "username": cfg.get("username"),
-                "password": cfg.get("password"),
-            }
-    return None
 
-def publish_state(percent):
-    global last_mqtt
-    payload = str(int(round(percent)))
-    if payload == last_mqtt:
-        return
-    if mqtt is None:
-        return
-    cfg = load_mqtt_config()
-    if not cfg:
-        return
+
+def open_ctl(path=CTL_SOCKET):
+    if not path:
+        return None
     try:
-        client = mqtt.Client(client_id="fan_ctrl_cpu", clean_session=True)
-        if cfg.get("username"):
-            client.username_pw_set(cfg.get("username"), cfg.get("password"))
-        client.connect(cfg["host"], cfg["port"], 10)
-        client.publish("rpi/fan/state", payload, retain=True)
-        client.disconnect()
-        last_mqtt = payload
-    except Exception:
-        pass
-
-# sanity checks
-if len(speedSteps_normal) != len(tempSteps) or len(speedSteps_silent) != len(tempSteps):
-    print("The number of temperature and speed steps does not match!", file=sys.stderr)
-    sys.exit(1)
-if not all(tempSteps[i] < tempSteps[i+1] for i in range(len(tempSteps)-1)):
-    print("tempSteps must be strictly increasing!", file=sys.stderr)
-    sys.exit(1)
-
-try:
-    # Lazy enable: only when needed (>0%)
-    while True:
-        override = read_override()
-        override_changed = (override != last_override)
-        last_override = override
+        return ControlServer(path)
+    except OSError as e:
+        print(f"Control socket {path} unavailable ({e})", file=sys.stderr)
+        return None
+
+
+class FanController:
+    """The fan control loop with its I/O passed in.
+
+    pwm: init_pwm(freq_hz), set_fan_speed(pct), stop_pwm() [, gpio_low()] - the
+    fan_pwm module or a stand-in. read_temp: callable returning degC. clock:
+    monotonic() and sleep() (the time module by default). disks, tach, mqtt,
+    ctl, watch and feed are optional. step() runs one iteration and returns how
+    long to wait; run() loops on it, waiting in wait_for()."""
+
+    def __init__(self, pwm, read_temp, clock=time, curve=None, controller=CONTROLLER,
+                 disks=None, tach=None, mqtt=None, ctl=None, watch=None, feed=None,
+                 mode_path=MODE_FILE, override_path=OVERRIDE_FILE):
+        curve = curve or builtin_curve()
+        self.temps = curve["temps"]
+        self.profiles = curve["profiles"]
+        self.min_duty = curve["min_duty"]
+        self.kick_duty = curve["kick_duty"]
+        self.pwm = pwm
+        self.read_celsius = read_temp
+        self.clock = clock
+        self.controller = controller
+        self.disks = disks
+        self.tach = tach
+        self.mqtt = mqtt
+        self.ctl = ctl
+        self.watch = watch
+        self.feed = feed
+        self.mode_path = mode_path
+        self.override_path = override_path
+        self.watched = {os.path.basename(mode_path), os.path.basename(override_path)}
+
+        self.cpu_ref = None
+        self.last_mode = None
+        self.last_override = None
+        self.override = ("auto", None)
+        self.mode_file = "normal"
+        self.files_changed = True
+        self.acks = []              # control clients waiting for the state after their "set"
+        self.last_status = None     # last state pushed to subscribers
+        self.last_mqtt = None
+        self.pwm_enabled = False
+        self.duty_old = -1.0
+        self.pid = None
+        self.disk_ref = None
+        self.slope = 0.0
+        self.last_sample = None     # (monotonic, temp) of the previous reading
+        self.last_rpm = None        # last published RPM
+        self.stall_since = None
+        self.stall_tries = 0
+        self.rpm_duty = None        # duty of the rpm:NNNN controller
+
+    # --- inputs ---
+
+    def read_mode(self):
+        try:
+            with open(self.mode_path, "r") as f:
+                m = f.read().strip().lower()
+                return m if m in self.profiles else "normal"
+        except FileNotFoundError:
+            return "normal"
+
+    def read_override(self):
+        try:
+            value = pathlib.Path(self.override_path).read_text()
+        except FileNotFoundError:
+            return ("auto", None)
+        return parse_override(value) or ("auto", None)
+
+    def read_temp(self):
+        """Temperature in degC; also updates the EWMA slope used for the cadence."""
+        t = self.read_celsius()
+        now = self.clock.monotonic()
+        if self.last_sample is not None and now > self.last_sample[0]:
+            dt = now - self.last_sample[0]
+            self.slope += (dt / (SLOPE_TAU + dt)) * ((t - self.last_sample[1]) / dt - self.slope)
+        self.last_sample = (now, t)
+        return t
+
+    # --- output ---
+
+    def ensure_pwm_enabled(self):
+        if not self.pwm_enabled:
+            self.pwm.init_pwm(freq_hz=PWM_FREQ)
+            self.pwm_enabled = True
+
+    def disable_pwm(self):
+        if self.pwm_enabled:
+            # stop PWM clock and force pin low (fan completely off)
+            try:
+                self.pwm.stop_pwm()
+            finally:
+                # optional: if the backend exposes gpio_low(), set the pin to 0
+                if hasattr(self.pwm, "gpio_low"):
+                    self.pwm.gpio_low()
+            self.pwm_enabled = False
+
+    def publish_state(self, percent):
+        payload = str(int(round(percent)))
+        if payload == self.last_mqtt or self.mqtt is None:
+            return
+        # queued on the persistent connection; sent now or right after reconnect
+        if self.mqtt.publish(MQTT_STATE_TOPIC, payload, retain=True):
+            self.last_mqtt = payload
+
+    def fan_off(self):
+        # keep PWM active and set a tiny duty so the fan is actually off
+        self.ensure_pwm_enabled()
+        if FAN_OFF_DUTY != self.duty_old:
+            self.pwm.set_fan_speed(FAN_OFF_DUTY)
+            self.duty_old = FAN_OFF_DUTY
+        self.publish_state(0)
+
+    def fan_on(self, duty, kick):
+        self.ensure_pwm_enabled()
+        if kick:
+            self.pwm.set_fan_speed(self.kick_duty)
+            self.clock.sleep(FAN_KICK_MS / 1000.0)
+            self.duty_old = self.kick_duty
+        if duty != self.duty_old:
+            self.pwm.set_fan_speed(duty)
+            self.duty_old = duty
+        self.publish_state(duty)
+
+    def apply_duty(self, duty):
+        """Write a controller duty: 0 = off (FAN_OFF_DUTY), otherwise at least
+        the minimum duty, with a kick-start when the fan was stopped."""
+        if duty <= 0.0:
+            self.fan_off()
+        else:
+            self.fan_on(max(duty, self.min_duty), kick=self.duty_old < self.min_duty)
+
+    # --- tach ---
+
+    def publish_rpm(self, rpm):
+        rpm = int(round(rpm))
+        last = self.last_rpm
+        if last is not None and abs(rpm - last) < RPM_PUBLISH_STEP and (rpm == 0) == (last == 0):
+            return
+        if self.mqtt is not None and self.mqtt.publish(MQTT_RPM_TOPIC, str(rpm), retain=True):
+            self.last_rpm = rpm
+
+    def check_tach(self):
+        """Publish the RPM and restart a fan that is driven but reports 0 RPM for
+        STALL_S: kick at the kick duty, then at each of STALL_KICKS, then give up until it spins."""
+        if self.tach is None:
+            return None
+        rpm = self.tach.rpm()
+        self.publish_rpm(rpm)
+        kicks = (self.kick_duty,) + STALL_KICKS
+        if rpm > 0.0 or self.duty_old < self.min_duty:
+            if self.stall_tries and rpm > 0.0:
+                print(f"Fan spinning again: {rpm:.0f} RPM")
+            self.stall_since = None
+            self.stall_tries = 0
+            return rpm
+        now = self.clock.monotonic()
+        if self.stall_since is None:
+            self.stall_since = now
+        elif now - self.stall_since >= STALL_S and self.stall_tries < len(kicks):
+            kick = max(kicks[self.stall_tries], self.duty_old)
+            self.stall_tries += 1
+            print(f"Fan stalled at {self.duty_old:g}% (0 RPM for {now - self.stall_since:.0f} s), kick {self.stall_tries}/{len(kicks)} at {kick:g}%")
+            self.pwm.set_fan_speed(kick)
+            self.clock.sleep(FAN_KICK_MS / 1000.0)
+            self.pwm.set_fan_speed(self.duty_old)
+            self.stall_since = self.clock.monotonic()
+        elif now - self.stall_since >= STALL_S and self.stall_tries == len(kicks):
+            self.stall_tries += 1
+            print(f"Fan still stalled after {len(kicks)} kicks - check the fan and its tach wire", file=sys.stderr)
+        return rpm
+
+    def rpm_step(self, target, rpm, restart):
+        """Next duty for the rpm:NNNN override: integral steps on the RPM error."""
+        if target <= 0:
+            self.rpm_duty = None
+            return 0.0
+        if restart or self.rpm_duty is None:
+            self.rpm_duty = max(self.duty_old, self.min_duty)
+        elif abs(target - rpm) > RPM_TOLERANCE:
+            self.rpm_duty = clamp(self.rpm_duty + RPM_GAIN * (target - rpm), self.min_duty, 100.0)
+        return round(self.rpm_duty, 1)
+
+    # --- cadence ---
+
+    def breakpoints(self, speeds):
+        """Temperatures where the curve leaves or enters a flat stretch."""
+        pts = set()
+        for i in range(len(self.temps) - 1):
+            if speeds[i] != speeds[i + 1]:
+                pts.update((self.temps[i], self.temps[i + 1]))
+        return sorted(pts)
+
+    def next_wait(self, cpu, mode, running):
+        """Sleep until the temperature could plausibly cross the next point where the
+        output changes: WAIT_MIN when rising into it, up to WAIT_MAX when far and flat."""
+        if self.controller == "pid":
+            if running or cpu >= PID_SETPOINT[mode] - 5.0:
+                return WAIT_TIME
+            dist = PID_SETPOINT[mode] - 5.0 - cpu
+        else:
+            speeds = self.profiles[mode]
+            if interp_speed(cpu - HYST, self.temps, speeds) != interp_speed(cpu + HYST, self.temps, speeds):
+                return WAIT_TIME  # on a sloped segment: track it at the normal cadence
+            pts = self.breakpoints(speeds)
+            dist = max(0.0, min(abs(cpu - t) for t in pts) - HYST) if pts else 1e9
+        # expected time to cover the distance at the current slope (at least 0.02 degC/s)
+        eta = dist / max(abs(self.slope), 0.02)
+        return clamp(eta / 3.0, WAIT_MIN, WAIT_MAX)
+
+    # --- control API ---
+
+    def status(self):
+        kind, value = self.override
+        return {
+            "temp_c": round(self.last_sample[1], 1) if self.last_sample else None,
+            "duty": round(self.duty_old, 1) if self.duty_old > FAN_OFF_DUTY else 0.0,
+            "mode": value if kind == "profile" else self.mode_file,
+            "override": override_text(self.override),
+            "controller": self.controller,
+            "rpm": round(self.tach.rpm()) if self.tach is not None else None,
+            "disk_temp_c": self.disks.max_temp() if self.disks is not None else None,
+        }
+
+    def report(self):
+        """Acknowledge applied "set" commands and push state changes to subscribers."""
+        if self.ctl is None:
+            return
+        state = self.status()
+        for client in self.acks:
+            self.ctl.send(client, {"ok": True, **state})
+        self.acks.clear()
+        if state != self.last_status:
+            self.ctl.publish({"event": "state", **state})
+            self.last_status = state
+
+    def serve(self, ready):
+        """Handle control requests; True if a "set" changed the override."""
+        ctl = self.ctl
+        changed = False
+        for client, req in ctl.handle(ready):
+            cmd = req.get("cmd")
+            if cmd == "get":
+                ctl.send(client, {"ok": True, **self.status()})
+            elif cmd == "subscribe":
+                ctl.subscribe(client)
+                ctl.send(client, {"ok": True, **self.status()})
+            elif cmd == "set":
+                ov = parse_override(str(req["value"])) if "value" in req else None
+                if ov is None:
+                    ctl.send(client, {"ok": False, "error": f"invalid value {req.get('value')!r}"})
+                    continue
+                # the file stays the single source of truth (set_fan_override.sh, restarts)
+                try:
+                    if ov[0] == "auto":
+                        pathlib.Path(self.override_path).unlink(missing_ok=True)
+                    else:
+                        pathlib.Path(self.override_path).write_text(override_text(ov) + "\n")
+                except OSError as e:
+                    ctl.send(client, {"ok": False, "error": str(e)})
+                    continue
+                self.acks.append(client)
+                changed = True
+            else:
+                ctl.send(client, {"ok": False, "error": f"unknown cmd {cmd!r}"})
+        return changed
+
+    def wait_for(self, timeout):
+        """Sleep up to timeout while serving the control socket; return True if the
+        mode/override (may) have changed."""
+        self.report()
+        watch, ctl = self.watch, self.ctl
+        poll_files = watch is None
+        if poll_files:
+            timeout = min(timeout, WAIT_TIME)
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return poll_files
+            fds = ([watch] if watch is not None else []) + (ctl.fds() if ctl is not None else [])
+            if not fds:
+                time.sleep(left)
+                return poll_files
+            ready, _, _ = select.select(fds, [], [], left)
+            if not ready:
+                return poll_files
+            if watch is not None and watch in ready and {name for _, _, name in watch.read()} & self.watched:
+                return True
+            if ctl is not None and self.serve(ready):
+                return True
+
+    # --- loop ---
+
+    def step(self):
+        """One control iteration; returns the seconds until the next one."""
+        if self.files_changed:
+            self.override = self.read_override()
+            self.mode_file = self.read_mode()
+            self.files_changed = False
+        override = self.override
+        override_changed = (override != self.last_override)
+        self.last_override = override
+        if override[0] == "rpm" and self.tach is None and override_changed:
+            print("rpm:NNNN override needs a tach (FAN_TACH_GPIO), using auto", file=sys.stderr)
 
         if override[0] == "duty":
             duty = float(override[1])
-            if override_changed or duty != fanDutyOld:
+            if override_changed or duty != self.duty_old:
                 if duty <= 0.0:
-                    ensure_pwm_enabled()
-                    if FAN_OFF_DUTY != fanDutyOld:
-                        fan_pwm.set_fan_speed(FAN_OFF_DUTY)
-                        fanDutyOld = FAN_OFF_DUTY
-                    publish_state(0)
+                    self.fan_off()
                 else:
-                    was_off = not pwm_enabled
-                    ensure_pwm_enabled()
-                    if was_off:
-                        fan_pwm.set_fan_speed(FAN_KICK_DUTY)
-                        time.sleep(FAN_KICK_MS / 1000.0)
-                    if duty != fanDutyOld:
-                        fan_pwm.set_fan_speed(duty)
-                        fanDutyOld = duty
-                    publish_state(duty)
-            cpu_ref = None
-            last_mode = None
-            time.sleep(WAIT_TIME)
-            continue
-
-        if override[0] == "profile":
-            mode = override[1]
-        else:
-            mode = read_mode()
+                    self.fan_on(duty, kick=not self.pwm_enabled)
+            self.cpu_ref = None
+            self.last_mode = None
+            self.pid = None
+            self.rpm_duty = None
+            self.check_tach()
+            # fixed duty: nothing to sample, wait for the next override/mode change
+            # (or the next stall check while a tach watches the running fan)
+            return WAIT_TIME if self.tach is not None and self.duty_old >= self.min_duty else 3600.0
+
+        if override[0] == "rpm" and self.tach is not None:
+            self.apply_duty(self.rpm_step(override[1], self.check_tach(), override_changed))
+            self.cpu_ref = None
+            self.last_mode = None
+            self.pid = None
+            return WAIT_TIME
+        self.rpm_duty = None
 
-        speeds = profiles[mode]
-        mode_changed = (mode != last_mode)
+        mode = override[1] if override[0] == "profile" else self.mode_file
+        speeds = self.profiles[mode]
+        mode_changed = (mode != self.last_mode)
         if mode_changed:
             print(f"Mode: {mode}")
-            last_mode = mode
-            cpu_ref = None  # force recompute
-            last_effective = None
-
-        with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
-            cpu = float(f.read().strip()) / 1000.0
+            self.last_mode = mode
+            self.cpu_ref = None  # force recompute
 
-        if cpu_ref is None or abs(cpu - cpu_ref) > HYST or mode_changed:
-            target = clamp(interp_speed(cpu, tempSteps, speeds), 0.0, 100.0)
+        cpu = self.read_temp()
+        disk_duty = 0.0
+        if self.disks is not None:
+            self.disks.poll()
+            disk_duty = self.disks.duty(mode)
 
+        if self.controller == "pid":
+            if self.pid is None:
+                self.pid = FanPid(self.feed, self.clock, self.min_duty)
+                print(f"Controller: PID, setpoints {PID_SETPOINT}")
+            self.apply_duty(max(self.pid.update(cpu, mode), disk_duty))
+        elif self.cpu_ref is None or abs(cpu - self.cpu_ref) > HYST or mode_changed or disk_duty != self.disk_ref:
+            target = max(clamp(interp_speed(cpu, self.temps, speeds), 0.0, 100.0), disk_duty)
+            self.disk_ref = disk_duty
             if target <= 0.0:
-                # keep PWM active and set a tiny duty so the fan is actually off
-                ensure_pwm_enabled()
-                if FAN_OFF_DUTY != fanDutyOld:
-                    fan_pwm.set_fan_speed(FAN_OFF_DUTY)
-                    fanDutyOld = FAN_OFF_DUTY
-                publish_state(0)
+                self.fan_off()
             else:
-                # enable PWM if needed, do kick-start if we were OFF
-                was_off = not pwm_enabled
-                ensure_pwm_enabled()
+                # kick-start if PWM was off
+                self.fan_on(max(target, self.min_duty), kick=not self.pwm_enabled)
+            self.cpu_ref = cpu
 
-                duty = max(target, FAN_MIN_DUTY)
-                if was_off:
-                    fan_pwm.set_fan_speed(FAN_KICK_DUTY)
-                    time.sleep(FAN_KICK_MS/1000.0)
+        self.check_tach()
+        wait = self.next_wait(cpu, mode, self.duty_old > FAN_OFF_DUTY)
+        if self.disks is not None:
+            wait = min(wait, self.disks.due_in() + 0.01)
+        if self.tach is not None and self.duty_old >= self.min_duty:
+            wait = min(wait, WAIT_TIME)  # keep stall detection within a few seconds
+        return wait
 
-                if duty != fanDutyOld:
-                    fan_pwm.set_fan_speed(duty)
-                    fanDutyOld = duty
-                publish_state(duty)
+    def run(self):
+        # Lazy enable: only when needed (>0%)
+        while True:
+            self.files_changed = self.wait_for(self.step())
 
-            cpu_ref = cpu
+    def close(self):
+        try:
+            self.disable_pwm()
+        finally:
+            if self.tach is not None:
+                self.tach.close()
+            if self.ctl is not None:
+                self.ctl.close()
+            if self.mqtt is not None:
+                self.mqtt.close()
 
-        time.sleep(WAIT_TIME)
 
-except KeyboardInterrupt:
-    print("Fan ctrl interrupted by keyboard")
-    try:
-        disable_pwm()
-    finally:
-        sys.exit(0)
-except Exception:
+def main():
+    prepare_run_dir()
+    curve = load_curve(CURVE_FILE)
+    if curve is not None:
+        print(f"Curve: {CURVE_FILE} (min {curve['min_duty']:g}%, kick {curve['kick_duty']:g}%)")
+    curve = curve or builtin_curve()
+    problem = check_curve(curve, CONTROLLER)
+    if problem:
+        print(problem, file=sys.stderr)
+        sys.exit(1)
+
+    tach = open_tach(TACH)
+    if tach is not None:
+        print(f"Tach: {TACH}")
+        if hasattr(tach, "note_duty"):
+            fan_pwm.on_change = tach.note_duty  # simulated fan follows every duty write
+    ctrl = FanController(
+        fan_pwm, zone_reader(THERMAL_ZONE), curve=curve, controller=CONTROLLER,
+        disks=DiskTemps(DISK_SENSOR), tach=tach,
+        mqtt=MqttLink("fan_ctrl_cpu", status_topic=MQTT_STATUS_TOPIC),
+        ctl=open_ctl(CTL_SOCKET), watch=open_watch([MODE_FILE, OVERRIDE_FILE]),
+    )
     try:
-        disable_pwm()
-    finally:
+        ctrl.run()
+    except KeyboardInterrupt:
+        print("Fan ctrl interrupted by keyboard")
+        try:
+            ctrl.close()
+        finally:
+            sys.exit(0)
+    except Exception:
+        ctrl.close()
         raise
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "common"))
+from sysfs import SysfsAttr
 
 PWM_CHIP = 0   # controller 0
 PWM_CH   = 3   # channel 3
@@ -8,6 +12,22 @@ FREQ_HZ  = 20000  # Hz
 base = f"/sys/class/pwm/pwmchip{PWM_CHIP}"
 pwm  = f"{base}/pwm{PWM_CH}"
 _period_ns = None  # cache the period for subsequent calculations
+_duty = None       # duty_cycle handle kept open between speed changes
+_truncate = False  # plain-file fake chip: truncate after pwrite (see SysfsAttr)
+on_change = None   # optional callback(percent) after each speed write (e.g. simulated tach)
+
+def use_chip(chip_dir, channel=PWM_CH, truncate=False):
+    """Drive another pwmchip directory, e.g. a fake chip for off-device runs
+    (pass truncate=True when its attributes are plain files)."""
+    global base, pwm, PWM_CH, _period_ns, _duty, _truncate
+    if _duty is not None:
+        _duty.close()
+    base = str(chip_dir)
+    PWM_CH = channel
+    pwm = f"{base}/pwm{PWM_CH}"
+    _period_ns = None
+    _duty = None
+    _truncate = truncate
 
 def _write(path, value):
     with open(path, "w") as f:
@@ -15,8 +35,10 @@ def _write(path, value):
 
 def init_pwm(freq_hz=FREQ_HZ):
     """Export the channel and configure the PWM frequency."""
-    global _period_ns
+    global _period_ns, _duty
     # Reset the channel
+    if _duty is not None:
+        _duty.close()
     if os.path.exists(pwm):
         _write(f"{base}/unexport", PWM_CH)
     _write(f"{base}/export", PWM_CH)
@@ -27,21 +49,28 @@ def init_pwm(freq_hz=FREQ_HZ):
     period_ns = (period_ns // quantum) * quantum
 
     _write(f"{pwm}/period", period_ns)
-    _write(f"{pwm}/duty_cycle", 0)
+    _duty = SysfsAttr(f"{pwm}/duty_cycle", truncate=_truncate)
+    _duty.write(0)
     _write(f"{pwm}/enable", 1)
     _period_ns = period_ns
 
 def set_fan_speed(percent):
     """Set the duty cycle in percent (0-100)."""
-    if _period_ns is None:
+    if _period_ns is None or _duty is None:
         raise RuntimeError("PWM not initialised - call init_pwm() first")
     pct = max(0.0, min(100.0, float(percent)))
     pct = 100.0 - pct  # invert duty cycle
     duty_ns = int(_period_ns * (pct / 100.0))
-    _write(f"{pwm}/duty_cycle", duty_ns)
+    _duty.write(duty_ns)  # pwrite on the held fd, skipped when unchanged
+    if on_change is not None:
+        on_change(100.0 - pct)
 
 def stop_pwm():
     """Disable the PWM channel."""
+    global _duty
+    if _duty is not None:
+        _duty.close()
+        _duty = None
     try:
         _write(f"{pwm}/enable", 0)
     except FileNotFoundError:
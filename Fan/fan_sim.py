@@ -0,0 +1,306 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Off-device replay of fan_ctrl_CPU.py.
+
+`record` samples the CPU temperature, the load proxy used by the PID
+feed-forward and the duty on the real PWM channel into a JSONL trace.
+`replay` runs FanController.step() for each controller/profile on a simulated
+clock, driving fan_pwm against a fake sysfs PWM chip. It reports duty writes
+per hour, temperature overshoot after load steps and reaction latency.
+
+Thermal model (estimate only): the replayed temperature is the recorded one
+plus the difference in fan cooling between the recorded and the simulated
+duty, low-passed with THERMAL_TAU. The cooling of duty d is
+COOL_C * (1 - exp(-d / COOL_D)), and 0 while the fan is off.
+"""
+import argparse
+import bisect
+import contextlib
+import io
+import json
+import math
+import os
+import pathlib
+import statistics
+import sys
+import tempfile
+import time
+
+import fan_pwm
+import fan_ctrl_CPU as fc
+
+THERMAL_TAU = 60.0      # s, how fast a duty change shows up in the temperature
+COOL_C = 20.0           # degC of cooling at full duty (relative to fan off)
+COOL_D = 30.0           # % duty scale of the cooling curve
+STEP_C = 3.0            # degC rise in the recorded trace ...
+STEP_WINDOW_S = 30.0    # ... within this long counts as a load step
+EVENT_S = 300.0         # s after a step used for overshoot / latency
+SETTLE_S = 60.0         # s at the end of that window = settled temperature
+
+
+class FakePwmChip:
+    """pwmchipN directory with an already exported channel, as plain files."""
+
+    def __init__(self, root, channel=fan_pwm.PWM_CH):
+        self.dir = pathlib.Path(root) / "pwmchip0"
+        self.pwm = self.dir / f"pwm{channel}"
+        self.pwm.mkdir(parents=True)
+        for name, value in (("export", ""), ("unexport", ""), ("npwm", "4")):
+            (self.dir / name).write_text(value)
+        for name in ("period", "duty_cycle", "enable"):
+            (self.pwm / name).write_text("0")
+        self.channel = channel
+
+    def percent(self):
+        return chip_percent(self.pwm)
+
+
+def chip_percent(pwm_dir):
+    """Fan duty in % from a PWM channel directory (the output is inverted), None if unreadable."""
+    try:
+        if (pathlib.Path(pwm_dir) / "enable").read_text().strip() != "1":
+            return None
+        period = int((pathlib.Path(pwm_dir) / "period").read_text())
+        duty = int((pathlib.Path(pwm_dir) / "duty_cycle").read_text())
+    except (OSError, ValueError):
+        return None
+    return round(100.0 - 100.0 * duty / period, 2) if period else None
+
+
+class SimClock:
+    """Stands in for the time module inside FanController."""
+
+    def __init__(self, t):
+        self.t = t
+
+    def monotonic(self):
+        return self.t
+
+    def time(self):
+        return self.t
+
+    def sleep(self, s):
+        self.t += s
+
+
+class Trace:
+    def __init__(self, path):
+        rows = [json.loads(line) for line in open(path) if line.strip()]
+        rows = [r for r in rows if r.get("temp_c") is not None]
+        if len(rows) < 2:
+            raise SystemExit(f"{path}: need at least two samples")
+        self.t = [r["t"] for r in rows]
+        self.temp = [r["temp_c"] for r in rows]
+        self.load = [r.get("load") or 0.0 for r in rows]
+        self.duty = [r.get("duty") or 0.0 for r in rows]
+
+    def at(self, series, t):
+        i = bisect.bisect_right(self.t, t)
+        if i <= 0:
+            return series[0]
+        if i >= len(self.t):
+            return series[-1]
+        t0, t1 = self.t[i - 1], self.t[i]
+        return series[i - 1] + (series[i] - series[i - 1]) * (t - t0) / (t1 - t0)
+
+    def steps(self):
+        """Start times of load steps: the recorded temperature rising STEP_C within STEP_WINDOW_S."""
+        out = []
+        j = 0
+        for i, t in enumerate(self.t):
+            while self.t[j] < t - STEP_WINDOW_S:
+                j += 1
+            low = min(range(j, i + 1), key=lambda k: self.temp[k])
+            if self.temp[i] - self.temp[low] >= STEP_C and (not out or self.t[low] - out[-1] > EVENT_S):
+                out.append(self.t[low])
+        return out
+
+
+def cooling(duty):
+    return 0.0 if duty is None or duty <= fc.FAN_OFF_DUTY else COOL_C * (1.0 - math.exp(-duty / COOL_D))
+
+
+class ThermalModel:
+    """Recorded temperature corrected for the simulated fan (see module docstring)."""
+
+    def __init__(self, trace, pwm, clock):
+        self.trace = trace
+        self.pwm = pwm
+        self.clock = clock
+        self.delta = 0.0
+        self.at = clock.t
+
+    def read(self):
+        now = self.clock.t
+        while self.at < now:
+            dt = min(1.0, now - self.at)
+            self.at += dt
+            simulated = self.pwm.writes[-1][1] if self.pwm.writes else None
+            target = cooling(self.trace.at(self.trace.duty, self.at)) - cooling(simulated)
+            self.delta += (target - self.delta) * (1.0 - math.exp(-dt / THERMAL_TAU))
+        return self.trace.at(self.trace.temp, now) + self.delta
+
+
+class TraceFeed:
+    def __init__(self, trace, clock):
+        self.trace = trace
+        self.clock = clock
+
+    def read(self):
+        return fc.clamp(self.trace.at(self.trace.load, self.clock.t), 0.0, 1.0)
+
+
+class ChipWatch:
+    """fan_pwm wrapper that logs every change the fake chip actually sees."""
+
+    def __init__(self, chip, clock):
+        self.chip = chip
+        self.clock = clock
+        self.writes = []        # (t, percent)
+        self.on_change = None
+
+    def init_pwm(self, freq_hz):
+        fan_pwm.init_pwm(freq_hz=freq_hz)
+
+    def set_fan_speed(self, percent):
+        fan_pwm.set_fan_speed(percent)
+        pct = self.chip.percent()
+        if not self.writes or self.writes[-1][1] != pct:
+            self.writes.append((self.clock.t, pct))
+
+    def stop_pwm(self):
+        fan_pwm.stop_pwm()
+
+    def duty_at(self, t):
+        i = bisect.bisect_right([w[0] for w in self.writes], t)
+        return self.writes[i - 1][1] if i else None
+
+
+def replay_one(trace, controller, profile, curve, verbose):
+    with tempfile.TemporaryDirectory(prefix="fan-sim-") as tmp:
+        chip = FakePwmChip(tmp)
+        fan_pwm.use_chip(chip.dir, chip.channel, truncate=True)
+        clock = SimClock(trace.t[0])
+        pwm = ChipWatch(chip, clock)
+        model = ThermalModel(trace, pwm, clock)
+        mode_path = os.path.join(tmp, "fan_mode")
+        pathlib.Path(mode_path).write_text(profile + "\n")
+        ctrl = fc.FanController(pwm, model.read, clock=clock, curve=curve, controller=controller,
+                                feed=TraceFeed(trace, clock), mode_path=mode_path,
+                                override_path=os.path.join(tmp, "fan_override"))
+        temps = []              # (t, simulated degC)
+        cpu_s = 0.0
+        iterations = 0
+        out = sys.stdout if verbose else io.StringIO()
+        with contextlib.redirect_stdout(out):
+            while clock.t < trace.t[-1]:
+                t0 = time.process_time()
+                wait = ctrl.step()
+                cpu_s += time.process_time() - t0
+                iterations += 1
+                temps.append((clock.t, model.read()))
+                end = min(clock.t + wait, trace.t[-1])
+                while clock.t < end:     # keep the temperature series dense for the metrics
+                    clock.sleep(min(1.0, end - clock.t))
+                    temps.append((clock.t, model.read()))
+            ctrl.close()
+
+    hours = (trace.t[-1] - trace.t[0]) / 3600.0
+    ts = [t for t, _ in temps]
+    overshoot, latency = [], []
+    for t0 in trace.steps():
+        lo, hi = bisect.bisect_left(ts, t0), bisect.bisect_right(ts, t0 + EVENT_S)
+        window = temps[lo:hi]
+        if len(window) < 2:
+            continue
+        settled = statistics.fmean(v for t, v in window if t >= window[-1][0] - SETTLE_S)
+        overshoot.append(max(0.0, max(v for _, v in window) - settled))
+        before = pwm.duty_at(t0) or 0.0
+        react = next((t for t, d in pwm.writes if t0 <= t <= t0 + EVENT_S and (d or 0.0) > before), None)
+        latency.append(None if react is None else react - t0)
+    reacted = [x for x in latency if x is not None]
+    return {
+        "controller": controller,
+        "profile": profile,
+        "hours": round(hours, 2),
+        "duty_writes": len(pwm.writes),
+        "writes_per_hour": round(len(pwm.writes) / hours, 1) if hours else None,
+        "max_c": round(max(v for _, v in temps), 1),
+        "steps": len(overshoot),
+        "overshoot_mean_c": round(statistics.fmean(overshoot), 2) if overshoot else None,
+        "overshoot_max_c": round(max(overshoot), 2) if overshoot else None,
+        "latency_median_s": round(statistics.median(reacted), 1) if reacted else None,
+        "latency_max_s": round(max(reacted), 1) if reacted else None,
+        "no_reaction": len(latency) - len(reacted),
+        "iterations": iterations,
+        "cpu_ms_per_iteration": round(1000.0 * cpu_s / iterations, 3) if iterations else None,
+    }
+
+
+def cmd_record(args):
+    zone = fc.SysfsAttr(fc.THERMAL_ZONE)
+    feed = fc.LoadFeed()
+    feed.read()
+    end = time.time() + args.duration if args.duration else None
+    with open(args.out, "a") as out:
+        while end is None or time.time() < end:
+            raw = zone.read_int()
+            row = {"t": round(time.time(), 3), "temp_c": None if raw is None else raw / 1000.0, "load": round(feed.read(), 4),
+                   "duty": chip_percent(fan_pwm.pwm)}
+            out.write(json.dumps(row) + "\n")
+            out.flush()
+            time.sleep(args.interval)
+
+
+def cmd_replay(args):
+    trace = Trace(args.trace)
+    curve = fc.load_curve(args.curve) if args.curve else None
+    curve = curve or fc.builtin_curve()
+    results = []
+    for controller in args.controllers.split(","):
+        problem = fc.check_curve(curve, controller)
+        if problem:
+            raise SystemExit(problem)
+        for profile in args.profiles.split(","):
+            if profile not in curve["profiles"]:
+                raise SystemExit(f"unknown profile {profile!r}")
+            results.append(replay_one(trace, controller, profile, curve, args.verbose))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'controller':10} {'profile':8} {'writes/h':>8} {'max C':>6} {'steps':>5} {'overshoot C':>12} {'latency s':>10}")
+    for r in results:
+        over = "-" if r["overshoot_mean_c"] is None else f"{r['overshoot_mean_c']:.1f}/{r['overshoot_max_c']:.1f}"
+        lat = "-" if r["latency_median_s"] is None else f"{r['latency_median_s']:.0f}/{r['latency_max_s']:.0f}"
+        if r["no_reaction"]:
+            lat += f" ({r['no_reaction']} none)"
+        print(f"{r['controller']:10} {r['profile']:8} {r['writes_per_hour']:8.1f} {r['max_c']:6.1f} {r['steps']:5d} {over:>12} {lat:>10}")
+    print("overshoot: mean/max above the settled temperature; latency: median/max from step start to the first duty increase")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Record a temperature trace or replay it through the fan controller")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    rec = sub.add_parser("record", help="append samples to a JSONL trace")
+    rec.add_argument("out")
+    rec.add_argument("--interval", type=float, default=2.0)
+    rec.add_argument("--duration", type=float, help="seconds (default: until interrupted)")
+    rep = sub.add_parser("replay", help="run the controller over a trace against a fake PWM chip")
+    rep.add_argument("trace")
+    rep.add_argument("--controllers", default="curve,pid", help="comma-separated: curve,pid")
+    rep.add_argument("--profiles", default=",".join(fc.profiles), help="comma-separated profiles")
+    rep.add_argument("--curve", help="fan_curve.json to test instead of the built-in tables")
+    rep.add_argument("--json", action="store_true")
+    rep.add_argument("-v", "--verbose", action="store_true", help="show the controller's own output")
+    args = ap.parse_args()
+    try:
+        if args.cmd == "record":
+            cmd_record(args)
+        else:
+            cmd_replay(args)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
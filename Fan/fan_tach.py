@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Fan tachometer input: lgpio edge callbacks or a simulated fan for testing.
+
+Both sources expose rpm(); RPM is counted over a sliding window of edges so a
+single missed or bounced edge does not swing the reading.
+"""
+import collections
+import math
+import threading
+import time
+
+try:
+    import lgpio
+except ImportError:
+    lgpio = None
+
+PULSES_PER_REV = 2      # standard PC fans: two open-collector pulses per revolution
+WINDOW_S = 3.0          # sliding window for the RPM estimate
+DEBOUNCE_US = 100       # tach edges closer than this are glitches (10k RPM = 3 ms/pulse)
+
+
+class LgpioTach:
+    def __init__(self, gpio, chip=0, pulses_per_rev=PULSES_PER_REV, window_s=WINDOW_S):
+        if lgpio is None:
+            raise RuntimeError("Missing python3-rpi-lgpio. Install with: sudo apt install python3-rpi-lgpio")
+        self.gpio = gpio
+        self.pulses_per_rev = pulses_per_rev
+        self.window_ns = int(window_s * 1e9)
+        self._edges = collections.deque()   # (monotonic_ns when seen, lgpio tick ns)
+        self._lock = threading.Lock()
+        self.handle = lgpio.gpiochip_open(chip)
+        lgpio.gpio_claim_alert(self.handle, gpio, lgpio.FALLING_EDGE, lgpio.SET_PULL_UP)
+        lgpio.gpio_set_debounce_micros(self.handle, gpio, DEBOUNCE_US)
+        self._cb = lgpio.callback(self.handle, gpio, lgpio.FALLING_EDGE, self._edge)
+
+    def _edge(self, _chip, _gpio, _level, tick):
+        with self._lock:
+            self._edges.append((time.monotonic_ns(), tick))
+
+    def rpm(self):
+        cutoff = time.monotonic_ns() - self.window_ns
+        with self._lock:
+            while self._edges and self._edges[0][0] < cutoff:
+                self._edges.popleft()
+            if len(self._edges) < 2:
+                return 0.0
+            span = self._edges[-1][1] - self._edges[0][1]   # kernel timestamps: exact spacing
+            pulses = len(self._edges) - 1
+        if span <= 0:
+            return 0.0
+        return pulses / self.pulses_per_rev * 60e9 / span
+
+    def close(self):
+        if self._cb is not None:
+            self._cb.cancel()
+            self._cb = None
+        if self.handle is not None:
+            lgpio.gpio_free(self.handle, self.gpio)
+            lgpio.gpiochip_close(self.handle)
+            self.handle = None
+
+
+class SimTach:
+    """Fan model for testing without hardware; feed it every duty write via note_duty().
+
+    A stopped rotor needs start_duty to break away and stops below hold_duty;
+    speed follows max_rpm * duty with a first-order lag. stall_at_s makes the
+    rotor seize after that many seconds until a kick of at least 60 %.
+    """
+
+    def __init__(self, max_rpm=3000.0, start_duty=24.0, hold_duty=18.0, tau_s=1.5, stall_at_s=None):
+        self.max_rpm = max_rpm
+        self.start_duty = start_duty
+        self.hold_duty = hold_duty
+        self.tau_s = tau_s
+        self._duty = 0.0
+        self._rpm = 0.0
+        self._spinning = False
+        self._last = time.monotonic()
+        self._stall_at = None if stall_at_s is None else self._last + stall_at_s
+        self._seized = False
+
+    def _advance(self):
+        now = time.monotonic()
+        dt, self._last = now - self._last, now
+        if self._stall_at is not None and now >= self._stall_at:
+            self._seized, self._stall_at = True, None
+        if self._seized:
+            self._spinning = False
+        elif not self._spinning:
+            self._spinning = self._duty >= self.start_duty
+        elif self._duty < self.hold_duty:
+            self._spinning = False
+        target = self.max_rpm * self._duty / 100.0 if self._spinning else 0.0
+        self._rpm += (target - self._rpm) * (1.0 - math.exp(-dt / self.tau_s))
+
+    def note_duty(self, percent):
+        self._advance()
+        self._duty = float(percent)
+        if self._seized and self._duty >= 60.0:
+            self._seized = False
+        self._advance()
+
+    def rpm(self):
+        self._advance()
+        return 0.0 if self._rpm < 50.0 else self._rpm
+
+    def close(self):
+        pass
+
+
+def open_tach(spec):
+    """"sim", "sim:STALL_S" or a BCM GPIO number; None/"" disables the tach."""
+    if not spec:
+        return None
+    if spec.startswith("sim"):
+        stall = float(spec.split(":", 1)[1]) if ":" in spec else None
+        return SimTach(stall_at_s=stall)
+    return LgpioTach(int(spec))
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Client for the fan_ctrl_CPU.py control socket.
+
+    fanctl.py get                 current temperature, duty, mode, override
+    fanctl.py set VALUE           auto | normal | silent | duty:NN | NN | rpm:NNNN
+    fanctl.py watch               print every state change
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+CTL_SOCKET = os.environ.get("FAN_CTRL_SOCKET", "/run/fan_ctrl.sock")
+
+
+def request(sock, obj):
+    sock.sendall(json.dumps(obj).encode() + b"\n")
+
+def lines(sock):
+    buf = b""
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            return
+        buf += data
+        *done, buf = buf.split(b"\n")
+        for line in done:
+            yield json.loads(line)
+
+def main():
+    ap = argparse.ArgumentParser(description="Query or control the fan daemon over its control socket")
+    ap.add_argument("cmd", choices=["get", "set", "watch"])
+    ap.add_argument("value", nargs="?")
+    ap.add_argument("--socket", default=CTL_SOCKET)
+    ap.add_argument("--json", action="store_true", help="print raw JSON replies")
+    args = ap.parse_args()
+    if args.cmd == "set" and args.value is None:
+        ap.error("set needs a value")
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.socket)
+    except OSError as e:
+        print(f"Cannot connect to {args.socket}: {e}", file=sys.stderr)
+        sys.exit(1)
+    t0 = time.monotonic()
+    if args.cmd == "set":
+        request(sock, {"cmd": "set", "value": args.value})
+    else:
+        request(sock, {"cmd": "subscribe" if args.cmd == "watch" else "get"})
+    try:
+        for msg in lines(sock):
+            if args.json:
+                print(json.dumps(msg), flush=True)
+            elif not msg.get("ok", True):
+                print(f"Error: {msg.get('error')}", file=sys.stderr)
+                sys.exit(1)
+            else:
+                rpm = f" {msg['rpm']} RPM" if msg.get("rpm") is not None else ""
+                disk = f" disk {msg['disk_temp_c']} C" if msg.get("disk_temp_c") is not None else ""
+                print(f"{msg['temp_c']} C{disk}  duty {msg['duty']:g}%{rpm}  mode {msg['mode']}  override {msg['override']}", flush=True)
+            if args.cmd != "watch":
+                if args.cmd == "set" and not args.json:
+                    print(f"applied in {(time.monotonic() - t0) * 1000:.1f} ms")
+                return
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,12 +2,13 @@
 set -eu
 
 if [ $# -lt 1 ]; then
-  echo "Usage: $0 {auto|normal|silent|0..100|0..100%|duty:NN}" >&2
+  echo "Usage: $0 {auto|normal|silent|0..100|0..100%|duty:NN|rpm:NNNN}" >&2
   exit 2
 fi
 
 value=$(printf '%s' "$1" | tr '[:upper:]' '[:lower:]')
-override_file="/run/fan_override"
+override_file="/run/fan/override"
+mkdir -p "$(dirname "$override_file")"
 
 case "$value" in
   auto)
@@ -18,6 +19,17 @@ case "$value" in
     printf '%s\n' "$value" > "$override_file"
     exit 0
     ;;
+  rpm:*)
+    rpm=${value#rpm:}
+    case "$rpm" in
+      ''|*[!0-9]*)
+        echo "Invalid fan override value: $1" >&2
+        exit 2
+        ;;
+    esac
+    printf 'rpm:%s\n' "$rpm" > "$override_file"
+    exit 0
+    ;;
 esac
 
 value=${value#duty:}
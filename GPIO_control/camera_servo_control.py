@@ -10,6 +10,9 @@ import signal
 import sys
 import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "common"))
+from sysfs import SysfsCache
+
 try:
     import lgpio
 except ImportError:
@@ -63,11 +66,16 @@ class SysfsPwmController:
         self.freq_hz = freq_hz
         self.period_ns = int(round(1_000_000_000 / float(freq_hz)))
         self.active = []
+        # period/duty_cycle/enable fds stay open; repeated equal writes are skipped
+        self.sysfs = SysfsCache()
 
     def _write(self, path, value):
         with open(path, "w") as handle:
             handle.write(str(value))
 
+    def _set(self, path, value):
+        self.sysfs.write(path, value)
+
     def _export_channel(self, chip_path, channel):
         pwm_path = os.path.join(chip_path, f"pwm{channel}")
         if not os.path.exists(pwm_path):
@@ -82,35 +90,36 @@ class SysfsPwmController:
         chip_path, channel = self.channels[channel_index]
         pwm_path = self._export_channel(chip_path, channel)
         try:
-            self._write(os.path.join(pwm_path, "enable"), 0)
+            self.sysfs.write(os.path.join(pwm_path, "enable"), 0, force=True)
         except FileNotFoundError:
             pass
-        self._write(os.path.join(pwm_path, "period"), self.period_ns)
-        self._write(os.path.join(pwm_path, "duty_cycle"), int(pulse_us) * 1000)
-        self._write(os.path.join(pwm_path, "enable"), 1)
+        self._set(os.path.join(pwm_path, "period"), self.period_ns)
+        self._set(os.path.join(pwm_path, "duty_cycle"), int(pulse_us) * 1000)
+        self._set(os.path.join(pwm_path, "enable"), 1)
         self.active.append((chip_path, channel))
 
     def update_servo(self, channel_index, pulse_us):
         chip_path, channel = self.channels[channel_index]
         pwm_path = os.path.join(chip_path, f"pwm{channel}")
-        self._write(os.path.join(pwm_path, "duty_cycle"), int(pulse_us) * 1000)
+        self._set(os.path.join(pwm_path, "duty_cycle"), int(pulse_us) * 1000)
 
     def stop_all(self):
         for chip_path, channel in self.active:
             pwm_path = os.path.join(chip_path, f"pwm{channel}")
             try:
-                self._write(os.path.join(pwm_path, "duty_cycle"), 0)
-                self._write(os.path.join(pwm_path, "enable"), 0)
+                self._set(os.path.join(pwm_path, "duty_cycle"), 0)
+                self._set(os.path.join(pwm_path, "enable"), 0)
             except FileNotFoundError:
                 pass
         self.active = []
+        self.sysfs.close()
 
     def disable_channel(self, channel_index):
         chip_path, channel = self.channels[channel_index]
         pwm_path = os.path.join(chip_path, f"pwm{channel}")
         try:
-            self._write(os.path.join(pwm_path, "duty_cycle"), 0)
-            self._write(os.path.join(pwm_path, "enable"), 0)
+            self._set(os.path.join(pwm_path, "duty_cycle"), 0)
+            self._set(os.path.join(pwm_path, "enable"), 0)
         except FileNotFoundError:
             pass
 
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Drift-free periodic scheduler for the monitor loops.
+
+Deadlines are kept on ``time.monotonic()`` and advanced by a fixed interval,
+so the period does not stretch by the time spent on I2C, the PMIC query or
+MQTT.  With alignment enabled the ticks fall on wall-clock multiples of the
+interval (…:00, …:01, … for 1 s) and every tick carries that nominal wall
+timestamp, so samples from separate services share the same timestamps.
+
+Ticks that are already over when the loop comes back are skipped and
+counted instead of being run back to back.
+"""
+import asyncio
+import math
+import time
+
+from telemetry_common import get_env
+
+# Re-anchor on the wall clock when it jumps (NTP step, RTC-less boot) by more
+# than this many seconds relative to the monotonic clock.
+WALL_RESYNC_SEC = 0.5
+MISSED_LOG_MIN_INTERVAL_SEC = 60.0
+
+
+class DeadlineScheduler:
+    def __init__(self, interval, align=True, report_sec=0.0, name="tick"):
+        self.interval = max(0.01, float(interval))
+        self.align = align
+        self.report_sec = float(report_sec)
+        self.name = name
+        self.ticks = 0
+        self.missed = 0
+        self._deadline = None
+        self._wall_offset = None
+        self._defer_until = 0.0
+        self._missed_logged = 0
+        self._missed_log_at = -math.inf
+        self._report_at = time.monotonic() + self.report_sec
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._lat_n = 0
+        self._lat_sum = 0.0
+        self._lat_sq = 0.0
+        self._lat_max = 0.0
+        self._missed_at_report = self.missed
+
+    def _anchor(self, mono_now):
+        self._wall_offset = time.time() - mono_now
+        if self.align:
+            wall_next = math.floor((mono_now + self._wall_offset) / self.interval + 1.0) * self.interval
+            self._deadline = wall_next - self._wall_offset
+        else:
+            self._deadline = mono_now
+
+    def defer(self, seconds):
+        """Skip ticks for ``seconds`` (error backoff) without counting them as missed."""
+        self._defer_until = time.monotonic() + max(0.0, seconds)
+
+    def _plan(self):
+        """Pick the next deadline; returns (monotonic deadline, wall tick timestamp)."""
+        now = time.monotonic()
+        if self._deadline is None:
+            self._anchor(now)
+        else:
+            if abs(time.time() - now - self._wall_offset) > WALL_RESYNC_SEC:
+                self._anchor(now)
+            else:
+                self._deadline += self.interval
+            earliest = max(now, self._defer_until)
+            if self._deadline < earliest:
+                skipped = math.ceil((earliest - self._deadline) / self.interval)
+                self._deadline += skipped * self.interval
+                if self._defer_until <= now:
+                    self._note_missed(skipped, now)
+        return self._deadline, self._deadline + self._wall_offset
+
+    def _note_missed(self, skipped, now):
+        self.missed += skipped
+        if now - self._missed_log_at >= MISSED_LOG_MIN_INTERVAL_SEC:
+            print(f"{self.name}: overran, skipped {self.missed - self._missed_logged} tick(s) (total {self.missed}).")
+            self._missed_logged = self.missed
+            self._missed_log_at = now
+
+    def _woke(self, deadline):
+        now = time.monotonic()
+        self.ticks += 1
+        late = max(0.0, now - deadline)
+        self._lat_n += 1
+        self._lat_sum += late
+        self._lat_sq += late * late
+        self._lat_max = max(self._lat_max, late)
+        if self.report_sec > 0 and now >= self._report_at:
+            print(self.report())
+            self._reset_stats()
+            self._report_at = now + self.report_sec
+
+    def report(self):
+        """Wake-up lateness since the last report (jitter) and missed ticks."""
+        n = max(1, self._lat_n)
+        mean = self._lat_sum / n
+        std = math.sqrt(max(0.0, self._lat_sq / n - mean * mean))
+        return (
+            f"{self.name}: {self._lat_n} ticks, late mean={mean * 1000:.2f} ms "
+            f"sd={std * 1000:.2f} ms max={self._lat_max * 1000:.2f} ms, "
+            f"missed={self.missed - self._missed_at_report}"
+        )
+
+    def wait(self):
+        """Sleep until the next tick and return its wall-clock timestamp."""
+        deadline, tick_ts = self._plan()
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._woke(deadline)
+        return tick_ts
+
+    async def wait_async(self, stop=None):
+        """Async ``wait()``; returns None when ``stop`` (an asyncio.Event) is set first."""
+        deadline, tick_ts = self._plan()
+        delay = deadline - time.monotonic()
+        if stop is None:
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif delay > 0:
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        if stop is not None and stop.is_set():
+            return None
+        self._woke(deadline)
+        return tick_ts
+
+
+def scheduler_from_env(env, interval, name):
+    """Build a scheduler from the ``TICK_ALIGN`` / ``TICK_REPORT_SEC`` settings."""
+    align = str(get_env(env, "TICK_ALIGN", "1")).strip().lower() not in ("0", "false", "no", "off")
+    report_sec = float(get_env(env, "TICK_REPORT_SEC", "0") or 0)
+    return DeadlineScheduler(interval, align=align, report_sec=report_sec, name=name)
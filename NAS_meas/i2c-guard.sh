@@ -7,6 +7,7 @@ TIMEOUT_THRESHOLD="${TIMEOUT_THRESHOLD:-8}"
 I2C_DEVICE="${I2C_DEVICE:-1f00074000.i2c}"
 COOLDOWN_SEC="${COOLDOWN_SEC:-1800}"
 ALLOW_STOP_OLED="${ALLOW_STOP_OLED:-0}"
+MONITOR_SERVICE="${MONITOR_SERVICE:-nas-ina219.service}"
 STATE_DIR="/run/i2c-guard"
 COOLDOWN_FILE="${STATE_DIR}/nas_ina219_cooldown_until"
 
@@ -22,8 +23,8 @@ count=$(journalctl -k --since "-${WINDOW_MINUTES} min" --no-pager \
   | grep -E -c "i2c_designware ${I2C_DEVICE}: controller timed out|i2c_designware ${I2C_DEVICE}: i2c_dw_handle_tx_abort: SDA stuck at low|i2c_designware ${I2C_DEVICE}: i2c_dw_handle_tx_abort: lost arbitration" || true)
 
 if [ "${count}" -ge "${TIMEOUT_THRESHOLD}" ]; then
-  logger -t "$LOG_TAG" "Detected ${count} i2c fault events in ${WINDOW_MINUTES} min; stopping nas-ina219 for ${COOLDOWN_SEC}s cooldown."
-  timeout 8 systemctl stop nas-ina219.service || true
+  logger -t "$LOG_TAG" "Detected ${count} i2c fault events in ${WINDOW_MINUTES} min; stopping ${MONITOR_SERVICE} for ${COOLDOWN_SEC}s cooldown."
+  timeout 8 systemctl stop "${MONITOR_SERVICE}" || true
   if [ "${ALLOW_STOP_OLED}" = "1" ]; then
     logger -t "$LOG_TAG" "ALLOW_STOP_OLED=1, stopping rockpi-penta.service."
     timeout 8 systemctl stop rockpi-penta.service || true
@@ -33,12 +34,12 @@ if [ "${count}" -ge "${TIMEOUT_THRESHOLD}" ]; then
 fi
 
 if [ "${now_epoch}" -lt "${cooldown_until}" ]; then
-  timeout 8 systemctl stop nas-ina219.service || true
+  timeout 8 systemctl stop "${MONITOR_SERVICE}" || true
   exit 0
 fi
 
 if [ "${cooldown_until}" -gt 0 ] && systemctl is-active --quiet rockpi-penta.service; then
-  logger -t "$LOG_TAG" "Cooldown finished and OLED is active; starting nas-ina219 again."
-  timeout 8 systemctl start nas-ina219.service || true
+  logger -t "$LOG_TAG" "Cooldown finished and OLED is active; starting ${MONITOR_SERVICE} again."
+  timeout 8 systemctl start "${MONITOR_SERVICE}" || true
   rm -f "${COOLDOWN_FILE}"
 fi
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""INA219 access over I2C shared by the NAS power monitors.
+
+Every bus transaction is serialised with the other I2C users (OLED) through
+``I2C_LOCK_PATH`` and bounded by ``I2C_OP_TIMEOUT_SEC`` (main thread only).
+"""
+import contextlib
+import fcntl
+import os
+import signal
+import threading
+import time
+
+try:
+    from smbus2 import SMBus
+except ImportError:
+    try:
+        from smbus import SMBus
+    except ImportError:
+        SMBus = None
+
+# INA219 register addresses
+REG_CONFIG = 0x00
+REG_SHUNT_VOLTAGE = 0x01
+REG_BUS_VOLTAGE = 0x02
+REG_POWER = 0x03
+REG_CURRENT = 0x04
+REG_CALIBRATION = 0x05
+
+# INA219 config: 32V bus range, 80mV shunt range, 12-bit ADCs, 128 samples averaging, continuous shunt+bus
+CONFIG_32V_80MV_CONT = 0x3BFF
+
+# Hardware configuration
+MAX_CURRENT_A = 4.0
+
+# Rshunt = parallel of one 0.1 Ohm and six 0.11 Ohm resistors
+RSHUNT_OHM = 1.0 / (1.0 / 0.1 + 6.0 / 0.11)
+
+# INA219 calibration
+CURRENT_LSB_A = MAX_CURRENT_A / 32767.0
+POWER_LSB_W = 20.0 * CURRENT_LSB_A
+CALIBRATION_VALUE = int(0.04096 / (CURRENT_LSB_A * RSHUNT_OHM))
+
+I2C_LOCK_PATH = "/home/vojrik/.i2c-1.lock"
+I2C_OP_TIMEOUT_SEC = 1.5
+
+INA219_SENSORS = [
+    {"component": "sensor", "suffix": "voltage", "name": "Voltage", "unit": "V", "device_class": "voltage"},
+    {"component": "sensor", "suffix": "current", "name": "Current", "unit": "A", "device_class": "current"},
+    {"component": "sensor", "suffix": "power", "name": "Power", "unit": "W", "device_class": "power"},
+]
+
+
+def ina219_device_info(device_id, device_name):
+    return {
+        "identifiers": [device_id],
+        "name": device_name,
+        "manufacturer": "Texas Instruments",
+        "model": "INA219",
+    }
+
+
+@contextlib.contextmanager
+def i2c_op_timeout(timeout_sec):
+    if timeout_sec <= 0:
+        yield
+        return
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def _handle_timeout(_signum, _frame):
+        raise TimeoutError("I2C operation timeout")
+
+    old_handler = signal.getsignal(signal.SIGALRM)
+    signal.signal(signal.SIGALRM, _handle_timeout)
+    old_timer = signal.setitimer(signal.ITIMER_REAL, timeout_sec)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, old_timer[0], old_timer[1])
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+def swap_bytes(value):
+    return ((value & 0xFF) << 8) | (value >> 8)
+
+
+def read_register(bus, addr, reg):
+    with i2c_op_timeout(I2C_OP_TIMEOUT_SEC):
+        value = bus.read_word_data(addr, reg)
+    return swap_bytes(value)
+
+
+def write_register(bus, addr, reg, value):
+    with i2c_op_timeout(I2C_OP_TIMEOUT_SEC):
+        bus.write_word_data(addr, reg, swap_bytes(value))
+
+
+def find_ina219_address(bus, start=0x40, end=0x4F):
+    for addr in range(start, end + 1):
+        try:
+            read_register(bus, addr, REG_CONFIG)
+            return addr
+        except OSError:
+            continue
+    return None
+
+
+def to_signed_16(value):
+    if value & 0x8000:
+        return value - 0x10000
+    return value
+
+
+@contextlib.contextmanager
+def i2c_lock(timeout=1.0):
+    start = time.time()
+    fd = os.open(I2C_LOCK_PATH, os.O_CREAT | os.O_RDWR, 0o666)
+    try:
+        os.chmod(I2C_LOCK_PATH, 0o666)
+    except OSError:
+        pass
+    try:
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() - start > timeout:
+                    raise TimeoutError("I2C lock timeout")
+                time.sleep(0.01)
+        yield
+    finally:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+def open_bus(bus_num):
+    return SMBus(bus_num)
+
+def reopen_bus(bus, bus_num):
+    try:
+        bus.close()
+    except Exception:
+        pass
+    return open_bus(bus_num)
+
+
+def list_i2c_buses():
+    buses = []
+    try:
+        for name in os.listdir("/dev"):
+            if not name.startswith("i2c-"):
+                continue
+            try:
+                buses.append(int(name.split("-", 1)[1]))
+            except ValueError:
+                continue
+    except OSError:
+        return []
+    return sorted(set(buses))
+
+
+def pick_i2c_bus(preferred_bus):
+    device = f"/dev/i2c-{preferred_bus}"
+    if os.path.exists(device):
+        return preferred_bus
+    buses = list_i2c_buses()
+    if not buses:
+        return None
+    print(
+        f"Preferred I2C bus {preferred_bus} missing; trying available bus {buses[0]} ({', '.join(str(b) for b in buses)})."
+    )
+    return buses[0]
+
+def init_ina219(bus, addr, allow_scan=True):
+    delay = 0.05
+    for _ in range(3):
+        try:
+            with i2c_lock(timeout=3.0):
+                if addr is None:
+                    if not allow_scan:
+                        raise RuntimeError("INA219 address missing.")
+                    addr = find_ina219_address(bus)
+                if addr is None:
+                    raise RuntimeError("INA219 not found on I2C addresses 0x40-0x4F.")
+
+                write_register(bus, addr, REG_CONFIG, CONFIG_32V_80MV_CONT)
+                write_register(bus, addr, REG_CALIBRATION, CALIBRATION_VALUE)
+            return addr
+        except TimeoutError:
+            time.sleep(delay)
+            delay *= 2
+            continue
+    raise RuntimeError("I2C lock timeout during INA219 init.")
+
+
+def read_measurements(bus, addr, retries=3):
+    delay = 0.05
+    for _ in range(retries):
+        try:
+            with i2c_lock():
+                shunt_raw = to_signed_16(read_register(bus, addr, REG_SHUNT_VOLTAGE))
+                bus_raw = read_register(bus, addr, REG_BUS_VOLTAGE)
+                current_raw = to_signed_16(read_register(bus, addr, REG_CURRENT))
+                power_raw = read_register(bus, addr, REG_POWER)
+            return shunt_raw, bus_raw, current_raw, power_raw
+        except (OSError, TimeoutError):
+            time.sleep(delay)
+            delay *= 2
+            continue
+    raise OSError("I2C read failed after retries")
+
+
+def convert_measurements(shunt_raw, bus_raw, current_raw, power_raw):
+    """Raw register values -> (total voltage V, current A, power W)."""
+    shunt_voltage_v = shunt_raw * 10e-6
+    bus_voltage_v = ((bus_raw >> 3) * 4e-3)
+    # Force positive display if sensor is wired with reversed polarity.
+    current_a = abs(current_raw * CURRENT_LSB_A)
+    power_w = power_raw * POWER_LSB_W
+    # Total voltage is bus voltage plus shunt drop.
+    return bus_voltage_v + shunt_voltage_v, current_a, power_w
+
+
+class Ina219Device:
+    """Non-blocking open/read/reopen wrapper for long-running samplers.
+
+    ``try_open()`` makes one init attempt and returns False instead of waiting,
+    ``read()`` returns converted values and reopens the bus after
+    ``reopen_after_errors`` consecutive failures.
+    """
+
+    def __init__(self, bus_num, address, reopen_after_errors=3, reopen_min_interval_sec=5.0):
+        self.bus_num = bus_num
+        self.address = address
+        self.reopen_after_errors = reopen_after_errors
+        self.reopen_min_interval_sec = reopen_min_interval_sec
+        self.bus = None
+        self.addr = None
+        self.active_bus = None
+        self.consecutive_errors = 0
+        self._last_reopen_at = 0.0
+
+    @property
+    def ready(self):
+        return self.bus is not None and self.addr is not None
+
+    def try_open(self):
+        if self.ready:
+            return True
+        if SMBus is None:
+            raise RuntimeError("Missing smbus/smbus2. Install python3-smbus or smbus2.")
+        self.active_bus = pick_i2c_bus(self.active_bus if self.active_bus is not None else self.bus_num)
+        if self.active_bus is None:
+            raise RuntimeError("No /dev/i2c-* devices found.")
+        try:
+            self.bus = open_bus(self.active_bus)
+            self.addr = init_ina219(self.bus, self.address, allow_scan=False)
+        except (FileNotFoundError, RuntimeError, OSError):
+            self.close()
+            raise
+        self.consecutive_errors = 0
+        return True
+
+    def read(self):
+        try:
+            raw = read_measurements(self.bus, self.addr)
+        except (OSError, TimeoutError):
+            self.consecutive_errors += 1
+            now = time.monotonic()
+            if (
+                self.consecutive_errors >= self.reopen_after_errors
+                and now - self._last_reopen_at >= self.reopen_min_interval_sec
+            ):
+                self._last_reopen_at = now
+                self.close()
+                try:
+                    self.try_open()
+                except (RuntimeError, OSError) as exc:
+                    print(f"I2C reopen failed: {exc}")
+            raise
+        self.consecutive_errors = 0
+        return convert_measurements(*raw)
+
+    def close(self):
+        try:
+            if self.bus is not None:
+                self.bus.close()
+        except Exception:
+            pass
+        self.bus = None
+        self.addr = None
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""Bounded store-and-forward spool for telemetry samples.
+
+Samples captured while the MQTT broker is unreachable are appended to a
+fixed-record binary file (timestamp + N float32 values).  After reconnect the
+monitor replays them in batches with their original timestamps.  The file is
+capped at ``max_bytes``; when the cap is hit the oldest records are dropped.
+"""
+import json
+import os
+import struct
+import time
+
+# magic, field count, reserved, head (index of the first unconsumed record)
+HEADER = struct.Struct("<4sHHQ")
+MAGIC = b"NSP1"
+# Drop down to this fraction of the cap when compacting so that a full spool
+# is not rewritten on every append.
+COMPACT_TARGET = 0.9
+# A replayed batch that the broker has not acknowledged within this long is
+# assumed lost (clean session, reconnect) and sent again from the spool.
+REPLAY_ACK_TIMEOUT_S = 30.0
+
+
+class SampleSpool:
+    def __init__(self, path, fields, max_bytes):
+        self.path = path
+        self.fields = tuple(fields)
+        self.record = struct.Struct("<d" + "f" * len(self.fields))
+        self.max_records = max(1, (int(max_bytes) - HEADER.size) // self.record.size)
+        self.dropped = 0
+        # Replay batches published but not yet acknowledged: [info, count, sent_at].
+        self.inflight = []
+        self._fd = None
+        self._head = 0
+        self._count = 0
+        self._open()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        header = os.pread(self._fd, HEADER.size, 0)
+        valid = False
+        if len(header) == HEADER.size:
+            magic, nfields, _reserved, head = HEADER.unpack(header)
+            valid = magic == MAGIC and nfields == len(self.fields)
+        if not valid:
+            # Unknown or incompatible layout (e.g. field set changed): start over.
+            self._reset()
+            return
+        self._count = (size - HEADER.size) // self.record.size
+        self._head = min(head, self._count)
+        # Drop a torn trailing record left by a crash mid-append.
+        os.ftruncate(self._fd, HEADER.size + self._count * self.record.size)
+        if self._head >= self._count:
+            self._reset()
+
+    def _reset(self):
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, HEADER.pack(MAGIC, len(self.fields), 0, 0), 0)
+        self._head = 0
+        self._count = 0
+
+    def _write_head(self):
+        os.pwrite(self._fd, HEADER.pack(MAGIC, len(self.fields), 0, self._head), 0)
+
+    def __len__(self):
+        return self._count - self._head
+
+    def _offset(self, index):
+        return HEADER.size + index * self.record.size
+
+    def append(self, ts, values):
+        """Store one sample; never raises on a full spool, drops oldest instead."""
+        # Bound the file, not just the unconsumed part: records before the head
+        # (already replayed) are folded away too.
+        if self._count >= self.max_records:
+            self._compact(int(self.max_records * COMPACT_TARGET))
+        os.pwrite(self._fd, self.record.pack(ts, *values), self._offset(self._count))
+        self._count += 1
+
+    def _compact(self, keep):
+        keep = max(0, min(keep, len(self)))
+        drop = len(self) - keep
+        start = self._count - keep
+        data = os.pread(self._fd, keep * self.record.size, self._offset(start))
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, HEADER.pack(MAGIC, len(self.fields), 0, 0))
+            os.write(fd, data)
+        except OSError:
+            os.close(fd)
+            raise
+        os.replace(tmp_path, self.path)
+        os.close(self._fd)
+        self._fd = fd
+        self._head = 0
+        self._count = keep
+        self.dropped += drop
+        if drop:
+            # In-flight batches no longer start at the head; simply send them again.
+            self.inflight.clear()
+
+    def read_batch(self, limit, skip=0):
+        """Return up to ``limit`` oldest samples after the first ``skip`` as ``(ts, values)`` tuples."""
+        n = min(int(limit), len(self) - int(skip))
+        if n <= 0:
+            return []
+        raw = os.pread(self._fd, n * self.record.size, self._offset(self._head + int(skip)))
+        batch = []
+        for item in self.record.iter_unpack(raw[: (len(raw) // self.record.size) * self.record.size]):
+            batch.append((item[0], item[1:]))
+        return batch
+
+    def consume(self, count):
+        """Mark ``count`` oldest samples as delivered."""
+        self._head = min(self._count, self._head + int(count))
+        if self._head >= self._count:
+            self._reset()
+        else:
+            self._write_head()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def open_spool(path, fields, max_bytes):
+    """Open a spool or return None (with a message) when it can't be used."""
+    if not path or int(max_bytes) <= 0:
+        return None
+    try:
+        return SampleSpool(path, fields, max_bytes)
+    except OSError as exc:
+        print(f"Spool disabled, cannot open {path}: {exc}")
+        return None
+
+
+def spool_batch_payload(fields, batch):
+    """Compact JSON-serialisable form of a replay batch."""
+    return {
+        "fields": ["ts", *fields],
+        "samples": [[round(ts, 3), *[round(v, 6) for v in values]] for ts, values in batch],
+    }
+
+
+def replay_spool(client, topic, spool, batch_size, max_batches):
+    """Replay spooled batches at QoS 1 without blocking on the broker.
+
+    Samples are consumed only once the broker has acknowledged their batch
+    (``is_published()``), in order; until then they stay in the spool.  At most
+    ``max_batches`` batches are in flight.  If the oldest one is not
+    acknowledged within REPLAY_ACK_TIMEOUT_S, everything in flight is sent again.
+    """
+    inflight = spool.inflight
+    while inflight and inflight[0][0].is_published():
+        spool.consume(inflight.pop(0)[1])
+    if inflight and time.monotonic() - inflight[0][2] > REPLAY_ACK_TIMEOUT_S:
+        inflight.clear()
+    pending = sum(count for _info, count, _sent_at in inflight)
+    while len(inflight) < max_batches:
+        batch = spool.read_batch(batch_size, skip=pending)
+        if not batch:
+            return
+        info = client.publish(topic, json.dumps(spool_batch_payload(spool.fields, batch)), qos=1)
+        if info.rc != 0:
+            return
+        inflight.append([info, len(batch), time.monotonic()])
+        pending += len(batch)
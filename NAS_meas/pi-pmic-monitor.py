@@ -3,36 +3,21 @@ import argparse
 import json
 import math
 import os
-import re
 import socket
-import subprocess
 import sys
 import time
 
-try:
-    import paho.mqtt.client as mqtt
-except ImportError:
-    mqtt = None
+from deadline import scheduler_from_env
+from mqtt_spool import open_spool, replay_spool
+from pmic_reader import PmicReader, open_device, pmic_device_info, pmic_sample
+from telemetry_common import DiscoveryCache, close_mqtt_client, create_mqtt_client, get_env, load_env_file
 
 ENV_FILE = os.path.join(os.path.dirname(__file__), ".env")
-
-
-def load_env_file(path):
-    env = {}
-    if not os.path.exists(path):
-        return env
-    with open(path, "r", encoding="utf-8") as handle:
-        for raw_line in handle:
-            line = raw_line.strip()
-            if not line or line.startswith("#") or "=" not in line:
-                continue
-            key, value = line.split("=", 1)
-            env[key.strip()] = value.strip().strip("\"").strip("'")
-    return env
-
-
-def get_env(env, key, default=None):
-    return os.environ.get(key, env.get(key, default))
+SPOOL_PATH = "/run/nas-pmic/pmic.spool"
+SPOOL_MAX_BYTES = 4 * 1024 * 1024
+SPOOL_REPLAY_BATCH = 300
+SPOOL_REPLAY_BATCHES_PER_TICK = 4
+SPOOL_FIELDS = ("pi_ext5v_v", "pi_3v3_sys_v", "pi_3v3_sys_a", "pi_rails_total_w")
 
 
 def build_mqtt_config(env):
@@ -55,75 +40,10 @@ def build_mqtt_config(env):
     }
 
 
-def publish_discovery(client, cfg):
+def setup_mqtt(cfg, discovery):
     availability_topic = f"{cfg['base_topic']}/status"
-    device_info = {
-        "identifiers": [cfg["device_id"]],
-        "name": cfg["device_name"],
-        "manufacturer": "Raspberry Pi",
-        "model": "RPi5 PMIC",
-    }
-    sensors = [
-        {
-            "suffix": "pi_ext5v_v",
-            "name": "Pi EXT5V Voltage",
-            "unit": "V",
-            "device_class": "voltage",
-        },
-        {
-            "suffix": "pi_3v3_sys_v",
-            "name": "Pi 3V3 Voltage",
-            "unit": "V",
-            "device_class": "voltage",
-        },
-        {
-            "suffix": "pi_3v3_sys_a",
-            "name": "Pi 3V3 Current",
-            "unit": "A",
-            "device_class": "current",
-        },
-    ]
-
-    for sensor in sensors:
-        object_id = f"{cfg['device_id']}_{sensor['suffix']}"
-        topic = f"{cfg['discovery_prefix']}/sensor/{object_id}/config"
-        payload = {
-            "name": f"{cfg['device_name']} {sensor['name']}",
-            "state_topic": f"{cfg['base_topic']}/{sensor['suffix']}",
-            "availability_topic": availability_topic,
-            "unique_id": object_id,
-            "device_class": sensor["device_class"],
-            "state_class": "measurement",
-            "unit_of_measurement": sensor["unit"],
-            "device": device_info,
-        }
-        client.publish(topic, json.dumps(payload), retain=True)
-
-    client.publish(availability_topic, "online", retain=True)
-
-
-def setup_mqtt(cfg):
-    if mqtt is None:
-        raise RuntimeError("Missing paho-mqtt. Install python3-paho-mqtt or paho-mqtt.")
-
-    try:
-        client = mqtt.Client(
-            client_id=cfg["client_id"],
-            clean_session=True,
-            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
-        )
-    except (AttributeError, TypeError):
-        client = mqtt.Client(client_id=cfg["client_id"], clean_session=True)
-
-    if cfg["user"] or cfg["password"]:
-        client.username_pw_set(cfg["user"], cfg["password"])
-
-    availability_topic = f"{cfg['base_topic']}/status"
-    client.will_set(availability_topic, "offline", retain=True)
-    client.connect(cfg["host"], cfg["port"], keepalive=60)
-    client.loop_start()
-    publish_discovery(client, cfg)
-    return client
+    # Retained discovery may be gone (broker restart): send it with the next sample.
+    return create_mqtt_client(cfg, availability_topic, on_connected=lambda _client: discovery.invalidate())
 
 
 def parse_args(env):
@@ -135,43 +55,15 @@ def parse_args(env):
         default=float(get_env(env, "PUBLISH_INTERVAL_SEC", "1")),
         help="Publish interval in seconds.",
     )
+    parser.add_argument(
+        "--reader",
+        choices=("auto", "mailbox", "vcgencmd", "fake"),
+        default=get_env(env, "PMIC_READER", "auto"),
+        help="PMIC access path: /dev/vcio mailbox, vcgencmd subprocess, or fake data (default: auto).",
+    )
     return parser.parse_args()
 
 
-def parse_adc_value(text):
-    match = re.search(r"[-+]?\d+(?:\.\d+)?", text)
-    if not match:
-        raise ValueError("No numeric value found")
-    return float(match.group(0))
-
-
-def read_pmic_adc():
-    try:
-        output = subprocess.check_output(
-            ["vcgencmd", "pmic_read_adc"],
-            stderr=subprocess.STDOUT,
-            text=True,
-        )
-    except (OSError, subprocess.CalledProcessError) as exc:
-        raise RuntimeError(f"vcgencmd failed: {exc}") from exc
-
-    readings = {}
-    for line in output.splitlines():
-        line = line.strip()
-        if not line or "=" not in line:
-            continue
-        key, raw_value = line.split("=", 1)
-        key = key.strip()
-        if " " in key:
-            key = key.split()[0]
-        raw_value = raw_value.strip()
-        try:
-            readings[key] = parse_adc_value(raw_value)
-        except ValueError:
-            continue
-    return readings
-
-
 def is_finite(value):
     return isinstance(value, (int, float)) and math.isfinite(value)
 
@@ -179,67 +71,108 @@ def is_finite(value):
 def main():
     env = load_env_file(ENV_FILE)
     args = parse_args(env)
+    try:
+        reader = PmicReader(open_device(args.reader))
+    except RuntimeError as exc:
+        print(f"PMIC reader init failed: {exc}")
+        return 1
+    print(f"PMIC reader: {reader.device.name}")
 
     mqtt_cfg = None if args.no_mqtt else build_mqtt_config(env)
     mqtt_client = None
+    spool = None
+    discovery = None
     if mqtt_cfg:
+        discovery = DiscoveryCache(
+            mqtt_cfg["discovery_prefix"],
+            f"{mqtt_cfg['base_topic']}/state",
+            f"{mqtt_cfg['base_topic']}/status",
+        )
         try:
-            mqtt_client = setup_mqtt(mqtt_cfg)
+            mqtt_client = setup_mqtt(mqtt_cfg, discovery)
         except Exception as exc:
             print(f"MQTT setup failed: {exc}")
             return 1
+        spool = open_spool(
+            get_env(env, "PMIC_SPOOL_PATH", SPOOL_PATH),
+            SPOOL_FIELDS,
+            int(get_env(env, "SPOOL_MAX_BYTES", str(SPOOL_MAX_BYTES))),
+        )
+        if spool is not None and len(spool):
+            print(f"Spool holds {len(spool)} samples from a previous run.")
 
     last_error_at = 0.0
+    scheduler = scheduler_from_env(env, args.interval, "pmic")
     try:
         while True:
+            tick_ts = scheduler.wait()
             try:
-                adc = read_pmic_adc()
+                adc = reader.read_adc()
             except RuntimeError as exc:
                 now = time.time()
                 if now - last_error_at > 5:
                     print(f"PMIC read failed: {exc}")
                     last_error_at = now
-                time.sleep(args.interval)
                 continue
 
+            try:
+                throttled = reader.read_throttled()
+            except RuntimeError as exc:
+                throttled = None
+                now = time.time()
+                if now - last_error_at > 5:
+                    print(f"get_throttled failed: {exc}")
+                    last_error_at = now
+
             ext5v_v = adc.get("EXT5V_V")
             sys_3v3_v = adc.get("3V3_SYS_V")
             sys_3v3_a = adc.get("3V3_SYS_A")
 
             if not (is_finite(ext5v_v) and is_finite(sys_3v3_v) and is_finite(sys_3v3_a)):
                 print("PMIC read missing expected values")
-                time.sleep(args.interval)
                 continue
 
+            state, sensors = pmic_sample(adc, throttled)
+            state["ts"] = round(tick_ts, 3)
+            total_w = state.get("pi_rails_total_w", math.nan)
+            throttled_text = "n/a" if throttled is None else f"0x{throttled:x}"
             print(
                 f"EXT5V_V={ext5v_v:6.3f} V | "
                 f"3V3_SYS_V={sys_3v3_v:6.3f} V | "
-                f"3V3_SYS_A={sys_3v3_a:6.3f} A"
+                f"3V3_SYS_A={sys_3v3_a:6.3f} A | "
+                f"rails={total_w:6.3f} W | "
+                f"throttled={throttled_text}"
             )
 
             if mqtt_client and mqtt_cfg:
-                mqtt_client.publish(
-                    f"{mqtt_cfg['base_topic']}/pi_ext5v_v",
-                    f"{ext5v_v:.6f}",
-                )
-                mqtt_client.publish(
-                    f"{mqtt_cfg['base_topic']}/pi_3v3_sys_v",
-                    f"{sys_3v3_v:.6f}",
-                )
-                mqtt_client.publish(
-                    f"{mqtt_cfg['base_topic']}/pi_3v3_sys_a",
-                    f"{sys_3v3_a:.6f}",
-                )
-
-            time.sleep(args.interval)
+                if mqtt_client.is_connected():
+                    discovery.publish(mqtt_client, [(mqtt_cfg["device_id"], pmic_device_info(mqtt_cfg["device_id"], mqtt_cfg["device_name"]), sensors)])
+                    mqtt_client.publish(f"{mqtt_cfg['base_topic']}/state", json.dumps(state))
+                    if spool is not None and len(spool):
+                        replay_spool(
+                            mqtt_client,
+                            f"{mqtt_cfg['base_topic']}/backlog",
+                            spool,
+                            SPOOL_REPLAY_BATCH,
+                            SPOOL_REPLAY_BATCHES_PER_TICK,
+                        )
+                elif spool is not None:
+                    # Broker unreachable: keep sampling and store locally.
+                    dropped = spool.dropped
+                    try:
+                        spool.append(tick_ts, (ext5v_v, sys_3v3_v, sys_3v3_a, total_w))
+                    except OSError as exc:
+                        print(f"Spool write failed: {exc}")
+                    if spool.dropped != dropped:
+                        print(f"Spool full, dropped {spool.dropped - dropped} oldest samples.")
     except KeyboardInterrupt:
         pass
     finally:
+        reader.close()
+        if spool is not None:
+            spool.close()
         if mqtt_client and mqtt_cfg:
-            availability_topic = f"{mqtt_cfg['base_topic']}/status"
-            mqtt_client.publish(availability_topic, "offline", retain=True)
-            mqtt_client.loop_stop()
-            mqtt_client.disconnect()
+            close_mqtt_client(mqtt_client, f"{mqtt_cfg['base_topic']}/status")
 
     return 0
 
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""Raspberry Pi 5 PMIC ADC reader.
+
+``vcgencmd pmic_read_adc`` is a thin wrapper around the firmware mailbox
+property interface exposed by ``/dev/vcio``.  ``VcioMailbox`` issues the same
+GET_GENCMD_RESULT request from Python over a persistent fd, so sampling does
+not fork a process every interval.  ``SubprocessGencmd`` is kept as fallback
+and ``FakeVcio`` returns canned output for offline runs.
+
+Micro-benchmark of both paths:
+
+    python3 pmic_reader.py --bench 200
+"""
+import argparse
+import ctypes
+import fcntl
+import os
+import re
+import struct
+import subprocess
+import sys
+import time
+
+VCIO_PATH = "/dev/vcio"
+# _IOWR(100, 0, char *) from the vcio driver / vcgencmd.
+IOCTL_MBOX_PROPERTY = (3 << 30) | (ctypes.sizeof(ctypes.c_void_p) << 16) | (100 << 8) | 0
+TAG_GET_GENCMD_RESULT = 0x00030080
+MBOX_REQUEST = 0x00000000
+MBOX_RESPONSE_OK = 0x80000000
+# Same limit vcgencmd uses for command and response text.
+GENCMD_MAX_STRING = 1024
+
+
+class MailboxError(RuntimeError):
+    """The /dev/vcio transport itself failed (as opposed to the gencmd)."""
+
+
+_VALUE_RE = re.compile(r"[-+]?\d+(?:\.\d+)?")
+
+# Typical Pi 5 output, used by FakeVcio.
+SAMPLE_PMIC_OUTPUT = """\
+     3V7_WL_SW_A current(0)=0.00390372A
+       3V3_SYS_A current(1)=0.05172426A
+       1V8_SYS_A current(2)=0.18445680A
+      DDR_VDD2_A current(3)=0.02049453A
+      DDR_VDDQ_A current(4)=0.00000000A
+       1V1_SYS_A current(5)=0.18542280A
+       0V8_SYS_A current(6)=0.32695440A
+      VDD_CORE_A current(7)=0.71738400A
+       3V3_DAC_A current(17)=0.00048840A
+       3V3_ADC_A current(18)=0.00024420A
+       0V8_AON_A current(16)=0.00390720A
+          HDMI_A current(22)=0.02296200A
+     3V7_WL_SW_V volt(8)=3.71426400V
+       3V3_SYS_V volt(9)=3.30281400V
+       1V8_SYS_V volt(10)=1.79711400V
+      DDR_VDD2_V volt(11)=1.11158000V
+      DDR_VDDQ_V volt(12)=0.60476800V
+       1V1_SYS_V volt(13)=1.10645000V
+       0V8_SYS_V volt(14)=0.80219000V
+      VDD_CORE_V volt(15)=0.72005200V
+       3V3_DAC_V volt(20)=3.31054300V
+       3V3_ADC_V volt(21)=3.30792800V
+       0V8_AON_V volt(19)=0.79780000V
+          HDMI_V volt(23)=5.14484000V
+         EXT5V_V volt(24)=5.12885200V
+          BATT_V volt(25)=0.00000000V
+"""
+
+
+def parse_adc_value(text):
+    match = _VALUE_RE.search(text)
+    if not match:
+        raise ValueError("No numeric value found")
+    return float(match.group(0))
+
+
+def parse_pmic_output(output):
+    readings = {}
+    for line in output.splitlines():
+        line = line.strip()
+        if not line or "=" not in line:
+            continue
+        key, raw_value = line.split("=", 1)
+        key = key.strip()
+        if " " in key:
+            key = key.split()[0]
+        try:
+            readings[key] = parse_adc_value(raw_value.strip())
+        except ValueError:
+            continue
+    return readings
+
+
+# Bits of the firmware get_throttled mask: (bit, key, label).
+THROTTLED_BITS = (
+    (0, "under_voltage", "Under-voltage"),
+    (1, "freq_capped", "ARM Frequency Capped"),
+    (2, "throttled", "Throttled"),
+    (3, "soft_temp_limit", "Soft Temperature Limit"),
+    (16, "under_voltage_occurred", "Under-voltage Occurred"),
+    (17, "freq_capped_occurred", "ARM Frequency Capped Occurred"),
+    (18, "throttled_occurred", "Throttled Occurred"),
+    (19, "soft_temp_limit_occurred", "Soft Temperature Limit Occurred"),
+)
+
+
+def parse_throttled(output):
+    """Parse ``throttled=0x50005`` into an int."""
+    _, _, value = output.strip().partition("=")
+    try:
+        return int(value.strip(), 16)
+    except ValueError:
+        raise RuntimeError(f"unexpected get_throttled output: {output.strip()!r}") from None
+
+
+def decode_throttled(mask):
+    return {key: bool(mask >> bit & 1) for bit, key, _label in THROTTLED_BITS}
+
+
+# Keep the entity names the first three sensors were published with.
+LEGACY_NAMES = {
+    "pi_ext5v_v": "Pi EXT5V Voltage",
+    "pi_3v3_sys_v": "Pi 3V3 Voltage",
+    "pi_3v3_sys_a": "Pi 3V3 Current",
+}
+UNIT_BY_SUFFIX = {
+    "_V": ("V", "voltage", "Voltage"),
+    "_A": ("A", "current", "Current"),
+    "_W": ("W", "power", "Power"),
+}
+
+
+def rail_powers(readings):
+    """Pair ``<rail>_V``/``<rail>_A`` readings into per-rail power in W."""
+    powers = {}
+    for key, volts in readings.items():
+        if not key.endswith("_V"):
+            continue
+        rail = key[:-2]
+        amps = readings.get(f"{rail}_A")
+        if amps is not None:
+            powers[rail] = volts * amps
+    return powers
+
+
+def pmic_device_info(device_id, device_name):
+    return {
+        "identifiers": [device_id],
+        "name": device_name,
+        "manufacturer": "Raspberry Pi",
+        "model": "RPi5 PMIC",
+    }
+
+
+def pmic_sample(adc, throttled):
+    """Return the JSON state and the matching sensor descriptions for one sample."""
+    state = {}
+    sensors = []
+    readings = dict(adc)
+    powers = rail_powers(adc)
+    for rail, watts in powers.items():
+        readings[f"{rail}_W"] = watts
+    for key in sorted(readings):
+        unit = UNIT_BY_SUFFIX.get(key[-2:])
+        if unit is None:
+            continue
+        suffix = f"pi_{key.lower()}"
+        state[suffix] = round(readings[key], 6)
+        sensors.append(
+            {
+                "component": "sensor",
+                "suffix": suffix,
+                "name": LEGACY_NAMES.get(suffix, f"Pi {key[:-2]} {unit[2]}"),
+                "unit": unit[0],
+                "device_class": unit[1],
+            }
+        )
+    if powers:
+        state["pi_rails_total_w"] = round(sum(powers.values()), 6)
+        sensors.append(
+            {
+                "component": "sensor",
+                "suffix": "pi_rails_total_w",
+                "name": "Pi Rails Total Power",
+                "unit": "W",
+                "device_class": "power",
+            }
+        )
+    if throttled is not None:
+        state["throttled_mask"] = throttled
+        state.update(decode_throttled(throttled))
+        sensors.append(
+            {
+                "component": "sensor",
+                "suffix": "throttled_mask",
+                "name": "Pi Throttled Mask",
+                "unit": None,
+                "device_class": None,
+            }
+        )
+        for _bit, key, label in THROTTLED_BITS:
+            sensors.append(
+                {
+                    "component": "binary_sensor",
+                    "suffix": key,
+                    "name": f"Pi {label}",
+                    "device_class": "problem",
+                }
+            )
+    return state, sensors
+
+
+class VcioMailbox:
+    """Firmware gencmd over the /dev/vcio property mailbox, fd kept open."""
+
+    name = "mailbox"
+
+    def __init__(self, path=VCIO_PATH):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR)
+        words = GENCMD_MAX_STRING // 4 + 7
+        self._buf = bytearray(words * 4)
+
+    def gencmd(self, command):
+        encoded = command.encode("ascii") + b"\0"
+        if len(encoded) >= GENCMD_MAX_STRING:
+            raise RuntimeError("gencmd command too long")
+        buf = self._buf
+        buf[:] = bytes(len(buf))
+        struct.pack_into(
+            "<6I",
+            buf,
+            0,
+            len(buf),
+            MBOX_REQUEST,
+            TAG_GET_GENCMD_RESULT,
+            GENCMD_MAX_STRING,
+            0,
+            0,
+        )
+        buf[24:24 + len(encoded)] = encoded
+        try:
+            fcntl.ioctl(self._fd, IOCTL_MBOX_PROPERTY, buf, True)
+        except OSError as exc:
+            raise MailboxError(f"mailbox ioctl failed: {exc}") from exc
+        status = struct.unpack_from("<I", buf, 4)[0]
+        if status != MBOX_RESPONSE_OK:
+            raise MailboxError(f"mailbox request failed (0x{status:08x})")
+        error = struct.unpack_from("<I", buf, 20)[0]
+        text = bytes(buf[24:24 + GENCMD_MAX_STRING]).split(b"\0", 1)[0].decode("ascii", "replace")
+        if error:
+            raise RuntimeError(f"gencmd '{command}' returned error {error}: {text.strip()}")
+        return text
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class SubprocessGencmd:
+    """Original path: spawn vcgencmd for every request."""
+
+    name = "vcgencmd"
+
+    def gencmd(self, command):
+        try:
+            return subprocess.check_output(
+                ["vcgencmd", *command.split()],
+                stderr=subprocess.STDOUT,
+                text=True,
+            )
+        except (OSError, subprocess.CalledProcessError) as exc:
+            raise RuntimeError(f"vcgencmd failed: {exc}") from exc
+
+    def close(self):
+        pass
+
+
+class FakeVcio:
+    """Canned gencmd responses for running the monitor without a Pi."""
+
+    name = "fake"
+
+    def __init__(self, responses=None):
+        self.responses = {"pmic_read_adc": SAMPLE_PMIC_OUTPUT, "get_throttled": "throttled=0x0\n"}
+        if responses:
+            self.responses.update(responses)
+
+    def gencmd(self, command):
+        try:
+            return self.responses[command]
+        except KeyError:
+            raise RuntimeError(f"fake gencmd has no response for '{command}'") from None
+
+    def close(self):
+        pass
+
+
+def open_device(kind="auto"):
+    """Return a gencmd device: ``auto`` prefers the mailbox, falls back to vcgencmd."""
+    if kind == "fake":
+        return FakeVcio()
+    if kind == "vcgencmd":
+        return SubprocessGencmd()
+    try:
+        return VcioMailbox()
+    except OSError as exc:
+        if kind == "mailbox":
+            raise RuntimeError(f"cannot open {VCIO_PATH}: {exc}") from exc
+        print(f"{VCIO_PATH} unavailable ({exc}); using vcgencmd subprocess.")
+        return SubprocessGencmd()
+
+
+class PmicReader:
+    def __init__(self, device=None):
+        self.device = device if device is not None else open_device()
+
+    def gencmd(self, command):
+        try:
+            return self.device.gencmd(command)
+        except MailboxError as exc:
+            # Mailbox stopped working (firmware/driver reload): degrade once.
+            print(f"{exc}; switching to vcgencmd subprocess.")
+            self.device.close()
+            self.device = SubprocessGencmd()
+            return self.device.gencmd(command)
+
+    def read_adc(self):
+        return parse_pmic_output(self.gencmd("pmic_read_adc"))
+
+    def read_throttled(self):
+        return parse_throttled(self.gencmd("get_throttled"))
+
+    def close(self):
+        self.device.close()
+
+
+def _bench(device, count):
+    reader = PmicReader(device)
+    reader.read_adc()  # warm-up
+    # Include reaped children so the vcgencmd processes are accounted for.
+    cpu_start = sum(os.times()[:4])
+    start = time.perf_counter()
+    for _ in range(count):
+        reader.read_adc()
+    wall = time.perf_counter() - start
+    cpu = sum(os.times()[:4]) - cpu_start
+    reader.close()
+    return wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read PMIC ADC values / benchmark the read paths.")
+    parser.add_argument("--device", choices=("auto", "mailbox", "vcgencmd", "fake"), default="auto")
+    parser.add_argument("--bench", type=int, metavar="N", help="Time N reads on every available path.")
+    args = parser.parse_args()
+
+    if not args.bench:
+        reader = PmicReader(open_device(args.device))
+        for key, value in sorted(reader.read_adc().items()):
+            print(f"{key}={value:.6f}")
+        reader.close()
+        return 0
+
+    candidates = [("mailbox", VcioMailbox), ("vcgencmd", SubprocessGencmd), ("fake", FakeVcio)]
+    for name, factory in candidates:
+        try:
+            wall, cpu = _bench(factory(), args.bench)
+        except (OSError, RuntimeError) as exc:
+            print(f"{name:9s} unavailable: {exc}")
+            continue
+        print(
+            f"{name:9s} {args.bench} reads: {wall * 1000.0 / args.bench:8.3f} ms/read wall, "
+            f"{cpu * 1000.0 / args.bench:8.3f} ms/read CPU"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
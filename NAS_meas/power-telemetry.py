@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""Unified NAS power telemetry daemon.
+
+Samples the INA219 (whole NAS draw) and the Pi 5 PMIC on the same
+wall-clock aligned ticks, derives NAS-minus-Pi draw and (optionally) the Pi
+conversion losses, and publishes one JSON state message per tick over a
+single persistent MQTT connection.  Replaces running ``ina219-monitor.py`` and
+``pi-pmic-monitor.py`` side by side.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import math
+import os
+import signal
+import socket
+import sys
+import time
+
+import ina219
+from deadline import scheduler_from_env
+from ina219 import INA219_SENSORS, Ina219Device, ina219_device_info
+from mqtt_spool import open_spool, replay_spool
+from pmic_reader import PmicReader, open_device, pmic_device_info, pmic_sample
+from telemetry_common import (
+    DiscoveryCache,
+    close_mqtt_client,
+    create_mqtt_client,
+    get_env,
+    load_env_file,
+    start_watchdog,
+    touch_progress,
+)
+
+ENV_FILE = os.path.join(os.path.dirname(__file__), ".env")
+WATCHDOG_TIMEOUT_SEC = 20.0
+I2C_INIT_RETRY_SEC = 5.0
+I2C_ERROR_BACKOFF_MAX_SEC = 60.0
+I2C_ERROR_BACKOFF_FACTOR = 2.0
+SPOOL_PATH = "/run/nas-power/power.spool"
+SPOOL_MAX_BYTES = 4 * 1024 * 1024
+SPOOL_REPLAY_BATCH = 300
+SPOOL_REPLAY_BATCHES_PER_TICK = 4
+SPOOL_FIELDS = ("voltage", "current", "power", "pi_ext5v_v", "pi_rails_total_w", "nas_minus_pi_w")
+
+DERIVED_SENSORS = [
+    {"component": "sensor", "suffix": "nas_minus_pi_w", "name": "NAS minus Pi Power", "unit": "W", "device_class": "power"},
+    {"component": "sensor", "suffix": "pi_share_pct", "name": "Pi Share of NAS Power", "unit": "%", "device_class": None},
+]
+LOSS_SENSORS = [
+    {"component": "sensor", "suffix": "pi_input_est_w", "name": "Pi Input Power (est.)", "unit": "W", "device_class": "power"},
+    {"component": "sensor", "suffix": "pi_conversion_loss_w", "name": "Pi Conversion Loss (est.)", "unit": "W", "device_class": "power"},
+]
+
+
+def build_mqtt_config(env):
+    host = get_env(env, "MQTT_HOST", "127.0.0.1")
+    if not host:
+        return None
+    return {
+        "host": host,
+        "port": int(get_env(env, "MQTT_PORT", "1883")),
+        "user": get_env(env, "MQTT_USER", ""),
+        "password": get_env(env, "MQTT_PASSWORD", ""),
+        "client_id": get_env(env, "POWER_MQTT_CLIENT_ID", f"nas-power-{socket.gethostname()}"),
+        "base_topic": get_env(env, "POWER_MQTT_BASE_TOPIC", "nas/power"),
+        "discovery_prefix": get_env(env, "MQTT_DISCOVERY_PREFIX", "homeassistant"),
+        "device_id": get_env(env, "MQTT_DEVICE_ID", "nas_ina219"),
+        "device_name": get_env(env, "MQTT_DEVICE_NAME", "NAS INA219"),
+        "pmic_device_id": get_env(env, "PMIC_MQTT_DEVICE_ID", "rpi_supply"),
+        "pmic_device_name": get_env(env, "PMIC_MQTT_DEVICE_NAME", "RPi Supply"),
+    }
+
+
+def parse_args(env):
+    parser = argparse.ArgumentParser(description="Sample INA219 and Pi PMIC together and publish to MQTT.")
+    parser.add_argument("--no-mqtt", action="store_true", help="Disable MQTT publishing.")
+    parser.add_argument("--no-ina219", action="store_true", help="Skip the INA219 (PMIC only).")
+    parser.add_argument(
+        "--i2c-bus",
+        type=int,
+        default=int(get_env(env, "I2C_BUS", "1")),
+        help="I2C bus number (default: 1).",
+    )
+    parser.add_argument(
+        "--i2c-address",
+        type=lambda value: int(value, 0),
+        default=get_env(env, "I2C_ADDRESS", "0x40"),
+        help="INA219 I2C address (default: 0x40).",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=float(get_env(env, "PUBLISH_INTERVAL_SEC", "1")),
+        help="Sampling interval in seconds; ticks are aligned to wall-clock multiples.",
+    )
+    parser.add_argument(
+        "--reader",
+        choices=("auto", "mailbox", "vcgencmd", "fake"),
+        default=get_env(env, "PMIC_READER", "auto"),
+        help="PMIC access path (default: auto).",
+    )
+    parser.add_argument(
+        "--pmic-efficiency",
+        type=float,
+        default=float(get_env(env, "PI_PMIC_EFFICIENCY", "0") or 0),
+        help="Assumed PMIC efficiency (0-1) for the Pi input/loss estimate; 0 disables it.",
+    )
+    return parser.parse_args()
+
+
+def derived_values(state, efficiency):
+    """NAS draw minus Pi draw, Pi share and optional conversion loss estimate.
+
+    The PMIC only reports its output rails, so the Pi input power is estimated
+    as rails / efficiency when an efficiency is configured.
+    """
+    nas_w = state.get("power")
+    pi_rails_w = state.get("pi_rails_total_w")
+    if nas_w is None or pi_rails_w is None:
+        return {}
+    out = {}
+    pi_w = pi_rails_w
+    if 0.0 < efficiency <= 1.0:
+        pi_w = pi_rails_w / efficiency
+        out["pi_input_est_w"] = round(pi_w, 6)
+        out["pi_conversion_loss_w"] = round(pi_w - pi_rails_w, 6)
+    out["nas_minus_pi_w"] = round(nas_w - pi_w, 6)
+    if nas_w > 0:
+        out["pi_share_pct"] = round(100.0 * pi_w / nas_w, 2)
+    return out
+
+
+class PowerDaemon:
+    def __init__(self, args, env, mqtt_cfg):
+        self.args = args
+        self.mqtt_cfg = mqtt_cfg
+        self.ina = None
+        if not args.no_ina219:
+            self.ina = Ina219Device(
+                args.i2c_bus,
+                args.i2c_address,
+                reopen_after_errors=int(get_env(env, "I2C_REOPEN_AFTER_ERRORS", "3")),
+                reopen_min_interval_sec=float(get_env(env, "I2C_REOPEN_MIN_INTERVAL_SEC", "5")),
+            )
+        self.ina_backoff_max_sec = float(get_env(env, "I2C_ERROR_BACKOFF_MAX_SEC", str(I2C_ERROR_BACKOFF_MAX_SEC)))
+        self.ina_backoff_factor = float(get_env(env, "I2C_ERROR_BACKOFF_FACTOR", str(I2C_ERROR_BACKOFF_FACTOR)))
+        self.pmic = PmicReader(open_device(args.reader))
+        # PMIC reads (mailbox ioctl or vcgencmd fallback) run off the event loop.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="pmic")
+        self.client = None
+        self.discovery = None
+        self.spool = None
+        self.stop = None
+        self._last_error_at = {}
+        self._next_ina_init_at = 0.0
+        self._next_ina_read_at = 0.0
+        self._ina_backoff_sec = self._ina_backoff_min()
+
+    def _log_limited(self, key, message):
+        now = time.monotonic()
+        if now - self._last_error_at.get(key, -math.inf) > 5:
+            print(message)
+            self._last_error_at[key] = now
+
+    def _ina_backoff_min(self):
+        return max(self.args.interval, 1.0)
+
+    def _read_ina(self):
+        """Blocking INA219 read on the loop thread (SIGALRM timeouts need the main thread).
+
+        Read errors back off exponentially so a missing or hung sensor does not
+        stall every tick; after ``reopen_after_errors`` failures the device is
+        closed and goes through ``try_open()`` again.
+        """
+        if self.ina is None:
+            return None
+        now = time.monotonic()
+        if now < self._next_ina_read_at:
+            return None
+        if not self.ina.ready:
+            if now < self._next_ina_init_at:
+                return None
+            try:
+                self.ina.try_open()
+                print(f"INA219 detected at 0x{self.ina.addr:02X} on I2C bus {self.ina.active_bus}")
+            except (RuntimeError, OSError) as exc:
+                self._next_ina_init_at = now + I2C_INIT_RETRY_SEC
+                self._log_limited("ina-init", f"I2C init failed: {exc}")
+                return None
+        try:
+            values = self.ina.read()
+        except (OSError, TimeoutError) as exc:
+            self._log_limited("ina-read", f"I2C read failed: {exc}")
+            now = time.monotonic()
+            self._next_ina_read_at = now + self._ina_backoff_sec
+            self._ina_backoff_sec = min(self.ina_backoff_max_sec, self._ina_backoff_sec * self.ina_backoff_factor)
+            if self.ina.ready and self.ina.consecutive_errors >= self.ina.reopen_after_errors:
+                # In-place reopen was rate limited or did not help: start over.
+                self.ina.close()
+                self._next_ina_init_at = self._next_ina_read_at
+            return None
+        self._next_ina_read_at = 0.0
+        self._ina_backoff_sec = self._ina_backoff_min()
+        return values
+
+    def _read_pmic(self):
+        try:
+            adc = self.pmic.read_adc()
+        except RuntimeError as exc:
+            self._log_limited("pmic", f"PMIC read failed: {exc}")
+            return None
+        try:
+            throttled = self.pmic.read_throttled()
+        except RuntimeError as exc:
+            self._log_limited("throttled", f"get_throttled failed: {exc}")
+            throttled = None
+        return pmic_sample(adc, throttled)
+
+    async def sample(self, ts):
+        loop = asyncio.get_running_loop()
+        pmic_future = loop.run_in_executor(self.executor, self._read_pmic)
+        ina = self._read_ina()
+        pmic = await pmic_future
+
+        state = {"ts": round(ts, 3)}
+        groups = []
+        cfg = self.mqtt_cfg
+        if ina is not None:
+            voltage, current, power = ina
+            state.update(voltage=round(voltage, 6), current=round(current, 6), power=round(power, 6))
+        if pmic is not None:
+            pmic_state, pmic_sensors = pmic
+            state.update(pmic_state)
+            if cfg:
+                groups.append((cfg["pmic_device_id"], pmic_device_info(cfg["pmic_device_id"], cfg["pmic_device_name"]), pmic_sensors))
+        derived = derived_values(state, self.args.pmic_efficiency)
+        state.update(derived)
+        if cfg and ina is not None:
+            sensors = list(INA219_SENSORS)
+            if "nas_minus_pi_w" in derived:
+                sensors += DERIVED_SENSORS
+            if "pi_conversion_loss_w" in derived:
+                sensors += LOSS_SENSORS
+            groups.append((cfg["device_id"], ina219_device_info(cfg["device_id"], cfg["device_name"]), sensors))
+        return state, groups
+
+    def publish(self, state, groups):
+        cfg = self.mqtt_cfg
+        if self.client.is_connected():
+            self.discovery.publish(self.client, groups)
+            self.client.publish(f"{cfg['base_topic']}/state", json.dumps(state))
+            if self.spool is not None and len(self.spool):
+                replay_spool(
+                    self.client,
+                    f"{cfg['base_topic']}/backlog",
+                    self.spool,
+                    SPOOL_REPLAY_BATCH,
+                    SPOOL_REPLAY_BATCHES_PER_TICK,
+                )
+        elif self.spool is not None:
+            dropped = self.spool.dropped
+            try:
+                self.spool.append(state["ts"], tuple(state.get(field, math.nan) for field in SPOOL_FIELDS))
+            except OSError as exc:
+                self._log_limited("spool", f"Spool write failed: {exc}")
+            if self.spool.dropped != dropped:
+                print(f"Spool full, dropped {self.spool.dropped - dropped} oldest samples.")
+
+    async def run(self, env):
+        loop = asyncio.get_running_loop()
+        self.stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop.set)
+
+        cfg = self.mqtt_cfg
+        if cfg:
+            availability_topic = f"{cfg['base_topic']}/status"
+            self.discovery = DiscoveryCache(cfg["discovery_prefix"], f"{cfg['base_topic']}/state", availability_topic)
+            self.client = create_mqtt_client(cfg, availability_topic, on_connected=lambda _client: self.discovery.invalidate())
+            self.spool = open_spool(
+                get_env(env, "POWER_SPOOL_PATH", SPOOL_PATH),
+                SPOOL_FIELDS,
+                int(get_env(env, "SPOOL_MAX_BYTES", str(SPOOL_MAX_BYTES))),
+            )
+
+        interval = max(0.1, self.args.interval)
+        scheduler = scheduler_from_env(env, interval, "power")
+        print(f"PMIC reader: {self.pmic.device.name}; interval {interval:g}s")
+        try:
+            while not self.stop.is_set():
+                touch_progress()
+                tick = await scheduler.wait_async(self.stop)
+                if tick is None:
+                    break
+                state, groups = await self.sample(tick)
+                if len(state) <= 1:
+                    continue
+                print(
+                    " | ".join(
+                        f"{key}={state[key]:.3f}"
+                        for key in ("power", "pi_rails_total_w", "nas_minus_pi_w")
+                        if key in state
+                    )
+                )
+                if self.client is not None:
+                    self.publish(state, groups)
+        finally:
+            self.executor.shutdown(wait=False)
+            self.pmic.close()
+            if self.ina is not None:
+                self.ina.close()
+            if self.spool is not None:
+                self.spool.close()
+            if self.client is not None:
+                close_mqtt_client(self.client, f"{cfg['base_topic']}/status")
+
+
+def main():
+    env = load_env_file(ENV_FILE)
+    ina219.I2C_OP_TIMEOUT_SEC = float(get_env(env, "I2C_OP_TIMEOUT_SEC", str(ina219.I2C_OP_TIMEOUT_SEC)))
+    args = parse_args(env)
+    mqtt_cfg = None if args.no_mqtt else build_mqtt_config(env)
+    try:
+        daemon = PowerDaemon(args, env, mqtt_cfg)
+    except RuntimeError as exc:
+        print(f"Init failed: {exc}")
+        return 1
+    start_watchdog(float(get_env(env, "WATCHDOG_TIMEOUT_SEC", str(WATCHDOG_TIMEOUT_SEC))), "power-watchdog")
+    try:
+        asyncio.run(daemon.run(env))
+    except RuntimeError as exc:
+        print(f"Power daemon failed: {exc}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Env loading, MQTT client setup, HA discovery and watchdog helpers shared
+by the NAS power monitors and the unified power daemon."""
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+MQTT_RECONNECT_MAX_SEC = 60
+_LAST_PROGRESS_AT = time.monotonic()
+
+
+def load_env_file(path):
+    env = {}
+    if not os.path.exists(path):
+        return env
+    with open(path, "r", encoding="utf-8") as handle:
+        for raw_line in handle:
+            line = raw_line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            env[key.strip()] = value.strip().strip("\"").strip("'")
+    return env
+
+
+def get_env(env, key, default=None):
+    return os.environ.get(key, env.get(key, default))
+
+
+def touch_progress():
+    global _LAST_PROGRESS_AT
+    _LAST_PROGRESS_AT = time.monotonic()
+
+
+def start_watchdog(timeout_sec, name):
+    if timeout_sec <= 0:
+        return
+
+    def _watchdog_loop():
+        while True:
+            time.sleep(2.0)
+            if time.monotonic() - _LAST_PROGRESS_AT > timeout_sec:
+                print(
+                    f"Watchdog: no progress for >{timeout_sec:.0f}s, exiting for systemd restart.",
+                    file=sys.stderr,
+                )
+                os._exit(1)
+
+    thread = threading.Thread(target=_watchdog_loop, daemon=True, name=name)
+    thread.start()
+
+
+def connack_ok(reason_code):
+    # paho 2.x passes a ReasonCode object, 1.x a plain int.
+    if hasattr(reason_code, "is_failure"):
+        return not reason_code.is_failure
+    return reason_code == 0
+
+
+def create_mqtt_client(cfg, availability_topic, on_connected=None):
+    """Create the client and connect in the background; never blocks on the broker.
+
+    ``on_connected(client)`` runs on the paho network thread after every
+    successful (re)connect.
+    """
+    if mqtt is None:
+        raise RuntimeError("Missing paho-mqtt. Install python3-paho-mqtt or paho-mqtt.")
+
+    # Use the new callback API when available to avoid deprecation warnings.
+    try:
+        client = mqtt.Client(
+            client_id=cfg["client_id"],
+            clean_session=True,
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+        )
+    except (AttributeError, TypeError):
+        client = mqtt.Client(client_id=cfg["client_id"], clean_session=True)
+    if cfg["user"] or cfg["password"]:
+        client.username_pw_set(cfg["user"], cfg["password"])
+
+    client.will_set(availability_topic, "offline", retain=True)
+    client.reconnect_delay_set(min_delay=1, max_delay=MQTT_RECONNECT_MAX_SEC)
+
+    def _on_connect(client, _userdata, _flags, reason_code, *_extra):
+        if connack_ok(reason_code):
+            print("MQTT connected.")
+            if on_connected is not None:
+                on_connected(client)
+        else:
+            print(f"MQTT connect refused: {reason_code}")
+
+    client.on_connect = _on_connect
+    client.connect_async(cfg["host"], cfg["port"], keepalive=60)
+    client.loop_start()
+    return client
+
+
+def close_mqtt_client(client, availability_topic):
+    client.publish(availability_topic, "offline", retain=True)
+    client.loop_stop()
+    client.disconnect()
+
+
+class DiscoveryCache:
+    """Home Assistant discovery for JSON-state sensors, re-sent only on change.
+
+    ``publish()`` takes ``(device_id, device_info, sensors)`` groups; each sensor
+    is a dict with ``component``, ``suffix``, ``name``, optional
+    ``device_class`` and, for plain sensors, ``unit`` (None for unitless values
+    such as a bitmask, which are then not recorded as measurements).  The value
+    is read from ``state_topic`` with ``value_json.<suffix>``.
+    """
+
+    def __init__(self, discovery_prefix, state_topic, availability_topic):
+        self.discovery_prefix = discovery_prefix
+        self.state_topic = state_topic
+        self.availability_topic = availability_topic
+        self.published = None
+
+    def invalidate(self):
+        self.published = None
+
+    def publish(self, client, groups):
+        current = {}
+        for device_id, device_info, sensors in groups:
+            for sensor in sensors:
+                object_id = f"{device_id}_{sensor['suffix']}"
+                current[(sensor["component"], object_id)] = (device_info, sensor)
+        if self.published is not None and set(current) == set(self.published):
+            return
+        for (component, object_id), (device_info, sensor) in current.items():
+            topic = f"{self.discovery_prefix}/{component}/{object_id}/config"
+            payload = {
+                "name": f"{device_info['name']} {sensor['name']}",
+                "state_topic": self.state_topic,
+                "availability_topic": self.availability_topic,
+                "unique_id": object_id,
+                "device": device_info,
+            }
+            if sensor.get("device_class"):
+                payload["device_class"] = sensor["device_class"]
+            if component == "binary_sensor":
+                payload["value_template"] = f"{{{{ 'ON' if value_json.{sensor['suffix']} else 'OFF' }}}}"
+            else:
+                payload["value_template"] = f"{{{{ value_json.{sensor['suffix']} }}}}"
+                if sensor.get("unit"):
+                    payload["state_class"] = "measurement"
+                    payload["unit_of_measurement"] = sensor["unit"]
+            client.publish(topic, json.dumps(payload), retain=True)
+        # Sensors that disappeared: clear their retained config so HA drops them.
+        for component, object_id in set(self.published or {}) - set(current):
+            client.publish(f"{self.discovery_prefix}/{component}/{object_id}/config", "", retain=True)
+        client.publish(self.availability_topic, "online", retain=True)
+        self.published = current
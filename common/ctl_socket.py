@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Line-delimited JSON control socket (Unix stream, no thread).
+
+The owner adds ``fds()`` to its own ``select()`` and passes the ready list to
+``handle()``, which accepts connections and returns complete requests as
+``(client, dict)``.  Replies go back with ``send()``; clients registered with
+``subscribe()`` get every ``publish()`` until they disconnect.
+"""
+import json
+import os
+import socket
+
+SEND_TIMEOUT = 1.0      # s; a client that cannot take a reply this fast is dropped
+MAX_LINE = 64 * 1024
+
+
+class ControlServer:
+    def __init__(self, path, mode=0o660):
+        self.path = str(path)
+        try:
+            os.unlink(self.path)  # stale socket from a previous run
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, mode)
+        sock.listen(8)
+        sock.setblocking(False)
+        self.sock = sock
+        self.clients = {}       # socket -> pending bytes
+        self.subscribers = set()
+
+    def fds(self):
+        return [self.sock] + list(self.clients)
+
+    def _drop(self, client):
+        self.clients.pop(client, None)
+        self.subscribers.discard(client)
+        try:
+            client.close()
+        except OSError:
+            pass
+
+    def handle(self, ready):
+        """Serve the ready sockets; return the complete requests received."""
+        requests = []
+        for s in ready:
+            if s is self.sock:
+                try:
+                    client, _ = self.sock.accept()
+                except OSError:
+                    continue
+                client.settimeout(SEND_TIMEOUT)
+                self.clients[client] = b""
+            elif s in self.clients:
+                try:
+                    data = s.recv(4096)
+                except OSError:
+                    data = b""
+                if not data:
+                    self._drop(s)
+                    continue
+                buf = self.clients[s] + data
+                *lines, rest = buf.split(b"\n")
+                if len(rest) > MAX_LINE:
+                    self._drop(s)
+                    continue
+                self.clients[s] = rest
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    try:
+                        req = json.loads(line)
+                        if not isinstance(req, dict):
+                            raise ValueError("request must be a JSON object")
+                    except ValueError as e:
+                        self.send(s, {"ok": False, "error": f"bad request: {e}"})
+                        continue
+                    requests.append((s, req))
+        return requests
+
+    def send(self, client, obj):
+        if client not in self.clients:
+            return False
+        try:
+            client.sendall(json.dumps(obj, separators=(",", ":")).encode() + b"\n")
+            return True
+        except OSError:
+            self._drop(client)
+            return False
+
+    def subscribe(self, client):
+        if client in self.clients:
+            self.subscribers.add(client)
+
+    def publish(self, obj):
+        for client in list(self.subscribers):
+            self.send(client, obj)
+
+    def close(self):
+        for client in list(self.clients):
+            self._drop(client)
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
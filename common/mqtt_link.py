@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Persistent MQTT connection shared by the CPU scheduler and fan controller.
+
+The broker settings come from the Home Assistant MQTT integration
+(``core.config_entries``) and are parsed once per process.  ``MqttLink`` keeps
+one connection open in paho's network thread, reconnects with backoff,
+announces availability through an LWT and never blocks the caller:
+``publish()`` only records the latest payload per topic, which is sent right
+away when connected or flushed after the next (re)connect.
+"""
+import json
+import pathlib
+import threading
+
+try:
+    import paho.mqtt.client as mqtt
+except Exception:  # pragma: no cover - optional dependency
+    mqtt = None
+
+HA_CONFIG_ENTRIES = pathlib.Path("/home/vojrik/homeassistant/.storage/core.config_entries")
+RECONNECT_MIN_SEC = 1
+RECONNECT_MAX_SEC = 120
+KEEPALIVE_SEC = 60
+
+_CONFIG_CACHE = {}
+
+
+def load_ha_mqtt_config(path=HA_CONFIG_ENTRIES):
+    """Broker host/port/credentials from the HA MQTT entry; None when unavailable."""
+    path = pathlib.Path(path)
+    if path in _CONFIG_CACHE:
+        return _CONFIG_CACHE[path]
+    cfg = None
+    try:
+        data = json.loads(path.read_text())
+    except Exception:
+        data = {}
+    for entry in data.get("data", {}).get("entries", []):
+        if entry.get("domain") == "mqtt":
+            entry_cfg = entry.get("data", {})
+            cfg = {
+                "host": entry_cfg.get("broker", "127.0.0.1"),
+                "port": int(entry_cfg.get("port", 1883)),
+                "username": entry_cfg.get("username"),
+                "password": entry_cfg.get("password"),
+            }
+            break
+    _CONFIG_CACHE[path] = cfg
+    return cfg
+
+
+def _connack_ok(reason_code):
+    # paho 2.x passes a ReasonCode object, 1.x a plain int.
+    if hasattr(reason_code, "is_failure"):
+        return not reason_code.is_failure
+    return reason_code == 0
+
+
+class MqttLink:
+    """One lazily started, auto-reconnecting MQTT client.
+
+    ``status_topic`` (optional) gets a retained ``online`` after every connect
+    and ``offline`` as LWT / on ``close()``.
+    """
+
+    def __init__(self, client_id, status_topic=None, config=None):
+        self.client_id = client_id
+        self.status_topic = status_topic
+        self._config = config
+        self._client = None
+        self._started = False
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed = threading.Event()
+        self._flushed.set()
+        self._last_info = None
+
+    def _get_config(self):
+        if self._config is None:
+            self._config = load_ha_mqtt_config()
+        return self._config
+
+    def _start(self):
+        self._started = True
+        cfg = self._get_config()
+        if mqtt is None or not cfg:
+            return
+        try:
+            client = mqtt.Client(
+                client_id=self.client_id,
+                clean_session=True,
+                callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            )
+        except (AttributeError, TypeError):
+            client = mqtt.Client(client_id=self.client_id, clean_session=True)
+        if cfg.get("username"):
+            client.username_pw_set(cfg.get("username"), cfg.get("password"))
+        if self.status_topic:
+            client.will_set(self.status_topic, "offline", retain=True)
+        client.reconnect_delay_set(min_delay=RECONNECT_MIN_SEC, max_delay=RECONNECT_MAX_SEC)
+        client.on_connect = self._on_connect
+        self._client = client
+        try:
+            client.connect_async(cfg["host"], cfg["port"], keepalive=KEEPALIVE_SEC)
+            client.loop_start()
+        except Exception:
+            self._client = None
+
+    def _on_connect(self, client, _userdata, _flags, reason_code, *_extra):
+        if not _connack_ok(reason_code):
+            return
+        if self.status_topic:
+            client.publish(self.status_topic, "online", retain=True)
+        self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending = list(self._pending.items())
+        for topic, (payload, retain) in pending:
+            info = self._client.publish(topic, payload, qos=1, retain=retain)
+            if info.rc != 0:
+                return
+            self._last_info = info
+            with self._lock:
+                # Keep a newer value queued meanwhile by publish().
+                if self._pending.get(topic) == (payload, retain):
+                    del self._pending[topic]
+                if not self._pending:
+                    self._flushed.set()
+
+    def publish(self, topic, payload, retain=False):
+        """Queue ``payload`` for ``topic`` (latest wins); returns False if MQTT is unusable."""
+        if not self._started:
+            self._start()
+        if self._client is None:
+            return False
+        with self._lock:
+            self._pending[topic] = (payload, retain)
+            self._flushed.clear()
+        if self._client.is_connected():
+            self._flush()
+        return True
+
+    def close(self, flush_timeout=0.0):
+        """Optionally wait for queued messages, then disconnect."""
+        if self._client is None:
+            return
+        if flush_timeout > 0 and self._flushed.wait(flush_timeout) and self._last_info is not None:
+            try:
+                self._last_info.wait_for_publish(flush_timeout)
+            except Exception:
+                pass
+        if self.status_topic and self._client.is_connected():
+            self._client.publish(self.status_topic, "offline", retain=True)
+        self._client.disconnect()
+        self._client.loop_stop()
+        self._client = None
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Cached sysfs attribute handles.
+
+Each attribute keeps its fd open and is accessed with ``pread``/``pwrite`` at
+offset 0, which re-runs the kernel show/store handler without reopening the
+path.  Writes of the value that was last written are skipped; ``ensure()``
+does a cheap read first so values changed behind our back (firmware, another
+tool) are still detected and corrected.
+"""
+import errno
+import os
+
+_STALE = (errno.ENODEV, errno.ENOENT, errno.EBADF)
+
+
+class SysfsAttr:
+    """One attribute file.  ``truncate=True`` is for plain files standing in for
+    sysfs (test/simulator trees), which keep stale tail bytes after a shorter
+    pwrite; never set it for real kernel attributes."""
+
+    def __init__(self, path, static=False, truncate=False):
+        self.path = str(path)
+        self.static = static
+        self.truncate = truncate
+        self.writes = 0
+        self.skipped = 0
+        self._fd = None
+        self._writable = False
+        self._cached = None
+        self._last = None
+
+    def _open(self):
+        if self._fd is not None:
+            return self._fd
+        try:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CLOEXEC)
+            self._writable = True
+        except PermissionError:
+            try:
+                # read-only attribute (or unprivileged status query)
+                self._fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+                self._writable = False
+            except PermissionError:
+                # write-only attribute such as export/unexport
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_CLOEXEC)
+                self._writable = True
+        return self._fd
+
+    def _pwrite(self, fd, data):
+        os.pwrite(fd, data, 0)
+        if self.truncate:
+            os.ftruncate(fd, len(data))
+
+    def _retry(self, func):
+        try:
+            return func(self._open())
+        except OSError as exc:
+            if exc.errno not in _STALE or self._fd is None:
+                raise
+            # node went away and came back (e.g. PWM re-export): reopen once
+            self.close()
+            return func(self._open())
+
+    def read(self):
+        if self.static and self._cached is not None:
+            return self._cached
+        value = self._retry(lambda fd: os.pread(fd, 4096, 0)).decode().strip()
+        if self.static:
+            self._cached = value
+        return value
+
+    def read_int(self):
+        try:
+            return int(self.read())
+        except (OSError, ValueError):
+            return None
+
+    def write(self, value, force=False):
+        """Write ``value`` unless it equals the last value we wrote; True if written."""
+        text = str(value)
+        if not force and text == self._last:
+            self.skipped += 1
+            return False
+        data = text.encode()
+        self._open()
+        if self._writable:
+            self._retry(lambda fd: self._pwrite(fd, data))
+        else:
+            # opened read-only; let the kernel decide on a one-shot write
+            fd = os.open(self.path, os.O_WRONLY | os.O_CLOEXEC)
+            try:
+                self._pwrite(fd, data)
+            finally:
+                os.close(fd)
+        self._last = text
+        self.writes += 1
+        return True
+
+    def ensure(self, value):
+        """Read the current value and write ``value`` only if it differs.
+
+        Returns the value found before the write (as a string).
+        """
+        current = self.read()
+        if current != str(value):
+            self.write(value, force=True)
+        else:
+            self._last = current
+            self.skipped += 1
+        return current
+
+    def forget(self):
+        """Drop the remembered last write (e.g. after the device was reset)."""
+        self._last = None
+
+    def close(self):
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except OSError:
+                pass
+            self._fd = None
+
+
+class SysfsCache:
+    """Path -> SysfsAttr registry so callers can keep using plain paths.
+
+    ``truncate`` is the default for attributes created from now on (see SysfsAttr).
+    """
+
+    def __init__(self, truncate=False):
+        self._attrs = {}
+        self.truncate = truncate
+
+    def attr(self, path, static=False, truncate=None):
+        key = str(path)
+        attr = self._attrs.get(key)
+        if attr is None:
+            attr = self._attrs[key] = SysfsAttr(
+                key, static=static, truncate=self.truncate if truncate is None else truncate
+            )
+        return attr
+
+    def read(self, path, static=False):
+        return self.attr(path, static).read()
+
+    def read_int(self, path, static=False):
+        return self.attr(path, static).read_int()
+
+    def write(self, path, value, force=False):
+        return self.attr(path).write(value, force=force)
+
+    def ensure(self, path, value):
+        return self.attr(path).ensure(value)
+
+    def forget(self, prefix=""):
+        for key, attr in self._attrs.items():
+            if key.startswith(prefix):
+                attr.forget()
+
+    def close(self, prefix=""):
+        for key in [k for k in self._attrs if k.startswith(prefix)]:
+            self._attrs.pop(key).close()
+
+    def stats(self):
+        writes = sum(a.writes for a in self._attrs.values())
+        skipped = sum(a.skipped for a in self._attrs.values())
+        return {"open": sum(1 for a in self._attrs.values() if a._fd is not None), "writes": writes, "skipped": skipped}
@@ -2,14 +2,22 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import time
+import fcntl
+import socket
+import struct
+import ipaddress
+import threading
 import subprocess
 import multiprocessing as mp
 import traceback
 from configparser import ConfigParser
 from collections import defaultdict
+from types import MappingProxyType
 
-# ------ Commands used for OLED info ------
+# ------ Shell commands formerly used for OLED info ------
+# Kept as the reference for the readers below (`python3 misc.py bench`).
 cmds = {
     'blk': "lsblk | awk '{print $1}'",
     'up': "s=$(cut -d. -f1 /proc/uptime); d=$((s/86400)); h=$(((s%86400)/3600)); m=$(((s%3600)/60)); "
@@ -33,18 +41,156 @@ def check_output(cmd):
 def check_call(cmd):
     return subprocess.check_call(cmd, shell=True)
 
+# ------ In-process readers (same text as the shell commands above) ------
+def _human(n):
+    """df -h size: powers of 1024, rounded up, one decimal below 10."""
+    units = 'KMGTPE'
+    i, div = -1, 1
+    while n >= div * 1024 and i < len(units) - 1:
+        div *= 1024
+        i += 1
+    if i < 0:
+        return str(n)
+    tenths = -(-n * 10 // div)
+    if tenths < 100:
+        return '{}.{}{}'.format(tenths // 10, tenths % 10, units[i])
+    whole = -(-n // div)
+    if whole >= 1024 and i < len(units) - 1:
+        return '1.0' + units[i + 1]
+    return '{}{}'.format(whole, units[i])
+
+def _df(path):
+    """(size, used, use%) as `df -hP` prints them, None if path is missing."""
+    try:
+        st = os.statvfs(path)
+    except OSError:
+        return None
+    size = st.f_blocks * st.f_frsize
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    avail = st.f_bavail * st.f_frsize
+    pct = -(-used * 100 // (used + avail)) if used + avail else 0
+    return _human(size), _human(used), '{}%'.format(pct)
+
+def _disk_text(label, path):
+    df = _df(path)
+    if df is None:
+        return ''
+    t, u, pct = df
+    # same quirks as the awk: unit from the size, first letter stripped from both numbers
+    g = t[-1:]
+    g = {'G': 'GB', 'T': 'TB'}.get(g, g)
+    strip = lambda v: next((v[:i] + v[i + 1:] for i, ch in enumerate(v) if 'A' <= ch <= 'Z'), v)
+    return '{}: {}/{} {}, {}'.format(label, strip(u), strip(t), g, pct)
+
+def _uptime_text():
+    with open('/proc/uptime', 'r', encoding='ascii') as fh:
+        s = int(fh.read().split('.')[0])
+    d, h, m = s // 86400, (s % 86400) // 3600, (s % 3600) // 60
+    if d > 0:
+        val = '{}d{:02d}h'.format(d, h)
+    elif h > 0:
+        val = '{:02d}h{:02d}m'.format(h, m)
+    else:
+        val = '{}m'.format(m)
+    return 'Uptime: ' + val
+
+def _meminfo():
+    info = {}
+    with open('/proc/meminfo', 'r', encoding='ascii') as fh:
+        for line in fh:
+            key, _, rest = line.partition(':')
+            info[key] = int(rest.split()[0])
+    return info
+
+def _mem_text():
+    m = _meminfo()
+    total = m['MemTotal']
+    # procps-ng 4 `free`: used = total - available, MiB truncated
+    used = total - m.get('MemAvailable', m['MemFree'])
+    return 'RAM: {}/{} MB'.format(used // 1024, total // 1024)
+
+_SIOCGIFADDR = 0x8915
+
+def _host_addresses():
+    """Like `hostname -I`: IPv4 per interface, then global IPv6; no loopback or link-local."""
+    addrs = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        for _, name in socket.if_nameindex():
+            try:
+                res = fcntl.ioctl(s.fileno(), _SIOCGIFADDR, struct.pack('256s', name[:15].encode()))
+            except OSError:
+                continue
+            addr = socket.inet_ntoa(res[20:24])
+            if not addr.startswith('127.'):
+                addrs.append(addr)
+    try:
+        with open('/proc/net/if_inet6', 'r', encoding='ascii') as fh:
+            for line in fh:
+                f = line.split()
+                if int(f[3], 16) & 0x30:   # host (loopback) or link scope
+                    continue
+                addrs.append(str(ipaddress.IPv6Address(bytes.fromhex(f[0]))))
+    except OSError:
+        pass
+    return addrs
+
+def _ip_text():
+    addrs = _host_addresses()
+    return 'IP ' + (addrs[0] if addrs else '')
+
+def _blk_text():
+    """NAME column of `lsblk` (disks and partitions; holders such as md are not nested)."""
+    devs = []
+    for dev in os.listdir('/sys/block'):
+        base = os.path.join('/sys/block', dev)
+        try:
+            with open(os.path.join(base, 'dev'), 'r', encoding='ascii') as fh:
+                major, minor = (int(x) for x in fh.read().split(':'))
+        except (OSError, ValueError):
+            continue
+        # lsblk skips ram disks and loop devices without a backing file
+        if major == 1 or (dev.startswith('loop') and not os.path.exists(os.path.join(base, 'loop', 'backing_file'))):
+            continue
+        devs.append((major, minor, dev))
+    lines = ['NAME']
+    for _, _, dev in sorted(devs):
+        lines.append(dev)
+        parts = sorted(p for p in os.listdir(os.path.join('/sys/block', dev)) if p.startswith(dev))
+        for i, part in enumerate(parts):
+            lines.append(('└─' if i == len(parts) - 1 else '├─') + part)
+    return '\n'.join(lines)
+
+def _temp_text():
+    with open('/sys/class/thermal/thermal_zone0/temp', 'r', encoding='ascii') as fh:
+        return fh.read().strip()
+
+readers = {
+    'blk': _blk_text,
+    'up': _uptime_text,
+    'temp': _temp_text,
+    'ip': _ip_text,
+    'men': _mem_text,
+    'disk_root': lambda: _disk_text('Root', '/'),
+    'disk_md0': lambda: _disk_text('md0', '/mnt/md0'),
+    'disk_md1': lambda: _disk_text('md1', '/mnt/md1'),
+}
+
 def get_info(key):
     if key == 'cpu':
         return get_cpu_load()
-    return check_output(cmds[key])
+    return readers[key]()
 
-def get_cpu_temp():
-    t = float(get_info('temp')) / 1000.0
+def format_cpu_temp(t):
+    if t is None:
+        return "CPU Temp: --"
     if conf['oled']['f-temp']:
         return "CPU Temp: {:.0f}°F".format(t * 1.8 + 32)
     return "CPU Temp: {:.1f}°C".format(t)
 
-_cpu_cache = {'time': 0.0, 'text': 'CPU Load: -- %'}
+def get_cpu_temp():
+    return format_cpu_temp(float(get_info('temp')) / 1000.0)
+
+_cpu_cache = {'time': 0.0, 'text': 'CPU Load: -- %', 'prev': None}
 
 def _read_cpu_times():
     with open('/proc/stat', 'r', encoding='ascii') as fh:
@@ -64,9 +210,13 @@ def get_cpu_load():
     if now - _cpu_cache['time'] < 1.0:
         return _cpu_cache['text']
 
-    total_1, idle_1 = _read_cpu_times()
-    time.sleep(0.1)
+    # load since the previous call; only the very first call has to wait for a second sample
+    if _cpu_cache['prev'] is None:
+        _cpu_cache['prev'] = _read_cpu_times()
+        time.sleep(0.1)
+    total_1, idle_1 = _cpu_cache['prev']
     total_2, idle_2 = _read_cpu_times()
+    _cpu_cache['prev'] = (total_2, idle_2)
 
     total_delta = total_2 - total_1
     idle_delta = idle_2 - idle_1
@@ -108,8 +258,8 @@ def read_conf():
 def get_disk_info(cache={}):
     if not cache.get('time') or time.time() - cache['time'] > 30:
         info = {}
-        cmd = "df -h | awk '$NF==\"/\"{printf \"%s\", $5}'"
-        info['root'] = check_output(cmd)
+        df = _df('/')
+        info['root'] = '' if df is None else df[2]
         # Add any additional devices here if you want more than the root filesystem:
         # for dev in ('md0','md1'): ...
         cache['info'] = list(zip(*info.items()))
@@ -131,3 +281,102 @@ conf.update(read_conf())
 def reload_conf():
     conf.update(read_conf())
     return conf
+
+# ------ Background metrics collector ------
+# Seconds between refreshes; the OLED only formats the latest snapshot.
+REFRESH_S = {
+    'cpu': 2.0,
+    'temp': 2.0,
+    'men': 5.0,
+    'up': 30.0,
+    'disk_root': 30.0,
+    'disk_md0': 30.0,
+    'disk_md1': 30.0,
+    'ip': 60.0,
+}
+
+class Collector(threading.Thread):
+    """Refreshes each metric on its own interval and publishes an immutable
+    snapshot (MappingProxyType, replaced as a whole). A slow or failing reader
+    only delays this thread; readers keep their last good value."""
+
+    def __init__(self, refresh=None):
+        super().__init__(daemon=True, name='oled-metrics')
+        self.refresh = dict(refresh or REFRESH_S)
+        self.due = dict.fromkeys(self.refresh, 0.0)
+        self.values = {}
+        self.snapshot = MappingProxyType({})
+
+    @staticmethod
+    def _read(key):
+        if key == 'temp':
+            return float(_temp_text()) / 1000.0
+        return get_info(key)
+
+    def poll(self):
+        """Refresh the metrics that are due; seconds until the next one is."""
+        changed = False
+        for key, every in self.refresh.items():
+            if time.monotonic() < self.due[key]:
+                continue
+            self.due[key] = time.monotonic() + every
+            try:
+                value = self._read(key)
+            except Exception:
+                continue
+            if self.values.get(key) != value:
+                self.values[key] = value
+                changed = True
+        if changed:
+            self.snapshot = MappingProxyType(dict(self.values))
+        return min(self.due.values()) - time.monotonic()
+
+    def run(self):
+        while True:
+            try:
+                wait = self.poll()
+            except Exception:
+                traceback.print_exc()
+                wait = 1.0
+            time.sleep(max(0.05, wait))
+
+_collector = None
+_collector_lock = threading.Lock()
+
+def snapshot():
+    """Latest metrics; starts the collector (one synchronous pass) on first use."""
+    global _collector
+    if _collector is None:
+        with _collector_lock:
+            if _collector is None:
+                c = Collector()
+                c.poll()
+                c.start()
+                _collector = c
+    return _collector.snapshot
+
+# ------ Micro-benchmark: readers vs. the shell commands ------
+def bench(rounds=50):
+    print('{:10} {:>10} {:>10} {:>8}  {}'.format('key', 'shell ms', 'native ms', 'speedup', 'same output'))
+    for key, cmd in cmds.items():
+        try:
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                shell = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL).decode().strip()
+            t_shell = (time.perf_counter() - t0) * 1000.0 / rounds
+            t0 = time.perf_counter()
+            for _ in range(rounds):
+                native = readers[key]()
+            t_native = (time.perf_counter() - t0) * 1000.0 / rounds
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('{:10} skipped: {}'.format(key, e))
+            continue
+        same = 'yes' if shell == native else 'no: {!r} vs {!r}'.format(shell, native)
+        print('{:10} {:10.3f} {:10.4f} {:7.0f}x  {}'.format(key, t_shell, t_native, t_shell / max(t_native, 1e-9), same))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        bench(int(sys.argv[2]) if len(sys.argv) > 2 else 50)
+    else:
+        print('usage: misc.py bench [ROUNDS]', file=sys.stderr)
+        sys.exit(2)
@@ -378,21 +378,23 @@ def put_disk_info():
     return page
 
 def gen_pages():
+    # formats only from the collector's snapshot: no I/O on the render path
+    snap = misc.snapshot()
     text_color = _text_color()
     pages = {
         0: [
-            {'xy': (0, -2), 'text': misc.get_info('up'), 'fill': text_color, 'font': font['11']},
-            {'xy': (0, 10), 'text': misc.get_cpu_temp(), 'fill': text_color, 'font': font['11']},
-            {'xy': (0, 21), 'text': misc.get_info('ip'), 'fill': text_color, 'font': font['11']},
+            {'xy': (0, -2), 'text': snap.get('up', ''), 'fill': text_color, 'font': font['11']},
+            {'xy': (0, 10), 'text': misc.format_cpu_temp(snap.get('temp')), 'fill': text_color, 'font': font['11']},
+            {'xy': (0, 21), 'text': snap.get('ip', ''), 'fill': text_color, 'font': font['11']},
         ],
         1: [
-            {'xy': (0, 2), 'text': misc.get_info('cpu'), 'fill': text_color, 'font': font['12']},
-            {'xy': (0, 18), 'text': misc.get_info('men'), 'fill': text_color, 'font': font['12']},
+            {'xy': (0, 2), 'text': snap.get('cpu', 'CPU Load: -- %'), 'fill': text_color, 'font': font['12']},
+            {'xy': (0, 18), 'text': snap.get('men', ''), 'fill': text_color, 'font': font['12']},
         ],
         2: [
-            {'xy': (0, -2), 'text': misc.get_info('disk_root'), 'fill': text_color, 'font': font['10']},
-            {'xy': (0, 10), 'text': misc.get_info('disk_md0'),  'fill': text_color, 'font': font['10']},
-            {'xy': (0, 21), 'text': misc.get_info('disk_md1'),  'fill': text_color, 'font': font['10']},
+            {'xy': (0, -2), 'text': snap.get('disk_root', ''), 'fill': text_color, 'font': font['10']},
+            {'xy': (0, 10), 'text': snap.get('disk_md0', ''),  'fill': text_color, 'font': font['10']},
+            {'xy': (0, 21), 'text': snap.get('disk_md1', ''),  'fill': text_color, 'font': font['10']},
         ],
     }
     return pages